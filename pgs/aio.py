@@ -0,0 +1,1204 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.aio
+===============
+
+An asyncio front end for pgs (Python >= 3.7).
+
+Static files (the paths of :func:`pgs.app.serve_static_files`) are served
+on the event loop:
+
+* ``304`` and ``HEAD`` responses and cached small files are written from
+  memory (:class:`pgs.app.Resource` header records and the response cache)
+* HTML pages get ``Link: rel=preload`` headers and (while their bodies
+  are read) ``103 Early Hints`` responses (see :mod:`pgs.prefetch`)
+* files from a :class:`pgs.app.DirectoryRepositoryFS` and blobs from
+  the disk blob cache (:mod:`pgs.blobcache`) are sent with
+  ``loop.sendfile``
+* git repositories are served through an :class:`AsyncGitRepositoryFS`:
+  revisions are resolved and indexed, and blobs are read from a persistent
+  ``git cat-file --batch`` process (or spooled to a temporary file by
+  ``git cat-file``), with ``asyncio.create_subprocess_exec``
+
+Only lookups that are not in memory (e.g. ``stat`` for directories),
+new path resolutions and blobs from a synchronous
+:class:`pgs.app.SubprocessGitRepositoryFS` (in slots of its
+:class:`pgs.limits.ProcessLimiter`) run in the thread pool. Dirlists,
+ranges and other requests fall through to the pgs bottle app (also in
+the thread pool); its responses are streamed to the event loop through
+a queue of at most ``STREAM_QUEUE_SIZE`` chunks. Requests that need the
+backend are admitted as by the :class:`pgs.app.StaticFilesFastPath`,
+waiting for a slot on the event loop (:class:`AsyncAdmission`).
+
+Idle keep-alive connections cost one coroutine each, so one process can
+hold many thousands of them.
+
+Usage::
+
+    pgs -p /var/www/html -s asyncio
+"""
+import asyncio
+import collections
+import io
+import logging
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import unquote
+
+import bottle
+
+from .app import (MtimesParser,
+                  NOT_MODIFIED_EXCLUDED_HEADERS, RESPONSE_CACHE_MAX_SIZE,
+                  StaticFilesFastPath, SubprocessGitRepositoryFS,
+                  _output_text, early_hints, get_FS, http_date,
+                  is_not_modified, parse_diff_tree, parse_ls_tree,
+                  peek_response, resolve_path, response_headers,
+                  store_response)
+from .limits import ProcessTimeout, QueueTimeout, Unavailable
+from .prefetch import prefetch, scan_html
+
+log = logging.getLogger('pgs.aio')
+
+CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 8
+
+GIT_BATCH_MAX_SIZE = 1024 * 1024
+
+
+async def _reap(proc):
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+    await proc.wait()
+
+
+class GitCatFileBatch(object):
+    """
+    A persistent ``git cat-file --batch`` process
+
+    Requests are serialised with a lock; the process is restarted if a
+    read is interrupted (so that its output never gets out of step).
+    """
+
+    def __init__(self, cmd, timeout=None):
+        """
+        Arguments:
+            cmd (list): ``git`` command prefix (e.g. ``['git', '-C', path]``)
+
+        Keyword Arguments:
+            timeout (float): seconds before a read is abandoned (and the
+                process restarted)
+        """
+        self.cmd = list(cmd) + ['cat-file', '--batch']
+        self.timeout = timeout
+        self.proc = None
+        self.lock = asyncio.Lock()
+
+    async def read(self, sha):
+        """
+        Read an object
+
+        Arguments:
+            sha (str): object hash
+
+        Returns:
+            bytes: object contents (or None if the object is missing)
+
+        Raises:
+            ProcessTimeout: if the read took longer than ``timeout``
+        """
+        try:
+            return await asyncio.wait_for(self._read(sha), self.timeout)
+        except asyncio.TimeoutError:
+            raise ProcessTimeout('git cat-file --batch timed out')
+
+    async def _read(self, sha):
+        async with self.lock:
+            if self.proc is None or self.proc.returncode is not None:
+                self.proc = await asyncio.create_subprocess_exec(
+                    *self.cmd, stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE)
+            proc = self.proc
+            try:
+                proc.stdin.write(sha.encode('ascii') + b'\n')
+                await proc.stdin.drain()
+                header = (await proc.stdout.readline()).split()
+                if len(header) != 3:
+                    return None
+                size = int(header[2])
+                data = await proc.stdout.readexactly(size + 1)
+                return data[:-1]
+            except BaseException:
+                self.close()
+                raise
+
+    def close(self):
+        """
+        Stop the process
+        """
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        return proc
+
+    async def aclose(self):
+        """
+        Stop the process and wait for it to exit
+        """
+        proc = self.close()
+        if proc is not None:
+            await proc.wait()
+
+
+class AsyncBlobReader(object):
+    """
+    Async iterator over the chunks of a blob
+
+    Small blobs are read whole from the :class:`GitCatFileBatch` process;
+    larger blobs are spooled to an anonymous temporary file by their own
+    ``git cat-file blob`` process (see
+    :meth:`AsyncGitRepositoryFS.spool_git`), and read from it (and copied
+    to ``sink``, a :class:`pgs.blobcache.BlobWriter`, if given).
+    """
+
+    def __init__(self, data=b'', fileobj=None, chunk_size=CHUNK_SIZE,
+                 sink=None):
+        self.data = data
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.sink = sink
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(self.chunk_size)
+        if not chunk:
+            await self.close()
+            raise StopAsyncIteration
+        return chunk
+
+    async def read(self, size=-1):
+        """
+        Arguments:
+            size (int): bytes to read (-1: all)
+
+        Returns:
+            bytes: up to ``size`` bytes (``b''`` at the end)
+        """
+        if self.fileobj is None:
+            if size < 0:
+                size = len(self.data)
+            chunk, self.data = self.data[:size], self.data[size:]
+            return chunk
+        # a local file that was just written: in the page cache
+        chunk = self.fileobj.read(size)
+        if self.sink is not None:
+            self.sink.write(chunk)
+        return chunk
+
+    async def close(self):
+        fileobj, self.fileobj = self.fileobj, None
+        sink, self.sink = self.sink, None
+        self.data = b''
+        try:
+            if fileobj is not None:
+                fileobj.close()
+        finally:
+            if sink is not None:
+                sink.close()
+
+
+class AsyncGitRepositoryFS(SubprocessGitRepositoryFS):
+    """
+    A :class:`pgs.app.SubprocessGitRepositoryFS` with an async interface
+
+    * :meth:`refresh` resolves ``repo_rev`` and builds the tree index and
+      modification times with asyncio subprocesses
+    * ``await fs.stat(path)`` returns a :class:`pgs.app.Resource`
+    * ``await fs.open(resource)`` returns an :class:`AsyncBlobReader`
+    * ``await fs.resolve(url_path)`` is :func:`pgs.app.resolve_path`
+
+    Blobs up to ``pgs.git_batch_max_size`` bytes (default: 1 MB) are read
+    from one persistent ``git cat-file --batch`` process; blobs which
+    are read are added to the disk blob cache (``pgs.blob_cache_path``),
+    if there is one, and later sent from there with ``sendfile``.
+    Other git processes share an asyncio semaphore of
+    ``pgs.git_max_processes`` slots with the queue and per-call timeouts of
+    the :class:`pgs.limits.ProcessLimiter` (a separate budget from the
+    one used by the synchronous interface).
+    The synchronous interface still works (e.g. for bottle fallback
+    requests in a thread pool); the tree index is always used.
+    """
+
+    use_index = True
+
+    def reset(self):
+        super(AsyncGitRepositoryFS, self).reset()
+        batch = getattr(self, '_batch', None)
+        if batch is not None:
+            batch.close()
+        self._batch = None
+        self._refresh_lock = None
+        self._slots = None
+        self._reads = {}
+        self._puts = set()
+
+    def post_fork(self):
+        # the batch process belongs to the parent process
+        self._batch = None
+        self.reset()
+
+    def close(self):
+        batch, self._batch = self._batch, None
+        if batch is not None:
+            batch.close()
+
+    async def aclose(self):
+        """
+        Stop the batch process and wait for it to exit
+        """
+        batch, self._batch = self._batch, None
+        if batch is not None:
+            await batch.aclose()
+
+    async def acquire(self):
+        """
+        Take a git process slot
+
+        Raises:
+            QueueTimeout: if no slot became free within the queue timeout
+        """
+        limiter = self.limiter
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(limiter.max_processes)
+        try:
+            await asyncio.wait_for(self._slots.acquire(),
+                                   limiter.queue_timeout)
+        except asyncio.TimeoutError:
+            raise QueueTimeout(
+                'all %d git processes busy' % limiter.max_processes,
+                limiter.retry_after)
+
+    async def run_git(self, *args):
+        """
+        Run a git command in a slot
+
+        Returns:
+            bytes: its standard output
+
+        Raises:
+            subprocess.CalledProcessError: if it fails
+            QueueTimeout: if no slot became free in time
+            ProcessTimeout: if it was killed after ``pgs.git_timeout``
+        """
+        cmd = self.git_cmd() + list(args)
+        await self.acquire()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE)
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(),
+                                                   self.limiter.timeout)
+            except asyncio.TimeoutError:
+                await _reap(proc)
+                raise ProcessTimeout('git process timed out: %r' % (cmd,),
+                                     self.limiter.retry_after)
+        finally:
+            self._slots.release()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    async def spool_git(self, *args):
+        """
+        Run a git command in a slot with its standard output written to an
+        anonymous temporary file, so that the slot is given back as soon
+        as it exits (not when a slow client has read it all; see
+        :meth:`pgs.limits.ProcessLimiter.spool`)
+
+        Returns:
+            file: its standard output (at offset 0)
+
+        Raises:
+            IOError: if it fails
+            QueueTimeout: if no slot became free in time
+            ProcessTimeout: if it was killed after ``pgs.git_timeout``
+        """
+        cmd = self.git_cmd() + list(args)
+        fileobj = tempfile.TemporaryFile(prefix='pgs-spool-')
+        try:
+            await self.acquire()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=fileobj)
+                try:
+                    await asyncio.wait_for(proc.wait(), self.limiter.timeout)
+                except asyncio.TimeoutError:
+                    await _reap(proc)
+                    raise ProcessTimeout(
+                        'git process timed out: %r' % (cmd,),
+                        self.limiter.retry_after)
+            finally:
+                self._slots.release()
+            if proc.returncode:
+                raise IOError('%r exited with %d' % (cmd, proc.returncode))
+            fileobj.seek(0)
+            return fileobj
+        except BaseException:
+            fileobj.close()
+            raise
+
+    async def refresh(self):
+        """
+        Resolve ``repo_rev`` (at most every ``pgs.git_rev_ttl`` seconds)
+        and build the tree index and modification times of the current
+        commit, so that :meth:`metadata_ready` is true
+
+        Returns:
+            str: commit hash
+        """
+        if self.metadata_ready():
+            return self._snapshot
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            now = time.time()
+            ttl = self.conf.get('pgs.git_rev_ttl', 1)
+            if self._snapshot is None or now - self._snapshot_checked >= ttl:
+                output = await self.run_git(
+                    'rev-parse', '--verify', '%s^{commit}' % self.repo_rev)
+                commit = _output_text(output).strip()
+                changes = None
+                if self._snapshot is not None and commit != self._snapshot:
+                    changes = await self.diff_snapshot_async(
+                        self._snapshot, commit)
+                self.set_snapshot(commit, now, changes)
+            commit = self._snapshot
+            if self._index is None:
+                self.load_index(commit)
+            if self._index is None:
+                output = await self.run_git(
+                    'ls-tree', '-r', '-t', '-l', '-z', '--full-tree', commit)
+                self._index = parse_ls_tree(_output_text(output), commit)
+            if self._mtimes is None:
+                mtimes = await self.read_mtimes(self._index)
+                loop = asyncio.get_running_loop()
+                index, mtimes = await loop.run_in_executor(
+                    None, self.save_index, commit, self._index, mtimes)
+                if self._snapshot == commit:
+                    self._index, self._mtimes = index, mtimes
+            return commit
+
+    async def diff_snapshot_async(self, old, new):
+        """
+        Returns:
+            dict: ``{path: status}`` (see
+            :meth:`pgs.app.SubprocessGitRepositoryFS.diff_snapshot`)
+        """
+        try:
+            output = await self.run_git(*self.diff_args(old, new))
+        except subprocess.CalledProcessError as e:
+            log.warning('cannot diff %s..%s: %s', old, new, e)
+            return None
+        return parse_diff_tree(_output_text(output))
+
+    async def read_mtimes(self, index):
+        """
+        Returns:
+            dict: ``{path: committer_date}`` (see
+            :meth:`pgs.app.SubprocessGitRepositoryFS.get_mtimes`)
+        """
+        parser = MtimesParser(index)
+
+        async def scan(stdout):
+            while not parser.done:
+                chunk = await stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+
+        await self.acquire()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.mtimes_cmd(index), stdout=asyncio.subprocess.PIPE)
+            try:
+                await asyncio.wait_for(scan(proc.stdout), self.limiter.timeout)
+            except asyncio.TimeoutError:
+                raise ProcessTimeout('git log timed out',
+                                     self.limiter.retry_after)
+            finally:
+                await _reap(proc)
+        finally:
+            self._slots.release()
+        return parser.mtimes
+
+    async def stat(self, path):
+        """
+        Arguments:
+            path (str): path to a file
+
+        Returns:
+            Resource: header record (or None if ``path`` is not a blob)
+        """
+        await self.refresh()
+        return self.get_resource(path)
+
+    async def resolve(self, url_path, executor=None):
+        """
+        Resolve a request path from memory, or else in a thread (so that
+        the event loop never waits for a resolution of another thread)
+
+        Arguments:
+            url_path (str): request path
+
+        Keyword Arguments:
+            executor (concurrent.futures.Executor): thread pool (default:
+                the loop's)
+
+        Returns:
+            tuple: ``(path, resource)`` (see :func:`pgs.app.resolve_path`)
+        """
+        await self.refresh()
+        resource = self.lookup_cached(url_path)
+        if resource is not None:
+            return resource.path, resource
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, resolve_path, self,
+                                          url_path)
+
+    async def read_blob(self, sha):
+        """
+        Read a blob from the batch process (concurrent reads of the same
+        blob share one read)
+
+        Arguments:
+            sha (str): blob hash
+
+        Returns:
+            bytes: blob contents (or None if the blob is missing)
+        """
+        future = self._reads.get(sha)
+        if future is None:
+            if self._batch is None:
+                self._batch = GitCatFileBatch(self.git_cmd(),
+                                              timeout=self.limiter.timeout)
+            future = asyncio.ensure_future(self._batch.read(sha))
+            self._reads[sha] = future
+            future.add_done_callback(lambda f: self._reads.pop(sha, None))
+        return await asyncio.shield(future)
+
+    def put_blob(self, sha, data):
+        """
+        Add a blob to the disk blob cache in the thread pool (failures are
+        logged)
+
+        Arguments:
+            sha (str): blob hash
+            data (bytes): blob contents
+        """
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self.blob_cache.put, sha, data)
+        self._puts.add(future)  # until it is done
+        future.add_done_callback(self._put_done)
+
+    def _put_done(self, future):
+        self._puts.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            log.warning('cannot cache blob: %s', future.exception())
+
+    async def open(self, resource):
+        """
+        Arguments:
+            resource (Resource): header record of a blob
+
+        Returns:
+            AsyncBlobReader: blob contents
+        """
+        sha = resource.etag.strip('"')
+        max_size = self.conf.get('pgs.git_batch_max_size', GIT_BATCH_MAX_SIZE)
+        if resource.size <= max_size:
+            data = await self.read_blob(sha)
+            if data is None:
+                raise IOError('missing blob: %s' % sha)
+            if self.blob_cache is not None:
+                self.put_blob(sha, data)
+            return AsyncBlobReader(data)
+        fileobj = await self.spool_git('cat-file', 'blob', sha)
+        sink = None
+        if self.blob_cache is not None:
+            sink = self.blob_cache.writer(sha, resource.size)
+        return AsyncBlobReader(fileobj=fileobj, sink=sink)
+
+
+class AsyncAdmission(object):
+    """
+    :class:`pgs.limits.AdmissionController` admission on the event loop
+
+    Requests wait for an in-flight slot in a future (at most
+    ``max_queue`` of them, for at most ``max_wait`` seconds) instead of
+    an executor thread, so that the executor queue cannot absorb an
+    overload and the CoDel sojourn time covers the whole wait. The
+    counters and dropping state are the controller's.
+    """
+
+    def __init__(self, controller):
+        """
+        Arguments:
+            controller (pgs.limits.AdmissionController): admission limits
+                and state
+        """
+        self.controller = controller
+        self._waiters = collections.deque()
+
+    async def admit(self):
+        """
+        Take an in-flight slot
+
+        Raises:
+            pgs.limits.Overloaded: if the request is shed
+        """
+        controller = self.controller
+        arrival = time.time()
+        if controller.inflight >= controller.max_inflight:
+            if controller.waiting >= controller.max_queue:
+                raise controller._shed('queue full')
+            deadline = arrival + controller.max_wait
+            controller.waiting += 1
+            try:
+                while controller.inflight >= controller.max_inflight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise controller._shed('queue timeout')
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    try:
+                        await asyncio.wait_for(waiter, remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    finally:
+                        if waiter in self._waiters:
+                            self._waiters.remove(waiter)
+            finally:
+                controller.waiting -= 1
+        now = time.time()
+        with controller._cond:
+            drop = controller._should_drop(now - arrival, now)
+            if not drop:
+                controller.inflight += 1
+        if drop:
+            self.wake()
+            raise controller._shed('queueing delay above target')
+
+    def release(self):
+        """
+        Give an in-flight slot back
+        """
+        self.controller.release()
+        self.wake()
+
+    def wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+class AsyncPgsServer(object):
+    """
+    An asyncio HTTP/1.1 server for a pgs bottle app
+
+    Files that were resolved before are sent from memory or disk; every
+    other request (refreshing the revision, resolving a path, reading a
+    blob from git, or the bottle app) first takes a slot from the
+    :class:`pgs.limits.AdmissionController` of the
+    :class:`pgs.app.StaticFilesFastPath` (waiting for it on the event
+    loop, see :class:`AsyncAdmission`), or is answered with ``503``.
+
+    With ``pgs.rate_limit``, clients are charged by the
+    :class:`pgs.limits.RateLimiter` of the fast path as it does (``429``
+    when over the limit).
+    """
+
+    def __init__(self, app,
+                 keepalive_timeout=75,
+                 max_body_size=1024 * 1024,
+                 executor=None,
+                 async_git=True):
+        """
+        Arguments:
+            app (bottle.Bottle): pgs bottle app (see :func:`pgs.app.make_app`)
+                or its :class:`pgs.app.StaticFilesFastPath`
+
+        Keyword Arguments:
+            keepalive_timeout (float): seconds to wait for the next request
+                on a connection
+            max_body_size (int): largest request body to accept
+            executor (concurrent.futures.Executor): thread pool for
+                metadata and fallback requests (default: the loop's)
+            async_git (bool): replace a
+                :class:`pgs.app.SubprocessGitRepositoryFS` with an
+                :class:`AsyncGitRepositoryFS`
+        """
+        if not isinstance(app, StaticFilesFastPath):
+            app = StaticFilesFastPath(app)
+        self.fast_path = app
+        self.app = app = app.app
+        FS = get_FS(app)
+        if async_git and type(FS) is SubprocessGitRepositoryFS:
+            app.config['pgs.FS'] = AsyncGitRepositoryFS(FS.conf)
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body_size = max_body_size
+        self.executor = executor
+        self.server = None
+        self._admission = None
+
+    @property
+    def FS(self):
+        return self.app.config['pgs.FS']
+
+    @property
+    def admission(self):
+        """
+        AsyncAdmission: event loop admission for the controller of the
+        fast path
+        """
+        controller = self.fast_path.admission
+        if (self._admission is None
+                or self._admission.controller is not controller):
+            self._admission = AsyncAdmission(controller)
+        return self._admission
+
+    async def start(self, host='127.0.0.1', port=8082, sock=None,
+                    backlog=1024):
+        """
+        Start listening
+
+        Arguments:
+            host (str): address to bind to
+            port (int): port to bind to
+            sock (socket.socket): already bound socket to use instead
+
+        Returns:
+            asyncio.AbstractServer: server
+        """
+        if sock is not None:
+            host = port = None
+        self.server = await asyncio.start_server(
+            self.handle_connection, host, port, sock=sock, backlog=backlog)
+        return self.server
+
+    async def close(self):
+        """
+        Stop listening and stop the git batch process
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        FS = self.FS
+        if isinstance(FS, AsyncGitRepositoryFS):
+            await FS.aclose()
+
+    async def run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handle the requests of one connection, in order
+        """
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                environ = self.parse_request(head, writer)
+                if environ is None:
+                    self.write_head(writer, '400 Bad Request',
+                                    [('Content-Length', '0')], False)
+                    break
+                try:
+                    length = int(environ.get('CONTENT_LENGTH') or 0)
+                except ValueError:
+                    length = -1
+                if (not 0 <= length <= self.max_body_size
+                        or 'HTTP_TRANSFER_ENCODING' in environ):
+                    self.write_head(writer, '413 Payload Too Large',
+                                    [('Content-Length', '0')], False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                environ['wsgi.input'] = io.BytesIO(body)
+                keep_alive = await self.handle_request(
+                    environ, writer, self.keep_alive(environ))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            log.exception('error handling connection')
+        finally:
+            writer.close()
+
+    def parse_request(self, head, writer):
+        """
+        Arguments:
+            head (bytes): request line and headers
+
+        Returns:
+            dict: WSGI environ (or None if the request is malformed)
+        """
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            return None
+        if not version.startswith('HTTP/1.'):
+            return None
+        path, _, query = target.partition('?')
+        sockname = writer.get_extra_info('sockname') or ('', 0)
+        peername = writer.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': str(sockname[0]),
+            'SERVER_PORT': str(sockname[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': str(peername[0]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            name = name.strip().replace('-', '_').upper()
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+                continue
+            key = 'HTTP_' + name
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
+
+    def keep_alive(self, environ):
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def write_head(self, writer, status, headers, keep_alive):
+        """
+        Write a status line and headers (adding ``Date`` and ``Connection``)
+        """
+        out = ['HTTP/1.1 %s\r\n' % status]
+        out.extend('%s: %s\r\n' % header for header in headers)
+        out.append('Date: %s\r\n' % http_date())
+        if not keep_alive:
+            out.append('Connection: close\r\n')
+        out.append('\r\n')
+        writer.write(''.join(out).encode('latin-1'))
+
+    def write_early_hints(self, environ, writer, headers):
+        """
+        Write a ``103 Early Hints`` response (to HTTP/1.1 clients)
+        """
+        if environ['SERVER_PROTOCOL'] != 'HTTP/1.1':
+            return
+        out = ['HTTP/1.1 103 Early Hints\r\n']
+        out.extend('%s: %s\r\n' % header for header in headers)
+        out.append('\r\n')
+        writer.write(''.join(out).encode('latin-1'))
+
+    async def handle_request(self, environ, writer, keep_alive):
+        """
+        Serve a static file on the event loop, or fall through to the
+        bottle app (``503`` if the git backend is saturated)
+
+        Returns:
+            bool: whether the connection can be kept alive
+        """
+        try:
+            return await self.serve_request(environ, writer, keep_alive)
+        except Unavailable as e:
+            log.warning('%s: %s' % (e.status[:3], e))
+            self.write_head(writer, e.status, [
+                ('Content-Length', '0'),
+                ('Retry-After', str(e.retry_after))], keep_alive)
+            return keep_alive
+
+    async def serve_request(self, environ, writer, keep_alive):
+        """
+        Returns:
+            bool: whether the connection can be kept alive
+        """
+        url_path = environ['PATH_INFO']
+        try:
+            url_path = url_path.encode('latin1').decode('utf8')
+        except UnicodeError:
+            url_path = None
+        if (environ['REQUEST_METHOD'] not in ('GET', 'HEAD')
+                or 'HTTP_RANGE' in environ
+                or url_path is not None and url_path.endswith('@@')):
+            url_path = None
+        FS = self.FS
+        resource = None
+        self.fast_path.charge(environ, 'cached')
+        if url_path is not None:
+            resource = await self.lookup(FS, url_path)
+            if resource is not None and await self.send_resource(
+                    environ, writer, keep_alive, FS, resource):
+                return keep_alive
+        self.fast_path.charge(environ, 'uncached', paid='cached')
+        admission = self.admission
+        await admission.admit()
+        try:
+            if url_path is not None and resource is None:
+                if isinstance(FS, AsyncGitRepositoryFS):
+                    await FS.refresh()
+                path, resource = await self.run_in_executor(
+                    resolve_path, FS, url_path)
+                if resource is not None and await self.send_resource(
+                        environ, writer, keep_alive, FS, resource):
+                    return keep_alive
+            if resource is not None:
+                return await self.send_blob(environ, writer, keep_alive, FS,
+                                            resource)
+            return await self.send_wsgi(environ, writer, keep_alive)
+        finally:
+            admission.release()
+
+    async def lookup(self, FS, url_path):
+        """
+        Get the :class:`pgs.app.Resource` of a previously resolved request
+        path (from memory on the event loop, or else in the thread pool)
+
+        Paths which are not resolved in memory (see
+        :meth:`pgs.app.RepositoryFS.is_resolved`) are not looked up: that
+        could refresh the revision, so it waits for admission.
+
+        Returns:
+            pgs.app.Resource: header record (or None)
+        """
+        resource = FS.lookup_cached(url_path)
+        if resource is None and FS.is_resolved(url_path):
+            resource = await self.run_in_executor(FS.lookup, url_path)
+        return resource
+
+    async def send_resource(self, environ, writer, keep_alive, FS, resource):
+        """
+        Send a ``304`` or ``200`` response for a :class:`pgs.app.Resource`
+        from memory or a file on disk
+
+        Returns:
+            bool: False if the body must be read from git instead (see
+            :meth:`send_blob`)
+        """
+        if is_not_modified(environ, resource):
+            headers = [h for h in resource.headers
+                       if h[0] not in NOT_MODIFIED_EXCLUDED_HEADERS]
+            self.write_head(writer, '304 Not Modified', headers, keep_alive)
+            return True
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            self.write_head(writer, '200 OK', response_headers(FS, resource),
+                            keep_alive)
+            return True
+        hints = early_hints(FS, resource)
+        if hints:
+            self.write_early_hints(environ, writer, hints)
+            await writer.drain()
+        # never FS.flights on the loop: other threads may hold the same
+        # flight while they read from git
+        response = peek_response(FS, resource)
+        if response is not None:
+            status, headers, body = response
+            self.write_head(writer, status, headers, keep_alive)
+            writer.write(body)
+            return True
+        # files (and blobs in the disk blob cache) are sent with sendfile
+        try:
+            fileobj = FS.open_cached(resource)
+        except (IOError, OSError) as e:
+            log.warning('cannot open %r: %s', resource.path, e)
+            return False
+        if fileobj is not None:
+            scan_html(FS, resource, fileobj)
+            self.write_head(writer, '200 OK', response_headers(FS, resource),
+                            keep_alive)
+            await self.send_file(writer, fileobj, resource.size)
+            return True
+        return False
+
+    async def send_blob(self, environ, writer, keep_alive, FS, resource):
+        """
+        Send a ``200`` response for a :class:`pgs.app.Resource` from git
+        (or another backend), or fall through to the bottle app if it
+        cannot be opened (which answers as :func:`pgs.app.static_file`
+        does, e.g. with ``403``)
+
+        Returns:
+            bool: whether the connection can be kept alive
+        """
+        try:
+            if isinstance(FS, AsyncGitRepositoryFS):
+                body = await FS.open(resource)
+            else:
+                # e.g. git cat-file, in a slot of FS.limiter
+                body = await self.run_in_executor(FS.open_resource, resource)
+        except (IOError, OSError) as e:
+            log.warning('cannot open %r: %s', resource.path, e)
+            return await self.send_wsgi(environ, writer, keep_alive)
+        if isinstance(body, AsyncBlobReader):
+            await self.send_async_blob(writer, keep_alive, FS, resource, body)
+            return keep_alive
+        self.write_head(writer, '200 OK', response_headers(FS, resource),
+                        keep_alive)
+        await self.send_body(writer, body, resource.size)
+        return keep_alive
+
+    async def send_file(self, writer, fileobj, size):
+        """
+        Send (and close) a file with ``loop.sendfile``
+        """
+        with fileobj:
+            await writer.drain()
+            loop = asyncio.get_running_loop()
+            await loop.sendfile(writer.transport, fileobj, 0, size)
+
+    async def send_body(self, writer, body, size):
+        """
+        Send (and close) a binary file object: files with ``sendfile``,
+        streams (e.g. from ``git cat-file``) in chunks read in the thread
+        pool
+        """
+        try:
+            body.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        else:
+            await self.send_file(writer, body, size)
+            return
+        try:
+            while True:
+                chunk = await self.run_in_executor(body.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            await self.run_in_executor(body.close)
+
+    async def send_async_blob(self, writer, keep_alive, FS, resource, blob):
+        """
+        Send a blob opened by an :class:`AsyncGitRepositoryFS`
+        (caching the response if it is small)
+        """
+        max_size = FS.conf.get('pgs.response_cache_max_size',
+                               RESPONSE_CACHE_MAX_SIZE)
+        if resource.size <= max_size:
+            body = await blob.read()
+            await blob.close()
+            status, headers, body = store_response(FS, resource, body)
+            prefetch(FS, resource, body)
+            self.write_head(writer, status, headers, keep_alive)
+            writer.write(body)
+            return
+        self.write_head(writer, '200 OK', response_headers(FS, resource),
+                        keep_alive)
+        if blob.fileobj is not None and blob.sink is None:
+            fileobj, blob.fileobj = blob.fileobj, None  # spooled
+            await self.send_file(writer, fileobj, resource.size)
+            return
+        try:
+            async for chunk in blob:
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            await blob.close()
+
+    async def send_wsgi(self, environ, writer, keep_alive):
+        """
+        Call the bottle app in the thread pool and stream its response
+        (chunked if it has no ``Content-Length``)
+
+        Returns:
+            bool: whether the connection can be kept alive
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+        aborted = threading.Event()
+
+        def emit(item):
+            if aborted.is_set():
+                if item is None:
+                    return
+                raise ConnectionAbortedError('client went away')
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        future = loop.run_in_executor(self.executor, self.call_wsgi,
+                                      environ, emit)
+        try:
+            head = await queue.get()
+            if head is None:
+                await future
+            status, headers = head
+            method = environ['REQUEST_METHOD']
+            chunked = False
+            if (method != 'HEAD' and status[:3] not in ('204', '304')
+                    and not any(name.lower() == 'content-length'
+                                for (name, _) in headers)):
+                if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                    headers = list(headers)
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                    chunked = True
+                else:
+                    keep_alive = False
+            self.write_head(writer, status, headers, keep_alive)
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break
+                if method == 'HEAD':
+                    continue
+                if chunked:
+                    writer.write(b'%x\r\n' % len(data))
+                    writer.write(data)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(data)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await future
+            return keep_alive
+        finally:
+            if not future.done():
+                # unblock and stop the app thread; it closes the body
+                aborted.set()
+                while not queue.empty():
+                    queue.get_nowait()
+                future.add_done_callback(
+                    lambda future: future.cancelled() or future.exception())
+
+    def call_wsgi(self, environ, emit):
+        """
+        Call the bottle app, and ``emit`` its ``(status, headers)``, each
+        body chunk, and None at the end
+
+        Arguments:
+            environ (dict): WSGI environ
+            emit (callable): ``emit(item)`` blocks while the queue is full
+        """
+        state = {'head': None, 'sent': False}
+
+        def write(data):
+            if not state['sent']:
+                if state['head'] is None:
+                    raise RuntimeError('start_response was not called')
+                state['sent'] = True
+                emit(state['head'])
+            if data:
+                emit(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state['sent']:
+                raise exc_info[1]
+            state['head'] = (status, headers)
+            return write
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+                write(b'')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            emit(None)
+
+
+async def serve(app, host='127.0.0.1', port=8082, sock=None, **kwargs):
+    """
+    Serve a pgs bottle app with an :class:`AsyncPgsServer` until cancelled
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app (or its
+            :class:`pgs.app.StaticFilesFastPath`)
+        host (str): address to bind to
+        port (int): port to bind to
+        sock (socket.socket): already bound socket to use instead
+
+    Keyword Arguments:
+        kwargs (dict): :class:`AsyncPgsServer` options
+    """
+    server = await AsyncPgsServer(app, **kwargs).start(host, port, sock=sock)
+    async with server:
+        await server.serve_forever()
+
+
+class _SocketServer(object):
+
+    def __init__(self, sock, app, **options):
+        self.sock, self.app, self.options = sock, app, options
+
+    def serve_forever(self):
+        asyncio.run(serve(self.app, sock=self.sock, **self.options))
+
+
+def make_asyncio_server(sock, app, quiet=False, **options):
+    """
+    Create an asyncio server for an already bound, listening socket
+    (``make_server`` for :class:`pgs.servers.PreforkServer`)
+
+    Arguments:
+        sock (socket.socket): listening socket
+        app (callable): pgs bottle app (or its
+            :class:`pgs.app.StaticFilesFastPath`)
+
+    Keyword Arguments:
+        options (dict): :class:`AsyncPgsServer` options
+
+    Returns:
+        object: server with a ``serve_forever`` method
+    """
+    return _SocketServer(sock, app, **options)
+
+
+class AsyncioServer(bottle.ServerAdapter):
+    """
+    Serve with an :class:`AsyncPgsServer`
+
+    Options:
+        keepalive_timeout (float): idle seconds before a persistent
+            connection is closed (default: 75)
+    """
+
+    def run(self, handler):  # pragma: no cover
+        try:
+            asyncio.run(serve(handler, self.host, self.port, **self.options))
+        except KeyboardInterrupt:
+            pass
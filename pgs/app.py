@@ -30,11 +30,15 @@ import cgi
 import collections
 import codecs
 import distutils.spawn
+import functools
 import logging
 import mimetypes
 import os.path
+import stat
 import subprocess
+import threading
 import time
+import weakref
 
 
 import bottle
@@ -45,9 +49,25 @@ try:
 except ImportError:
     dulwich = None
 
+from .blobcache import DiskBlobCache
+from .cache import (CacheBudget, ENTRY_OVERHEAD, LRUCache, SingleFlight,
+                    TinyLFUCache)
+from .index import CompactIndex, IndexCache
+from .limits import (AdmissionController, ProcessLimiter, ProcessTimeout,
+                     RateLimiter, Unavailable)
+from .policy import CacheControlPolicy
+from .prefetch import Prefetcher, prefetch, preload_headers, scan_html
+from .servers import (PreforkServer, ThreadPoolServer,
+                      make_threadpool_server, make_wsgiref_server)
+from .warmup import WARM_TOP, PathSampler, read_access_log, start_warmup
+
 DEBUG = False
 DEFAULT_ENCODING = 'UTF8'
 
+RESPONSE_CACHE_MAX_SIZE = 64 * 1024
+
+MISSING = object()
+
 log = logging.getLogger('pgs.app')
 if DEBUG:
     log.setLevel(logging.DEBUG)
@@ -94,12 +114,477 @@ def pathjoin(*args, **kwargs):
     return sanitize_path(joined_path)
 
 
-class DirectoryRepositoryFS(object):
+HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+
+def http_date(timestamp=None):
+    """
+    Format a timestamp as an RFC 1123 HTTP date (e.g. for ``Last-Modified``)
+
+    Arguments:
+        timestamp (float): seconds since the epoch (default: now)
+
+    Returns:
+        str: e.g. ``Sat, 10 Feb 2018 21:49:59 GMT``
+    """
+    return time.strftime(HTTP_DATE_FORMAT, time.gmtime(timestamp))
+
+
+class Resource(collections.namedtuple(
+        'Resource', ['path', 'size', 'mtime', 'etag', 'headers'])):
+    """
+    An immutable, precomputed response header record for one file
+
+    Attributes:
+        path (str): path of the file within its FS
+        size (int): file size in bytes
+        mtime (int): modification time (seconds since the epoch)
+        etag (str): quoted entity tag
+        headers (tuple): ``(name, value)`` pairs sent with every 200 response
+            (``Content-Type``, ``Content-Length``, ``Last-Modified``,
+            ``ETag``, ``Cache-Control``)
+    """
+    __slots__ = ()
+
+
+def make_resource(path, size, mtime, etag,
+                  cache_control=None,
+                  cache_policy=None,
+                  accept_ranges=False,
+                  mimetype='auto',
+                  download=False,
+                  charset='UTF-8'):
+    """
+    Build a :class:`Resource` header record for a file
+
+    Arguments:
+        path (str): path of the file (used to guess the MIME type)
+        size (int): file size in bytes
+        mtime (float): modification time (seconds since the epoch)
+        etag (str): quoted entity tag
+
+    Keyword Arguments:
+        cache_control (str): ``Cache-Control`` header value (or None)
+        cache_policy (callable): ``cache_policy(path, mimetype)`` returns
+            the ``Cache-Control`` header value (see
+            :class:`pgs.policy.CacheControlPolicy`)
+        accept_ranges (bool): whether to send ``Accept-Ranges: bytes``
+        mimetype (str): ``Content-Type`` (default: guess from ``path``)
+        download (bool or str): send a ``Content-Disposition`` header
+        charset (str): charset for ``text/*`` MIME types
+
+    Returns:
+        Resource: an immutable header record
+    """
+    headers = []
+    if mimetype == 'auto':
+        if download and download is not True:
+            mimetype, encoding = mimetypes.guess_type(download)
+        else:
+            mimetype, encoding = mimetypes.guess_type(path)
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+    if cache_policy is not None:
+        cache_control = cache_policy(path, mimetype)
+
+    if mimetype:
+        if mimetype[:5] == 'text/' and charset and 'charset' not in mimetype:
+            mimetype += '; charset=%s' % charset
+        headers.append(('Content-Type', mimetype))
+    else:
+        headers.append(
+            ('Content-Type', bottle.BaseResponse.default_content_type))
+
+    if download:
+        download = os.path.basename(path if download is True else download)
+        headers.append(
+            ('Content-Disposition', 'attachment; filename="%s"' % download))
+
+    mtime = int(mtime)
+    headers.append(('Content-Length', str(size)))
+    headers.append(('Last-Modified', http_date(mtime)))
+    headers.append(('ETag', etag))
+    if cache_control:
+        headers.append(('Cache-Control', cache_control))
+    if accept_ranges:
+        headers.append(('Accept-Ranges', 'bytes'))
+    return Resource(path, size, mtime, etag, tuple(headers))
+
+
+def is_not_modified(environ, resource):
+    """
+    Evaluate ``If-None-Match`` (or else ``If-Modified-Since``) request
+    headers against a :class:`Resource`
+
+    Arguments:
+        environ (dict): WSGI environ
+        resource (Resource): header record
+
+    Returns:
+        bool: True if a ``304 Not Modified`` response should be sent
+    """
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    if inm is not None:
+        tags = [tag.strip() for tag in inm.split(',')]
+        return inm.strip() == '*' or resource.etag in [
+            tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ims:
+        ims = parse_date(ims.split(";")[0].strip())
+        return ims is not None and ims >= resource.mtime
+    return False
+
+
+def cached_response(FS, resource, variant='identity', opener=None):
+    """
+    Get (or read and cache) the complete ``200 OK`` response for a small file
+
+    Responses are keyed by path, ETag and encoding variant; files larger
+    than ``pgs.response_cache_max_size`` (default: 64 KB) are not cached.
+    Concurrent misses for the same key share one read. The assets of
+    HTML responses are prefetched (with ``pgs.prefetch``) and preloaded
+    (with ``pgs.preload``; see :mod:`pgs.prefetch`).
+
+    Arguments:
+        FS (RepositoryFS): filesystem to read from
+        resource (Resource): header record
+
+    Keyword Arguments:
+        variant (str): content encoding variant
+        opener (callable): ``opener(resource)`` returns a binary file object
+            (or None) on a cache miss (default: ``FS.open_resource``)
+
+    Returns:
+        tuple: ``(status, headers, body)`` (or None)
+    """
+    key = (resource.path, resource.etag, variant)
+    response = FS.responses.get(key)
+    if response is None:
+        max_size = FS.conf.get('pgs.response_cache_max_size',
+                               RESPONSE_CACHE_MAX_SIZE)
+        if resource.size > max_size:
+            return None
+        response = FS.flights.do(('response',) + key, _read_response,
+                                 FS, resource, key, opener)
+    if response is not None and variant == 'identity':
+        prefetch(FS, resource, response[2])
+    return response
+
+
+def _read_response(FS, resource, key, opener):
+    response = FS.responses.peek(key)
+    if response is not None:
+        return response
+    fileobj = (opener or FS.open_resource)(resource)
+    if fileobj is None:
+        return None
+    try:
+        body = fileobj.read()
+    finally:
+        fileobj.close()
+    return store_response(FS, resource, body, variant=key[2])
+
+
+def peek_response(FS, resource, variant='identity'):
+    """
+    :func:`cached_response` from memory only, for callers which must not
+    block (no reads, and no waiting for the reads of other threads)
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (Resource): header record
+
+    Keyword Arguments:
+        variant (str): content encoding variant
+
+    Returns:
+        tuple: ``(status, headers, body)`` (or None)
+    """
+    response = FS.responses.get((resource.path, resource.etag, variant))
+    if response is not None and variant == 'identity':
+        prefetch(FS, resource, response[2])
+    return response
+
+
+def store_response(FS, resource, body, variant='identity'):
+    """
+    Add the complete ``200 OK`` response for a small file to the response
+    cache
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (Resource): header record
+        body (bytes): file contents
+
+    Keyword Arguments:
+        variant (str): content encoding variant
+
+    Returns:
+        tuple: ``(status, headers, body)``
+    """
+    headers = list(resource.headers)
+    headers.extend(preload_headers(FS, resource, body))
+    response = ('200 OK', headers, body)
+    FS.responses.set((resource.path, resource.etag, variant), response)
+    return response
+
+
+def response_headers(FS, resource):
+    """
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (Resource): header record
+
+    Returns:
+        list: ``200 OK`` response headers (with the ``Link: rel=preload``
+        header of an HTML page whose assets are known)
+    """
+    headers = list(resource.headers)
+    headers.extend(preload_headers(FS, resource))
+    return headers
+
+
+def early_hints(FS, resource):
+    """
+    Get the headers of a ``103 Early Hints`` response (with
+    ``pgs.early_hints``), sent while the body of an HTML page whose
+    assets are known is read
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (Resource): header record
+
+    Returns:
+        tuple: ``Link`` headers (or ``()`` if the complete response is
+        already cached, or the assets are not known)
+    """
+    if not FS.conf.get('pgs.early_hints'):
+        return ()
+    if FS.responses.peek((resource.path, resource.etag, 'identity')):
+        return ()
+    return preload_headers(FS, resource)
+
+
+def send_early_hints(environ, FS, resource):
+    """
+    Send a ``103 Early Hints`` response if the server supports it
+    (``environ['wsgi.early_hints']``; see :mod:`pgs.servers`)
+
+    Arguments:
+        environ (dict): WSGI environ
+        FS (RepositoryFS): filesystem
+        resource (Resource): header record
+    """
+    send = environ.get('wsgi.early_hints')
+    if send is not None:
+        headers = early_hints(FS, resource)
+        if headers:
+            send(list(headers))
+
+
+def _output_text(output):
+    if not isinstance(output, str):
+        output = output.decode(DEFAULT_ENCODING)
+    return output
+
+
+class RepositoryFS(object):
+    """
+    Base class for pgs filesystems, with their per-process caches
+
+    Attributes:
+        caches (CacheBudget): shared budget of the caches below
+            (``pgs.cache_size`` bytes)
+        resolutions (LRUCache): resolved request paths
+        responses (LRUCache): small complete responses
+            (``pgs.response_cache_size``)
+        dirlists (LRUCache): directory listings
+        html_assets (LRUCache): asset URLs of HTML pages, per ETag
+        cache_policy (CacheControlPolicy): ``Cache-Control`` policy
+        flights (SingleFlight): coalesces concurrent cache misses
+        sampler (PathSampler): recent request paths (or None)
+        prefetcher (Prefetcher): asset prefetcher (or None)
+    """
 
     def __init__(self, conf):
         self.conf = conf
-        if 'pgs.root_path' not in self.conf:
+        self.reset()
+
+    def reset(self):
+        """
+        Drop all cached state
+        """
+        self.caches = caches = CacheBudget.from_conf(self.conf)
+        # weights: the relative cost of a miss (cf. pgs.rate_limit_costs)
+        self._resources = caches.register(
+            'resources', LRUCache(overhead=ENTRY_OVERHEAD), weight=2)
+        self.resolutions = caches.register(
+            'resolutions', LRUCache(overhead=ENTRY_OVERHEAD), weight=1)
+        ContentCache = (LRUCache
+                        if self.conf.get('pgs.cache_admission') == 'lru'
+                        else TinyLFUCache)
+        self.responses = caches.register(
+            'responses',
+            ContentCache(self.conf.get('pgs.response_cache_size'),
+                         overhead=ENTRY_OVERHEAD),
+            weight=4)
+        self.dirlists = caches.register(
+            'dirlists', ContentCache(overhead=ENTRY_OVERHEAD), weight=8)
+        self.html_assets = caches.register(
+            'html_assets', LRUCache(overhead=ENTRY_OVERHEAD), weight=4)
+        self.cache_policy = CacheControlPolicy.from_conf(self.conf)
+        self.flights = SingleFlight()
+        self.sampler = PathSampler.from_conf(self.conf)
+        self.prefetcher = Prefetcher.from_conf(self.conf, self)
+
+    def post_fork(self):
+        """
+        Reinitialise per-process state in a forked worker process
+        """
+        self.reset()
+
+    def close(self):
+        """
+        Release per-process resources (e.g. in an exiting worker process)
+        """
+
+    def metadata_ready(self):
+        """
+        Returns:
+            bool: True if :func:`resolve_path` can be answered from memory
+            (without system calls or subprocesses that could block)
+        """
+        return False
+
+    def invalidate(self, changes):
+        """
+        Drop the cached state that depends on changed paths (when the
+        served revision moves), keeping everything else warm
+
+        * :class:`Resource` records and responses of changed paths
+        * resolutions to deleted or replaced paths, and of the request
+          paths an added path could now resolve (``a``, ``a.html`` and
+          ``a/index.html`` for ``/a``)
+        * dirlists of changed paths and of the directories in which
+          paths were added, deleted or replaced
+
+        Arguments:
+            changes (dict): ``{path: status}`` (``A``, ``D``, ``M`` or
+                ``T`` as in ``git diff-tree --name-status``; see
+                :func:`parse_diff_tree`)
+
+        Returns:
+            int: number of cache entries removed
+        """
+        changed = set(changes)
+        moved = set(path for (path, status) in changes.items()
+                    if status != 'M')
+        requests, dirs = set(moved), set(moved)
+        for path in moved:
+            dirname, _, name = path.rpartition('/')
+            dirs.add(dirname)
+            if name == 'index.html':
+                requests.add(dirname)
+            elif name.endswith('.html'):
+                requests.add(path[:-len('.html')])
+        removed = self._resources.pop_matching(
+            lambda path, resource: path in changed)
+        removed += self.responses.pop_matching(
+            lambda key, response: key[0] in changed)
+        removed += self.resolutions.pop_matching(
+            lambda url_path, path: (url_path.strip('/') in requests
+                                    or path in moved))
+        removed += self.dirlists.pop_matching(
+            lambda path, lines: path.strip('/') in dirs)
+        log.debug('invalidated %d cache entries for %d changed paths',
+                  removed, len(changes))
+        return removed
+
+    def snapshot(self):
+        """
+        Returns:
+            str: an identifier for the current revision (or None)
+        """
+        return None
+
+    def lookup(self, url_path):
+        """
+        Get the :class:`Resource` for a previously resolved request path
+
+        Arguments:
+            url_path (str): request path (e.g. ``/a/b``)
+
+        Returns:
+            Resource: header record (or None if not resolved yet)
+        """
+        if self.sampler is not None:
+            self.sampler.record(url_path)
+        self.snapshot()
+        path = self.resolutions.get(url_path)
+        if path is None:
+            return None
+        return self.get_resource(path)
+
+    def lookup_cached(self, url_path):
+        """
+        :meth:`lookup` from memory only, for callers which must not block
+        (no revision check, system calls, subprocesses or waiting for
+        other threads)
+
+        Arguments:
+            url_path (str): request path
+
+        Returns:
+            Resource: header record (or None if it is not in memory)
+        """
+        return None
+
+    def is_resolved(self, url_path):
+        """
+        Check (from memory) whether :meth:`lookup` is a cache hit, which
+        runs no backend subprocesses and so need not be admitted (see
+        :class:`StaticFilesFastPath`)
+
+        Arguments:
+            url_path (str): request path
+
+        Returns:
+            bool: True if ``url_path`` was resolved in the current snapshot
+        """
+        return self.resolutions.peek(url_path) is not None
+
+    def open_cached(self, resource):
+        """
+        Open a resource body without any backend subprocesses
+
+        Arguments:
+            resource (Resource): header record
+
+        Returns:
+            file-like: binary file object (or None)
+        """
+        return None
+
+
+class DirectoryRepositoryFS(RepositoryFS):
+
+    def __init__(self, conf):
+        if 'pgs.root_path' not in conf:
             raise Exception('must specify root_path')
+        super(DirectoryRepositoryFS, self).__init__(conf)
+
+    def lookup(self, url_path):
+        # there are no snapshots to invalidate resolutions with: the
+        # Resource is revalidated by get_resource, and a resolution to
+        # ``a.html`` for ``/a`` is dropped once ``a`` has been added
+        resource = super(DirectoryRepositoryFS, self).lookup(url_path)
+        if resource is None:
+            return None
+        path = url_path.strip('/')
+        if resource.path == path + '.html' and self.exists(path):
+            return None
+        return resource
 
     @property
     def root_path(self):
@@ -148,13 +633,167 @@ class DirectoryRepositoryFS(object):
     def hassyspath(self, path):
         return bool(self.getsyspath(path))
 
+    def get_resource(self, path):
+        """
+        Get the :class:`Resource` header record for a file
+
+        Records are cached and revalidated with one ``os.stat`` call.
+
+        Arguments:
+            path (str): path to a file
+
+        Returns:
+            Resource: header record (or None if ``path`` is not a file)
+        """
+        syspath = self.getsyspath(path)
+        root_path = os.path.abspath(self.root_path).rstrip(os.sep) + os.sep
+        if not os.path.abspath(syspath).startswith(root_path):
+            return None
+        try:
+            stats = os.stat(syspath)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stats.st_mode):
+            return None
+        key = (stats.st_ino, stats.st_size, int(stats.st_mtime))
+        cached = self._resources.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        resource = make_resource(
+            path, stats.st_size, stats.st_mtime,
+            etag='"%x-%x-%x"' % key,
+            cache_policy=self.cache_policy,
+            accept_ranges=True)
+        self._resources.set(path, (key, resource))
+        return resource
+
+    def open_resource(self, resource):
+        return open(self.getsyspath(resource.path), 'rb')
+
+    open_cached = open_resource
+
+
+def parse_ls_tree(output, commit):
+    """
+    Parse ``git ls-tree -r -t -l -z --full-tree`` output
+
+    Arguments:
+        output (str): ``ls-tree`` output
+        commit (str): the commit that was listed
+
+    Returns:
+        pgs.index.CompactIndex: ``{path: (mode, type, hash, size)}``
+        (the root tree is ``''``)
+    """
+    index = CompactIndex(sha_size=len(commit) // 2)
+    index.add('', ('040000', 'tree', commit, '-'))
+    for record in output.split('\0'):
+        if record:
+            fields, name = record.split('\t', 1)
+            index.add(name, fields.split())
+    index.compact()
+    return index
+
+
+def parse_diff_tree(output):
+    """
+    Parse ``git diff-tree -r -t -z --no-renames --name-status`` output
+
+    Arguments:
+        output (str): ``diff-tree`` output
+
+    Returns:
+        dict: ``{path: status}`` (``A``, ``D``, ``M`` or ``T``; changed
+        trees are included)
+    """
+    fields = output.split('\0')
+    return dict((path, status[:1])
+                for (status, path) in zip(fields[::2], fields[1::2]))
+
+
+class MtimesParser(object):
+    """
+    Incrementally parse ``git log -z --name-only --format=%x01%ct`` output
+    into the committer date of the last change to each blob of an index
+    """
+
+    def __init__(self, index):
+        """
+        Arguments:
+            index (dict): ``{path: (mode, type, hash, size)}``
+                (see :func:`parse_ls_tree`; the mtimes of a
+                :class:`pgs.index.CompactIndex` are stored in its mtime
+                column)
+        """
+        if isinstance(index, CompactIndex):
+            self.mtimes = index.mtimes
+        else:
+            self.mtimes = {}
+        self.remaining = set(
+            path for (path, entry) in index.items() if entry[1] == 'blob')
+        self.committer_date = None
+        self.buf = b''
 
-class SubprocessGitRepositoryFS(object):
+    @property
+    def done(self):
+        return not self.remaining
+
+    def feed(self, chunk):
+        """
+        Arguments:
+            chunk (bytes): next chunk of ``git log`` output
+        """
+        records = (self.buf + chunk).split(b'\0')
+        self.buf = records.pop()
+        for record in records:
+            record = _output_text(record).lstrip('\n')
+            if record.startswith('\x01'):
+                self.committer_date = int(record[1:])
+            elif record in self.remaining:
+                self.mtimes[record] = self.committer_date
+                self.remaining.discard(record)
+
+
+class SubprocessGitRepositoryFS(RepositoryFS):
 
     GIT_BIN = os.environ.get('GIT_BIN', distutils.spawn.find_executable('git'))
 
-    def __init__(self, conf):
-        self.conf = conf
+    def reset(self):
+        super(SubprocessGitRepositoryFS, self).reset()
+        self.limiter = ProcessLimiter.from_conf(self.conf)
+        self.blob_cache = DiskBlobCache.from_conf(self.conf)
+        self.index_cache = IndexCache.from_conf(self.conf)
+        self._snapshot = None
+        self._snapshot_checked = 0
+        self._index = None
+        self._mtimes = None
+
+    @property
+    def use_index(self):
+        return self.conf.get('pgs.git_index', True)
+
+    def metadata_ready(self):
+        return (self.use_index
+                and self._mtimes is not None
+                and self._snapshot is not None
+                and time.time() - self._snapshot_checked
+                < self.conf.get('pgs.git_rev_ttl', 1))
+
+    def is_resolved(self, url_path):
+        return (self.metadata_ready()
+                and super(SubprocessGitRepositoryFS, self).is_resolved(
+                    url_path))
+
+    def lookup_cached(self, url_path):
+        if not self.metadata_ready():
+            return None
+        path = self.resolutions.peek(url_path)
+        if path is None:
+            return None
+        resource = self._resources.peek(self.prefix_path(path))
+        if resource is not None and self.sampler is not None:
+            self.sampler.record(url_path)
+        return resource
 
     @property
     def repo_path(self):
@@ -175,22 +814,333 @@ class SubprocessGitRepositoryFS(object):
         return path
 
     def exists(self, path):
+        if self.use_index:
+            return self.get_tree_entry(path) is not None
         path = self.prefix_path(path)
         cmd = self.git_cmd() + ['cat-file', '-e', self.to_git_pathspec(path)]
-        retcode = subprocess.call(cmd, stderr=subp_stderr)
+        retcode = self.limiter.call(cmd, stderr=subp_stderr)
         return retcode == 0
 
     def getsize(self, path):
+        if self.use_index:
+            entry = self.get_tree_entry(path)
+            if entry is not None and entry[3] != '-':
+                return int(entry[3])
         path = self.prefix_path(path)
         cmd = self.git_cmd() + ['cat-file', '-s', self.to_git_pathspec(path)]
-        return long(subprocess.check_output(cmd))
-
-    def get_author_committer_dates(self, path):
+        return int(self.limiter.check_output(cmd))
+
+    def snapshot(self):
+        """
+        Resolve ``repo_rev`` to a commit hash
+
+        The resolved commit is rechecked at most every
+        ``pgs.git_rev_ttl`` seconds (default: 1); when it changes, the
+        cached state of the paths that changed between the two trees is
+        dropped (see :meth:`diff_snapshot` and :meth:`set_snapshot`).
+
+        Returns:
+            str: commit hash
+        """
+        now = time.time()
+        ttl = self.conf.get('pgs.git_rev_ttl', 1)
+        if self._snapshot is None or now - self._snapshot_checked >= ttl:
+            cmd = self.git_cmd() + ['rev-parse', '--verify',
+                                    '%s^{commit}' % self.repo_rev]
+            commit = _output_text(self.limiter.check_output(cmd)).strip()
+            changes = None
+            if self._snapshot is not None and commit != self._snapshot:
+                changes = self.diff_snapshot(self._snapshot, commit)
+            self.set_snapshot(commit, now, changes)
+        return self._snapshot
+
+    def diff_args(self, old, new):
+        return ['diff-tree', '-r', '-t', '-z', '--no-renames',
+                '--name-status', old, new]
+
+    def diff_snapshot(self, old, new):
+        """
+        Get the paths that changed between two commits (``git diff-tree``
+        compares tree hashes, so unchanged subtrees are not read)
+
+        Arguments:
+            old (str): commit hash
+            new (str): commit hash
+
+        Returns:
+            dict: ``{path: status}`` (see :func:`parse_diff_tree`; None if
+            the commits could not be compared)
+        """
+        try:
+            output = self.limiter.check_output(
+                self.git_cmd() + self.diff_args(old, new), stderr=subp_stderr)
+        except subprocess.CalledProcessError as e:
+            log.warning('cannot diff %s..%s: %s', old, new, e)
+            return None
+        return parse_diff_tree(_output_text(output))
+
+    def set_snapshot(self, commit, checked, changes=None):
+        """
+        Record the commit ``repo_rev`` resolved to, dropping cached state
+        if it changed
+
+        Arguments:
+            commit (str): commit hash
+            checked (float): when ``repo_rev`` was resolved
+
+        Keyword Arguments:
+            changes (dict): paths changed since the current snapshot
+                (see :meth:`diff_snapshot`): only their cached state is
+                dropped (see :meth:`RepositoryFS.invalidate`); all of it
+                is dropped if None
+        """
+        if commit != self._snapshot:
+            if changes is None:
+                self._resources.clear()
+                self.resolutions.clear()
+                self.responses.clear()
+                self.dirlists.clear()
+            else:
+                self.invalidate(changes)
+            self._index = None
+            self._mtimes = None
+            deployed = self._snapshot is not None
+            self._snapshot = commit
+            if deployed and self.sampler is not None:
+                # requests for changed paths will miss: warm them now
+                start_warmup(self, self.sampler.top(
+                    self.conf.get('pgs.warm_top', WARM_TOP)))
+        self._snapshot_checked = checked
+
+    def get_index(self):
+        """
+        Get the tree index of the current :meth:`snapshot`
+
+        The index is built with one ``git ls-tree -r -t -l`` call per
+        snapshot (if ``pgs.git_index`` is true (default)), so that
+        :meth:`exists`, :meth:`isdir`, :meth:`isfile` and
+        :meth:`get_resource` do not need to start a subprocess.
+        With ``pgs.index_cache_path``, the index and modification times
+        of a snapshot are saved to the :class:`pgs.index.IndexCache` and
+        then used in place, as a memory-mapped
+        :class:`pgs.index.MappedIndex` shared by all the workers.
+
+        Returns:
+            pgs.index.CompactIndex: ``{path: (mode, type, hash, size)}``
+            (the root tree is ``''``; a :class:`pgs.index.MappedIndex`
+            if it was loaded from the index cache)
+        """
+        commit = self.snapshot()
+        index = self._index
+        if index is None:
+            index = self.flights.do(('index', commit), self._read_index,
+                                    commit)
+        return index
+
+    def _read_index(self, commit):
+        if self._index is not None and self._snapshot == commit:
+            return self._index
+        index = self.load_index(commit)
+        if index is not None:
+            return index
+        cmd = self.git_cmd() + ['ls-tree', '-r', '-t', '-l', '-z',
+                                '--full-tree', commit]
+        output = _output_text(self.limiter.check_output(cmd))
+        index = parse_ls_tree(output, commit)
+        if self._snapshot == commit:
+            self._index = index
+        return index
+
+    def get_mtimes(self):
+        """
+        Get the modification times of every blob in the current
+        :meth:`snapshot`
+
+        Computed with one ``git log --name-only`` pass, which stops as
+        soon as every blob in the :meth:`get_index` has been seen.
+
+        Returns:
+            dict: ``{path: committer_date}``
+        """
+        index = self.get_index()
+        mtimes = self._mtimes
+        if mtimes is None:
+            mtimes = self.flights.do(('mtimes', index[''][2]),
+                                     self._read_mtimes, index)
+        return mtimes
+
+    def _read_mtimes(self, index):
+        commit = index[''][2]
+        if self._mtimes is not None and self._snapshot == commit:
+            return self._mtimes
+        parser = MtimesParser(index)
+        with self.limiter.popen(self.mtimes_cmd(index), timeout=None) as p:
+            while not parser.done:
+                chunk = p.read(64 * 1024)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+        if p.killed:
+            raise ProcessTimeout('git log timed out', self.limiter.retry_after)
+        index, mtimes = self.save_index(commit, index, parser.mtimes)
+        if self._snapshot == commit:
+            self._index, self._mtimes = index, mtimes
+        return mtimes
+
+    def save_index(self, commit, index, mtimes):
+        """
+        Save the index and modification times of a commit to the
+        :class:`pgs.index.IndexCache` (``pgs.index_cache_path``), and map
+        them back so that the dicts can be released
+
+        Arguments:
+            commit (str): commit hash
+            index (dict): ``{path: (mode, type, hash, size)}``
+            mtimes (dict): ``{path: committer_date}``
+
+        Returns:
+            tuple: ``(index, mtimes)`` (mapped from the index cache if they
+            could be saved)
+        """
+        if (self.index_cache is not None
+                and self.index_cache.save(commit, index, mtimes)):
+            loaded = self.index_cache.load(commit)
+            if loaded is not None:
+                return loaded
+        return index, mtimes
+
+    def load_index(self, commit):
+        """
+        Load the index and modification times of a commit from the
+        :class:`pgs.index.IndexCache` (``pgs.index_cache_path``)
+
+        Arguments:
+            commit (str): commit hash
+
+        Returns:
+            pgs.index.MappedIndex: ``{path: (mode, type, hash, size)}``
+            (or None if the commit is not in the index cache)
+        """
+        if self.index_cache is None:
+            return None
+        loaded = self.index_cache.load(commit)
+        if loaded is None:
+            return None
+        index, mtimes = loaded
+        if self._snapshot == commit:
+            self._index, self._mtimes = index, mtimes
+        return index
+
+    def mtimes_cmd(self, index):
+        return self.git_cmd() + ['log', '-z', '--name-only',
+                                 '--format=%x01%ct', index[''][2]]
+
+    def get_mtime(self, path):
+        """
+        Get the committer date of the last commit that changed a path
+
+        Arguments:
+            path (str): path within the repo
+
+        Returns:
+            int: seconds since the epoch
+        """
+        path = self.prefix_path(path).rstrip('/')
+        if self.use_index:
+            mtime = self.get_mtimes().get(path)
+            if mtime is not None:
+                return mtime
+        _, committer_date = self.get_author_committer_dates(
+            path, rev=self.snapshot())
+        return committer_date
+
+    def get_tree_entry(self, path, rev=None):
+        """
+        Get the ``git ls-tree -l`` entry for a path
+
+        Arguments:
+            path (str): path within the repo
+            rev (str): revision (default: the current :meth:`snapshot`
+                from the :meth:`get_index` or else ``repo_rev``)
+
+        Returns:
+            tuple: ``(mode, type, hash, size)`` (or None if not found)
+        """
+        path = self.prefix_path(path).rstrip('/')
+        if self.use_index and rev in (None, self._snapshot):
+            return self.get_index().get(path)
+        if not path:
+            return None
+        cmd = self.git_cmd() + ['ls-tree', '-l', '-z', '--full-tree',
+                                rev or self.repo_rev, '--', path]
+        output = _output_text(self.limiter.check_output(cmd))
+        for record in output.split('\0'):
+            if not record:
+                continue
+            fields, name = record.split('\t', 1)
+            if name == path:
+                mode, type_, hash, size = fields.split()
+                return mode, type_, hash, size
+        return None
+
+    def get_resource(self, path):
+        """
+        Get the :class:`Resource` header record for a blob
+
+        Records are cached for the current :meth:`snapshot`.
+
+        Arguments:
+            path (str): path to a file
+
+        Returns:
+            Resource: header record (or None if ``path`` is not a blob)
+        """
+        path = self.prefix_path(path)
+        commit = self.snapshot()
+        resource = self._resources.get(path, MISSING)
+        if resource is not MISSING:
+            return resource
+        resource = None
+        entry = self.get_tree_entry(path, rev=commit)
+        if entry is not None and entry[1] == 'blob':
+            resource = make_resource(
+                path, int(entry[3]), self.get_mtime(path),
+                etag='"%s"' % entry[2],
+                cache_policy=self.cache_policy)
+        self._resources.set(path, resource)
+        return resource
+
+    def open_resource(self, resource):
+        """
+        Open a blob from the disk blob cache (``pgs.blob_cache_path``),
+        or stream it from git (adding it to the disk blob cache)
+
+        Arguments:
+            resource (Resource): header record of a blob
+
+        Returns:
+            file-like: binary file object
+        """
+        sha = resource.etag.strip('"')
+        if self.blob_cache is None:
+            return self.get_blob_fileobj(sha)
+        fileobj = self.blob_cache.open(sha)
+        if fileobj is not None:
+            return fileobj
+        return self.blob_cache.tee(sha, resource.size,
+                                   self.get_blob_fileobj(sha))
+
+    def open_cached(self, resource):
+        if self.blob_cache is None:
+            return None
+        return self.blob_cache.open(resource.etag.strip('"'))
+
+    def get_author_committer_dates(self, path, rev=None):
         path = self.prefix_path(path)
         cmd = self.git_cmd() + ['log', '-1', "--format=%at %ct",
-                                self.repo_rev,
-                                '--', path]
-        output = subprocess.check_output(cmd)
+                                rev or self.repo_rev,
+                                '--', path or '.']
+        output = self.limiter.check_output(cmd)
         author_date, committer_date = output.rstrip().split()
         return int(author_date), int(committer_date)
 
@@ -198,16 +1148,19 @@ class SubprocessGitRepositoryFS(object):
         path = self.prefix_path(path)
         attrs = collections.OrderedDict()
         attrs["size"] = self.getsize(path)
-        _, committer_date = self.get_author_committer_dates(path)
+        committer_date = self.get_mtime(path)
         attrs["created_time"] = committer_date
         attrs["accessed_time"] = committer_date
         attrs["modified_time"] = committer_date
         return attrs
 
     def get_object_type(self, path):
+        if self.use_index:
+            entry = self.get_tree_entry(path)
+            return entry[1] if entry is not None else None
         path = self.prefix_path(path)
         cmd = self.git_cmd() + ['cat-file', '-t', self.to_git_pathspec(path)]
-        return subprocess.check_output(cmd).strip()
+        return self.limiter.check_output(cmd).strip()
 
     def isdir(self, path):
         return self.get_object_type(path) == 'tree'
@@ -220,7 +1173,7 @@ class SubprocessGitRepositoryFS(object):
         if kwargs:
             raise NotImplementedError()  # ~-> PyFilesystem interface
         cmd = self.git_cmd() + ['cat-file', '-p', self.to_git_pathspec(path)]
-        output = subprocess.check_output(cmd)
+        output = _output_text(self.limiter.check_output(cmd))
         files = []
         for _line in output.splitlines():
             line = _line.strip()
@@ -237,17 +1190,36 @@ class SubprocessGitRepositoryFS(object):
         for p in self.listdir(path, **kwargs):
             yield self.getinfo(pathjoin(path, p))
 
+    def get_blob_fileobj(self, sha):
+        """
+        Read a blob from ``git cat-file blob`` into a temporary file (see
+        :meth:`pgs.limits.ProcessLimiter.spool`)
+
+        Arguments:
+            sha (str): blob hash (or ``rev:path``)
+
+        Returns:
+            file: blob contents
+
+        Raises:
+            IOError: if ``git`` fails (e.g. the blob is missing)
+        """
+        cmd = self.git_cmd() + ['cat-file', 'blob', sha]
+        return self.limiter.spool(cmd)
+
     def get_fileobj(self, path):
         path = self.prefix_path(path)
-        cmd = self.git_cmd() + ['show', self.to_git_pathspec(path)]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        # p.communicate()
-        return p.stdout
+        return self.get_blob_fileobj(self.to_git_pathspec(path))
 
     def get_contents(self, path):
-        path = self.prefix_path(path)
-        cmd = self.git_cmd() + ['show', self.to_git_pathspec(path)]
-        return subprocess.check_output(cmd)
+        """
+        Read a whole (small) file into memory
+
+        Use :meth:`get_fileobj` to stream larger files.
+        """
+        path = self.to_git_pathspec(self.prefix_path(path))
+        return self.limiter.check_output(
+            self.git_cmd() + ['cat-file', 'blob', path])
 
     def getsyspath(self, path):
         return path
@@ -340,6 +1312,93 @@ def make_app(conf=None):
     return configure_app(app, conf)
 
 
+_FS_LOCK = threading.Lock()
+
+
+def get_FS(app):
+    """
+    Get the filesystem of a pgs app, creating it on first use
+    (see :func:`create_app`)
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app
+
+    Returns:
+        RepositoryFS: filesystem (or None if none is configured)
+    """
+    FS = app.config.get('pgs.FS')
+    if FS is None:
+        with _FS_LOCK:
+            FS = app.config.get('pgs.FS')
+            if FS is None:
+                FS = configure_FS(app, conf=app.config).config['pgs.FS']
+    return FS
+
+
+PGS_ENVIRON = [
+    ('PGS_ROOT_PATH', 'pgs.root_path'),
+    ('PGS_GIT_REPO_PATH', 'pgs.git_repo_path'),
+    ('PGS_GIT_REPO_REV', 'pgs.git_repo_rev'),
+]
+
+
+def conf_from_environ(environ=None):
+    """
+    Read pgs configuration from environment variables
+    (``PGS_ROOT_PATH``, ``PGS_GIT_REPO_PATH``, ``PGS_GIT_REPO_REV``)
+
+    Keyword Arguments:
+        environ (dict): environment (default: ``os.environ``)
+
+    Returns:
+        dict: configuration
+    """
+    if environ is None:
+        environ = os.environ
+    conf = {}
+    for name, key in PGS_ENVIRON:
+        if environ.get(name):
+            conf[key] = environ[name]
+    if 'pgs.git_repo_path' in conf:
+        conf.setdefault('pgs.git_repo_rev', GIT_REPO_REV_DEFAULT)
+    return conf
+
+
+APPS = weakref.WeakSet()
+
+
+def create_app(conf=None):
+    """
+    Create a pgs WSGI application (e.g. for gunicorn or uWSGI)::
+
+        gunicorn -w 4 -c python:pgs.gunicorn_conf \\
+            'pgs.app:create_app({"pgs.root_path": "/var/www/html"})'
+
+    Nothing is opened or started when the app is created: the filesystem
+    (git processes, caches) is created by each worker process on its
+    first request (see :func:`get_FS`), and :func:`on_post_fork` and
+    :func:`on_worker_exit` reset and release per-process state of every
+    app created in a process.
+
+    Keyword Arguments:
+        conf (dict): configuration
+            (default: :func:`conf_from_environ`)
+
+    Returns:
+        StaticFilesFastPath: WSGI application (its ``app`` is the bottle
+        app)
+    """
+    if conf is None:
+        conf = conf_from_environ()
+    app = add_routes(bottle.Bottle())
+    app.config.update(conf)
+    app.config.setdefault('pgs.show_dirlists', True)
+    app.config['pgs.FS'] = None
+    configure_mimetypes()
+    APPS.add(app)
+    return make_wsgi_app(app)
+
+
 # @app.hook('config')
 # def on_config_change(key, value):
 #    log.debug("config_change: %r = %r" % (key, value))
@@ -410,32 +1469,124 @@ def generate_dirlist_html(FS, filepath):
     yield '</table>'
 
 
-# bottle app
+def unavailable_response(exc):
+    """
+    Arguments:
+        exc (pgs.limits.Unavailable): error
 
-app = make_app(conf=None)
+    Returns:
+        HTTPError: ``503 Service Unavailable`` (or ``429 Too Many
+        Requests``) with ``Retry-After``
+    """
+    return HTTPError(exc.status, exc.status[4:], exception=exc,
+                     headers={'Retry-After': str(exc.retry_after)})
+
+
+def handle_unavailable(func):
+    """
+    Decorate a route to answer :exc:`pgs.limits.Unavailable` errors
+    (a saturated git backend, a rate limited client) with
+    ``503 Service Unavailable`` (or ``429 Too Many Requests``)
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Unavailable as e:
+            log.warning('%s: %s' % (e.status[:3], e))
+            return unavailable_response(e)
+    return wrapper
+
+
+def charge_request(kind):
+    """
+    Charge the client of the current request for an expensive operation
+    (see :class:`pgs.limits.RateLimiter`; a no-op without rate limiting)
+
+    Arguments:
+        kind (str): kind of operation (e.g. ``dirlist``)
+
+    Raises:
+        pgs.limits.RateLimited: if the client is over its rate limit
+    """
+    charge = request.environ.get('pgs.charge')
+    if charge is not None:
+        charge(kind)
 
 
-@app.route('<filepath:re:(.*?)@@$>')
+@handle_unavailable
 def explicitly_serve_dirlist(filepath):
     # trip leading / and trailing '@@'
     path = filepath[1:][:-2]
     return serve_dirlist(path)
 
 
+def dirlist_html(FS, path):
+    """
+    Generate directory listing HTML (concurrent requests for the same
+    directory of the same snapshot share one listing; listings of
+    a git snapshot are cached in ``FS.dirlists``)
+
+    Arguments:
+        FS (RepositoryFS): filesystem object to read files from
+        path (str): path to generate directory listings for
+
+    Returns:
+        list: lines of an HTML table (see :func:`generate_dirlist_html`)
+    """
+    snapshot = FS.snapshot()
+    if snapshot is not None:
+        lines = FS.dirlists.get(path)
+        if lines is not None:
+            return lines
+    return FS.flights.do(('dirlist', snapshot, path),
+                         _dirlist_html, FS, snapshot, path)
+
+
+def _dirlist_html(FS, snapshot, path):
+    lines = list(generate_dirlist_html(FS, path))
+    if snapshot is not None and FS.snapshot() == snapshot:
+        FS.dirlists.set(path, lines)
+    return lines
+
+
 def serve_dirlist(path):
-    FS = request.app.config['pgs.FS']
+    FS = get_FS(request.app)
     if FS.exists(path) and FS.isdir(path):
         if request.app.config.get('pgs.show_dirlists'):
-            return list(generate_dirlist_html(FS, path))
+            charge_request('dirlist')
+            return dirlist_html(FS, path)
     return HTTPError(404, 'Not found.')
 
 
-@app.route('<filepath:path>')
-def serve_static_files(filepath):
-    FS = request.app.config['pgs.FS']
+def resolve_path(FS, filepath):
+    """
+    Resolve a request path to a file (``try_files``: ``/a/b`` ->
+    ``a/b/index.html``, ``/a`` -> ``a.html``)
+
+    Resolved files are remembered in ``FS.resolutions``; concurrent misses
+    for the same path of the same snapshot share one resolution.
+
+    Arguments:
+        FS (RepositoryFS): filesystem to resolve in
+        filepath (str): request path
+
+    Returns:
+        tuple: ``(path, resource)`` where ``resource`` is the
+        :class:`Resource` of ``path`` (or None if ``path`` is a directory
+        without an ``index.html`` or does not exist)
+    """
     if filepath == '':
         filepath = '/'  # index.html'
     log.debug("filepath: %r" % filepath)
+    resource = FS.lookup(filepath)
+    if resource is not None:
+        return resource.path, resource
+    return FS.flights.do(('resolve', FS.snapshot(), filepath),
+                         _resolve_path, FS, filepath)
+
+
+def _resolve_path(FS, filepath):
     path = rewrite_path(FS, filepath)  # or ''  # XXX
     log.debug("rwpath  : %r" % path)
     if FS.exists(path) and FS.isdir(path):
@@ -443,30 +1594,39 @@ def serve_static_files(filepath):
         if FS.exists(index_html) and FS.isfile(index_html):
             path = index_html
         else:
-            if request.app.config.get('pgs.show_dirlists'):
-                return list(generate_dirlist_html(FS, path))
-                # TODO: mtime ?
-
-    if isinstance(FS, DirectoryRepositoryFS):
-        return bottle.static_file(path, root=app.config['pgs.root_path'])
-    elif isinstance(FS, SubprocessGitRepositoryFS):
-        # this is mostly derived from bottle.static_file
-        # without the RANGE support
-        return git_static_file(path)
-    else:
-        raise Exception(FS, type(FS))
+            return path, None
+
+    resource = FS.get_resource(path.strip('/\\'))
+    if resource is not None:
+        FS.resolutions.set(filepath, resource.path)
+    return path, resource
 
 
-def git_static_file(filename,
-                    mimetype='auto',
-                    download=False,
-                    charset='UTF-8'):
+@handle_unavailable
+def serve_static_files(filepath):
+    FS = get_FS(request.app)
+    path, resource = resolve_path(FS, filepath)
+    if resource is None and FS.exists(path) and FS.isdir(path):
+        if request.app.config.get('pgs.show_dirlists'):
+            charge_request('dirlist')
+            return dirlist_html(FS, path)
+            # TODO: mtime ?
+    return static_file(path)
+
+
+def static_file(filename,
+                mimetype='auto',
+                download=False,
+                charset='UTF-8'):
     """ This method is derived from bottle.static_file:
 
         Open [a file] and return :exc:`HTTPResponse` with status
-        code 200, 305, 403 or 404. The ``Content-Type``, ``Content-Encoding``,
-        ``Content-Length`` and ``Last-Modified`` headers are set if possible.
-        Special support for ``If-Modified-Since`` [...].
+        code 200, 206, 304, 403, 404 or 416. The ``Content-Type``,
+        ``Content-Encoding``, ``Content-Length``, ``Last-Modified`` and
+        ``ETag`` headers are set from the (cached) :class:`Resource` header
+        record of the current ``pgs.FS``.
+        Special support for ``If-None-Match``, ``If-Modified-Since``,
+        ``Range`` (from the filesystem) and ``HEAD`` requests.
 
         :param filename: Name or path of the file to send.
         :param mimetype: Defines the content-type header (default: guess from
@@ -478,68 +1638,358 @@ def git_static_file(filename,
         :param charset: The charset to use for files with a ``text/*``
             mime-type. (default: UTF-8)
     """
-
-    # root = os.path.abspath(root) + os.sep
-    # filename = os.path.abspath(pathjoin(root, filename.strip('/\\')))
     filename = filename.strip('/\\')
-    headers = dict()
 
-    FS = request.app.config['pgs.FS']
-    # if not filename.startswith(root):
-    #    return HTTPError(403, "Access denied.")
-    if not FS.exists(filename):
+    FS = get_FS(request.app)
+    resource = FS.get_resource(filename)
+    if resource is None:
         return HTTPError(404, "Not found.")
-    # if not os.access(filename, os.R_OK):
-    # return HTTPError(403, "You do not have permission to access this file.")
+    if mimetype != 'auto' or download or charset != 'UTF-8':
+        headers = dict(resource.headers)
+        resource = make_resource(
+            resource.path, resource.size, resource.mtime, resource.etag,
+            cache_control=headers.get('Cache-Control'),
+            accept_ranges='Accept-Ranges' in headers,
+            mimetype=mimetype, download=download, charset=charset)
+
+    if is_not_modified(request.environ, resource):
+        return HTTPResponse(status=304, headers=resource.headers,
+                            Date=http_date())
+
+    try:
+        response = None
+        if request.method == 'HEAD':
+            body = ''
+        elif 'HTTP_RANGE' not in request.environ:
+            send_early_hints(request.environ, FS, resource)
+            response = cached_response(FS, resource)
+        if response is not None:
+            body = response[2]
+        elif request.method != 'HEAD':
+            body = FS.open_resource(resource)
+            if 'HTTP_RANGE' not in request.environ:
+                scan_html(FS, resource, body)
+    except (IOError, OSError):
+        return HTTPError(403,
+                         "You do not have permission to access this file.")
+
+    if ('HTTP_RANGE' in request.environ
+            and isinstance(FS, DirectoryRepositoryFS)):
+        clen = resource.size
+        ranges = list(bottle.parse_range_header(
+            request.environ['HTTP_RANGE'], clen))
+        if not ranges:
+            return HTTPError(416, "Requested Range Not Satisfiable")
+        offset, end = ranges[0]
+        rsp = HTTPResponse(body, status=206, headers=resource.headers)
+        rsp['Content-Range'] = "bytes %d-%d/%d" % (offset, end - 1, clen)
+        rsp['Content-Length'] = str(end - offset)
+        if body:
+            rsp.body = bottle._file_iter_range(body, offset, end - offset)
+        return rsp
+    if response is not None:
+        return HTTPResponse(body, headers=response[1])
+    return HTTPResponse(body, headers=response_headers(FS, resource))
+
+
+git_static_file = static_file
+
+
+def add_routes(app):
+    """
+    Add the pgs routes to a bottle app
 
-    if mimetype == 'auto':
-        if download and download is not True:
-            mimetype, encoding = mimetypes.guess_type(download)
-        else:
-            mimetype, encoding = mimetypes.guess_type(filename)
-        if encoding:
-            headers['Content-Encoding'] = encoding
+    Arguments:
+        app (bottle.Bottle): bottle app
 
-    if mimetype:
-        if mimetype[:5] == 'text/' and charset and 'charset' not in mimetype:
-            mimetype += '; charset=%s' % charset
-        headers['Content-Type'] = mimetype
+    Returns:
+        bottle.Bottle: ``app``
+    """
+    app.route('<filepath:re:(.*?)@@$>', callback=explicitly_serve_dirlist)
+    app.route('<filepath:path>', callback=serve_static_files)
+    return app
 
-    if download:
-        download = os.path.basename(filename if download else download)
-        headers['Content-Disposition'] = 'attachment; filename="%s"' % download
 
-    # stats = os.stat(filename)
-    info = FS.getinfo(filename)
-    headers['Content-Length'] = clen = info['size']
-    lm = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
-                       time.gmtime(info['modified_time']))
-    headers['Last-Modified'] = lm
+# bottle app
 
-    ims = request.environ.get('HTTP_IF_MODIFIED_SINCE')
-    if ims:
-        ims = parse_date(ims.split(";")[0].strip())
-    mtime = info['modified_time']
-    if mtime and ims is not None and ims >= int(mtime):
-        headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
-                                        time.gmtime())
-        return HTTPResponse(status=304, **headers)
-
-    body = '' if request.method == 'HEAD' else FS.get_fileobj(filename)
-
-    clen
-    # headers["Accept-Ranges"] = "bytes"
-    # ranges = request.environ.get('HTTP_RANGE')
-    # if 'HTTP_RANGE' in request.environ:
-    #    ranges = list(parse_range_header(request.environ['HTTP_RANGE'], clen))
-    #     if not ranges:
-    #         return HTTPError(416, "Requested Range Not Satisfiable")
-    #    offset, end = ranges[0]
-    #    headers["Content-Range"] = "bytes %d-%d/%d" % (offset, end - 1, clen)
-    #    headers["Content-Length"] = str(end - offset)
-    #    if body: body = _file_iter_range(body, offset, end - offset)
-    #     return HTTPResponse(body, status=206, **headers)
-    return HTTPResponse(body, **headers)
+app = add_routes(make_app(conf=None))
+
+
+NOT_MODIFIED_EXCLUDED_HEADERS = bottle.BaseResponse.bad_headers[304]
+
+
+class StaticFilesFastPath(object):
+    """
+    A lean WSGI entry point in front of the pgs bottle app
+
+    ``GET`` and ``HEAD`` requests for previously resolved files are
+    answered directly from the environ and the cached :class:`Resource`
+    header records (``200`` from the small-file response cache or when
+    the body can be opened without a backend subprocess, and ``304``)
+    without bottle routing or request/response setup. Everything else
+    (dirlists, misses, ranges, errors) falls through to the wrapped bottle
+    app, once admitted by the :class:`pgs.limits.AdmissionController` (or
+    else ``503``), so that requests answerable from cache are never shed.
+    Request paths which are not resolved yet (see
+    :meth:`RepositoryFS.is_resolved`) are not even looked up before
+    admission, since that could run git.
+
+    With ``pgs.rate_limit``, each client is charged by its
+    :class:`pgs.limits.RateLimiter` as ``cached`` before any path is
+    looked up, and the difference to ``uncached`` when the request falls
+    through (the bottle routes add ``dirlist`` for dirlists).
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.admission = AdmissionController.from_conf(app.config)
+        self.rate_limiter = RateLimiter.from_conf(app.config)
+
+    def __call__(self, environ, start_response):
+        try:
+            self.charge(environ, 'cached')
+            response = None
+            if environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+                response = self.serve(environ, start_response)
+            if response is None:
+                self.charge(environ, 'uncached', paid='cached')
+                return self.admit(environ, start_response)
+            return response
+        except Unavailable as e:
+            log.warning('%s: %s' % (e.status[:3], e))
+            return self.unavailable(start_response, e)
+
+    def charge(self, environ, kind, paid=None):
+        """
+        Charge the client of a request (see :class:`pgs.limits.RateLimiter`)
+
+        Arguments:
+            environ (dict): WSGI environ
+            kind (str): kind of request
+
+        Keyword Arguments:
+            paid (str): kind the request was already charged as
+
+        Raises:
+            pgs.limits.RateLimited: if the client is over its rate limit
+        """
+        rate_limiter = self.rate_limiter
+        if rate_limiter is None:
+            return
+        client = rate_limiter.client(environ)
+        rate_limiter.charge(client, kind, paid=paid)
+        environ['pgs.charge'] = functools.partial(rate_limiter.charge, client)
+
+    def admit(self, environ, start_response):
+        """
+        Call the bottle app once admitted; the in-flight slot is given
+        back when the response is closed
+
+        Returns:
+            iterable: WSGI response body
+
+        Raises:
+            pgs.limits.Overloaded: if the request is shed
+        """
+        self.admission.admit()
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self.admission.release()
+            raise
+        return AdmittedResponse.wrap(result, self.admission.release,
+                                     environ.get('wsgi.file_wrapper'))
+
+    def unavailable(self, start_response, exc):
+        start_response(exc.status, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '0'),
+            ('Retry-After', str(exc.retry_after))])
+        return []
+
+    def serve(self, environ, start_response):
+        """
+        Arguments:
+            environ (dict): WSGI environ
+            start_response (callable): WSGI start_response
+
+        Returns:
+            iterable: WSGI response body (or None to fall through)
+        """
+        if 'HTTP_RANGE' in environ:
+            return None
+        FS = get_FS(self.app)
+        if FS is None:
+            return None
+        url_path = environ.get('PATH_INFO') or '/'
+        if bottle.py3k:
+            try:
+                url_path = url_path.encode('latin1').decode('utf8')
+            except UnicodeError:
+                return None
+        if url_path.endswith('@@') or not FS.is_resolved(url_path):
+            return None
+        resource = FS.lookup(url_path)
+        if resource is None:
+            return None
+
+        if is_not_modified(environ, resource):
+            headers = [h for h in resource.headers
+                       if h[0] not in NOT_MODIFIED_EXCLUDED_HEADERS]
+            headers.append(('Date', http_date()))
+            start_response('304 Not Modified', headers)
+            return []
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            start_response('200 OK', response_headers(FS, resource))
+            return []
+        try:
+            send_early_hints(environ, FS, resource)
+            response = cached_response(FS, resource, opener=FS.open_cached)
+            if response is not None:
+                status, headers, body = response
+                start_response(status, list(headers))
+                return [body]
+            body = FS.open_cached(resource)
+            if body is None:
+                return None
+            scan_html(FS, resource, body)
+        except (IOError, OSError):
+            return None
+        start_response('200 OK', response_headers(FS, resource))
+        file_wrapper = environ.get('wsgi.file_wrapper',
+                                   bottle.WSGIFileWrapper)
+        return file_wrapper(body, 1024 * 64)
+
+
+class AdmittedResponse(object):
+    """
+    A WSGI response body that calls ``release`` when it is closed
+    """
+
+    def __init__(self, result, release):
+        self.result = result
+        self.release = release
+        self._close = getattr(result, 'close', None)
+
+    @classmethod
+    def wrap(cls, result, release, file_wrapper=None):
+        """
+        Arguments:
+            result (iterable): WSGI response body
+            release (callable): function to call once ``result`` is closed
+            file_wrapper (type): the ``wsgi.file_wrapper`` of the server
+
+        Returns:
+            iterable: ``result`` itself if it is a ``file_wrapper`` (with
+            ``release`` chained to its ``close``, so that the server still
+            recognises it and can send the file with ``sendfile``), or else
+            an :class:`AdmittedResponse`
+        """
+        if isinstance(file_wrapper, type) and isinstance(result,
+                                                         file_wrapper):
+            try:
+                result.close = cls(result, release).close
+                return result
+            except AttributeError:
+                pass
+        return cls(result, release)
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        release, self.release = self.release, None
+        try:
+            if self._close is not None:
+                self._close()
+        finally:
+            if release is not None:
+                release()
+
+
+def make_wsgi_app(app):
+    """
+    Wrap a pgs bottle app with the :class:`StaticFilesFastPath`
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app (see :func:`make_app`)
+
+    Returns:
+        callable: WSGI application
+    """
+    return StaticFilesFastPath(app)
+
+
+def post_fork(app, worker_id=None):
+    """
+    Reinitialise the per-process state of a pgs app in a forked worker
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app
+        worker_id (int): worker number
+    """
+    FS = app.config.get('pgs.FS')
+    if FS is not None:
+        FS.post_fork()
+    log.debug('post_fork: worker %r (pid %d)' % (worker_id, os.getpid()))
+    warm_up(app)
+
+
+def warm_up(app):
+    """
+    Warm the caches of a pgs app in a background thread with the most
+    requested paths of the ``pgs.warm_from`` access log (at most
+    ``pgs.warm_top``; called in each worker process after it starts)
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app
+
+    Returns:
+        threading.Thread: warm-up thread (or None)
+    """
+    path = app.config.get('pgs.warm_from')
+    if not path:
+        return None
+    FS = get_FS(app)
+    if FS is None:
+        return None
+    return start_warmup(FS, read_access_log(
+        path, top=app.config.get('pgs.warm_top', WARM_TOP)))
+
+
+def worker_exit(app, worker_id=None):
+    """
+    Release the per-process resources of a pgs app in an exiting worker
+
+    Arguments:
+        app (bottle.Bottle): pgs bottle app
+        worker_id (int): worker number
+    """
+    FS = app.config.get('pgs.FS')
+    if FS is not None:
+        FS.close()
+    log.debug('worker_exit: worker %r (pid %d)' % (worker_id, os.getpid()))
+
+
+def on_post_fork(server=None, worker=None):
+    """
+    :func:`post_fork` every app created with :func:`create_app` in this
+    process (a gunicorn ``post_fork`` server hook; for uWSGI,
+    ``uwsgidecorators.postfork(on_post_fork)``)
+    """
+    for app in list(APPS):
+        post_fork(app, getattr(worker, 'age', None))
+
+
+def on_worker_exit(server=None, worker=None):
+    """
+    :func:`worker_exit` every app created with :func:`create_app` in this
+    process (a gunicorn ``worker_exit`` server hook; for uWSGI,
+    ``uwsgi.atexit = on_worker_exit``)
+    """
+    for app in list(APPS):
+        worker_exit(app, getattr(worker, 'age', None))
 
 
 def pgs(app, config_obj):
@@ -550,14 +2000,75 @@ def pgs(app, config_obj):
         app.config['pgs.git_repo_path'] = os.path.abspath(
             os.path.expanduser(config_obj.git_repo_path))
         app.config['pgs.git_repo_rev'] = config_obj.git_repo_rev
+    if config_obj.cache_control_rules:
+        app.config['pgs.cache_control_rules'] = config_obj.cache_control_rules
+    if getattr(config_obj, 'rate_limit', None):
+        app.config['pgs.rate_limit'] = config_obj.rate_limit
+        app.config['pgs.rate_limit_header'] = config_obj.rate_limit_header
+        app.config['pgs.rate_limit_proxies'] = config_obj.rate_limit_proxies
+    if getattr(config_obj, 'cache_size', None):
+        app.config['pgs.cache_size'] = int(config_obj.cache_size * 1024 * 1024)
+    if getattr(config_obj, 'blob_cache_path', None):
+        app.config['pgs.blob_cache_path'] = os.path.abspath(
+            os.path.expanduser(config_obj.blob_cache_path))
+    if getattr(config_obj, 'index_cache_path', None):
+        app.config['pgs.index_cache_path'] = os.path.abspath(
+            os.path.expanduser(config_obj.index_cache_path))
+    if getattr(config_obj, 'warm_from', None):
+        app.config['pgs.warm_from'] = os.path.abspath(
+            os.path.expanduser(config_obj.warm_from))
+    if getattr(config_obj, 'warm_auto', None):
+        app.config['pgs.warm_auto'] = True
+    if getattr(config_obj, 'warm_top', None):
+        app.config['pgs.warm_top'] = config_obj.warm_top
+    if getattr(config_obj, 'prefetch', None):
+        app.config['pgs.prefetch'] = True
+    if getattr(config_obj, 'preload', None):
+        app.config['pgs.preload'] = True
+    if getattr(config_obj, 'early_hints', None):
+        app.config['pgs.early_hints'] = True
 
     log.info("app.config: %s" % app.config)
     app = configure_app(app)
-    return bottle.run(app,
+    server_opts = {}
+    reloader = config_obj.reloader
+    server = getattr(config_obj, 'server', None) or 'wsgiref'
+    if server == 'threaded':
+        server_opts['server'] = ThreadPoolServer
+        server_opts['threads'] = config_obj.threads
+        server_opts['keepalive_timeout'] = config_obj.keepalive_timeout
+    elif server == 'asyncio':
+        from .aio import AsyncioServer
+        server_opts['server'] = AsyncioServer
+        server_opts['keepalive_timeout'] = config_obj.keepalive_timeout
+    workers = int(getattr(config_obj, 'workers', None) or 1)
+    if workers > 1:
+        make_server = make_wsgiref_server
+        if server == 'threaded':
+            make_server = functools.partial(
+                make_threadpool_server,
+                threads=server_opts.pop('threads'),
+                keepalive_timeout=server_opts.pop('keepalive_timeout'))
+        elif server == 'asyncio':
+            from .aio import make_asyncio_server
+            make_server = functools.partial(
+                make_asyncio_server,
+                keepalive_timeout=server_opts.pop('keepalive_timeout'))
+        server_opts['server'] = PreforkServer
+        server_opts['workers'] = workers
+        server_opts['post_fork'] = functools.partial(post_fork, app)
+        server_opts['worker_exit'] = functools.partial(worker_exit, app)
+        server_opts['make_server'] = make_server
+        reloader = False
+    elif not reloader or os.environ.get('BOTTLE_CHILD'):
+        # with the reloader, only the child process serves requests
+        warm_up(app)
+    return bottle.run(make_wsgi_app(app),
                       host=config_obj.host,
                       port=config_obj.port,
                       debug=config_obj.debug,
-                      reloader=config_obj.reloader)
+                      reloader=reloader,
+                      **server_opts)
 
 
 def main(argv=1j):
@@ -582,6 +2093,14 @@ def main(argv=1j):
                    help='Git repo revision (commit hash, branch, tag)',
                    default='gh-pages')
 
+    prs.add_option('-C', '--cache-control',
+                   dest='cache_control_rules',
+                   action='append',
+                   help=('Cache-Control rule: PATTERN=DIRECTIVES '
+                         '(e.g. "*.html=no-cache", '
+                         '"mime:image/*=max-age=86400"); '
+                         'may be specified more than once'))
+
     prs.add_option('-H', '--host',
                    dest='host',
                    default='localhost')
@@ -598,6 +2117,96 @@ def main(argv=1j):
                    default=True,
                    action='store_false',
                    help='set bottle reload=False')
+    prs.add_option('-w', '--workers',
+                   dest='workers',
+                   type='int',
+                   default=1,
+                   help=('Number of pre-forked worker processes '
+                         '(sharing the port with SO_REUSEPORT; '
+                         'disables the reloader)'))
+    prs.add_option('-s', '--server',
+                   dest='server',
+                   type='choice',
+                   choices=['wsgiref', 'threaded', 'asyncio'],
+                   default='wsgiref',
+                   help=('Server: wsgiref (one request at a time), '
+                         'threaded (thread pool, HTTP/1.1 keep-alive) or '
+                         'asyncio (Python >= 3.7)'))
+    prs.add_option('--threads',
+                   dest='threads',
+                   type='int',
+                   default=10,
+                   help='Number of threads for --server=threaded')
+    prs.add_option('--keepalive-timeout',
+                   dest='keepalive_timeout',
+                   type='float',
+                   default=5,
+                   help=('Seconds before an idle connection is closed '
+                         'for --server=threaded or asyncio'))
+
+    prs.add_option('--cache-size',
+                   dest='cache_size',
+                   type='float',
+                   help=('Memory for cached metadata, responses and '
+                         'dirlists, in MB per process (default: 64)'))
+    prs.add_option('--blob-cache',
+                   dest='blob_cache_path',
+                   help=('Directory for a disk cache of git blobs '
+                         '(shared by all workers; at most 1 GB)'))
+    prs.add_option('--index-cache',
+                   dest='index_cache_path',
+                   help=('Directory for saved git tree indexes and '
+                         'modification times (one file per commit)'))
+    prs.add_option('--warm-from',
+                   dest='warm_from',
+                   help=('Access log (Common or Combined Log Format) whose '
+                         'most requested paths are cached in the '
+                         'background when each process starts'))
+    prs.add_option('--warm-auto',
+                   dest='warm_auto',
+                   action='store_true',
+                   help=('Sample request paths and cache the most '
+                         'requested in the background when the git '
+                         'revision changes'))
+    prs.add_option('--warm-top',
+                   dest='warm_top',
+                   type='int',
+                   help=('Number of paths for --warm-from and --warm-auto '
+                         '(default: 1000)'))
+    prs.add_option('--prefetch',
+                   dest='prefetch',
+                   action='store_true',
+                   help=('Cache the same-origin scripts, stylesheets and '
+                         'images of served HTML pages in the background'))
+    prs.add_option('--preload',
+                   dest='preload',
+                   action='store_true',
+                   help=('Send Link: rel=preload headers for the '
+                         'stylesheets, scripts and fonts of HTML pages'))
+    prs.add_option('--early-hints',
+                   dest='early_hints',
+                   action='store_true',
+                   help=('Also send the Link headers of HTML pages in a '
+                         '103 Early Hints response (--server=threaded or '
+                         'asyncio)'))
+    prs.add_option('--rate-limit',
+                   dest='rate_limit',
+                   type='float',
+                   help=('Per-client rate limit (cost units per second; '
+                         'cache hits cost 1, other requests 4, '
+                         'dirlists 8 more)'))
+    prs.add_option('--rate-limit-header',
+                   dest='rate_limit_header',
+                   help=('Request header with the client address for '
+                         '--rate-limit (e.g. X-Forwarded-For; '
+                         'default: the remote address)'))
+    prs.add_option('--rate-limit-proxies',
+                   dest='rate_limit_proxies',
+                   type='int',
+                   default=1,
+                   help=('Number of trusted proxies appending to '
+                         '--rate-limit-header (the client is the address '
+                         'the outermost one appended; default: 1)'))
 
     prs.add_option('-v', '--verbose',
                    dest='verbose',
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.blobcache
+===============
+
+A content-addressed cache of git blobs on local disk.
+
+Blobs are stored by hash (``<path>/ab/cdef...``), so cached files stay
+valid across revisions and restarts, and every worker process on a host
+can share one cache directory. A blob is written to a temporary file
+while it is streamed from git and renamed into place once it is
+complete, so readers never see a partial blob. Cached blobs are ordinary
+files: they are sent with ``sendfile`` where the server supports it.
+
+The total size is bounded by a least-recently-used cleanup: hits touch
+the file's mtime, and when ``max_bytes`` is exceeded the oldest files are
+removed until the cache is below ``low_water`` of ``max_bytes``.
+"""
+import errno
+import logging
+import os
+import tempfile
+import threading
+import time
+
+BLOB_CACHE_SIZE = 1024 * 1024 * 1024
+TMP_PREFIX = '.tmp-'
+TMP_MAX_AGE = 3600
+TOUCH_INTERVAL = 60
+
+log = logging.getLogger('pgs.blobcache')
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class DiskBlobCache(object):
+    """
+    A size-bounded, content-addressed blob cache directory
+    """
+
+    def __init__(self, path, max_bytes=BLOB_CACHE_SIZE, low_water=0.9):
+        """
+        Arguments:
+            path (str): cache directory (created if necessary)
+
+        Keyword Arguments:
+            max_bytes (int): byte budget for the cache directory
+            low_water (float): fraction of ``max_bytes`` to clean up to
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.written = 0
+        self._cleaning = False
+        self._lock = threading.Lock()
+        makedirs(self.path)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a blob cache from pgs configuration:
+
+        * ``pgs.blob_cache_path`` -- cache directory (no cache if unset)
+        * ``pgs.blob_cache_size`` -- byte budget (default: 1 GB)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            DiskBlobCache: blob cache (or None)
+        """
+        path = conf.get('pgs.blob_cache_path')
+        if not path:
+            return None
+        return cls(os.path.expanduser(path),
+                   max_bytes=conf.get('pgs.blob_cache_size', BLOB_CACHE_SIZE))
+
+    def blob_path(self, sha):
+        """
+        Arguments:
+            sha (str): blob hash
+
+        Returns:
+            str: path of the cached blob
+        """
+        return os.path.join(self.path, sha[:2], sha[2:])
+
+    def open(self, sha):
+        """
+        Open a cached blob (and mark it as recently used)
+
+        Arguments:
+            sha (str): blob hash
+
+        Returns:
+            file: binary file object (or None on a miss)
+        """
+        path = self.blob_path(sha)
+        try:
+            fileobj = open(path, 'rb')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            mtime = os.fstat(fileobj.fileno()).st_mtime
+            if time.time() - mtime > TOUCH_INTERVAL:
+                os.utime(path, None)
+        except OSError:
+            pass
+        return fileobj
+
+    def writer(self, sha, size):
+        """
+        Arguments:
+            sha (str): blob hash
+            size (int): blob size
+
+        Returns:
+            BlobWriter: a writer which adds the blob to the cache when it
+            is closed after ``size`` bytes
+        """
+        return BlobWriter(self, sha, size)
+
+    def put(self, sha, data):
+        """
+        Add a blob to the cache
+
+        Arguments:
+            sha (str): blob hash
+            data (bytes): blob contents
+
+        Returns:
+            bool: whether the blob was stored
+        """
+        writer = self.writer(sha, len(data))
+        writer.write(data)
+        return writer.close()
+
+    def tee(self, sha, size, fileobj):
+        """
+        Arguments:
+            sha (str): blob hash
+            size (int): blob size
+            fileobj (file-like): blob contents (e.g. from ``git cat-file``)
+
+        Returns:
+            TeeFile: ``fileobj``, copying what is read into the cache
+        """
+        return TeeFile(fileobj, self.writer(sha, size))
+
+    def _stored(self, size):
+        with self._lock:
+            self.stored += 1
+            self.written += size
+            if (self._cleaning or
+                    self.written < self.max_bytes * (1 - self.low_water)):
+                return
+            self.written = 0
+            self._cleaning = True
+        thread = threading.Thread(target=self._cleanup,
+                                  name='pgs-blobcache-cleanup')
+        thread.daemon = True
+        thread.start()
+
+    def _cleanup(self):
+        try:
+            self.cleanup()
+        except Exception:
+            log.exception('blob cache cleanup failed: %r', self.path)
+        finally:
+            self._cleaning = False
+
+    def cleanup(self, now=None):
+        """
+        Remove least-recently-used blobs until the cache is below
+        ``low_water * max_bytes`` (if it exceeds ``max_bytes``), and
+        abandoned temporary files
+
+        Keyword Arguments:
+            now (float): current time (default: ``time.time()``)
+
+        Returns:
+            int: bytes freed
+        """
+        now = time.time() if now is None else now
+        entries, total, freed = [], 0, 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith(TMP_PREFIX):
+                    if now - stats.st_mtime > TMP_MAX_AGE:
+                        freed += self._remove(path, stats.st_size)
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, path))
+                total += stats.st_size
+        if total <= self.max_bytes:
+            return freed
+        entries.sort()
+        target = self.low_water * self.max_bytes
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            total -= size
+            freed += self._remove(path, size)
+        return freed
+
+    @staticmethod
+    def _remove(path, size):
+        try:
+            os.unlink(path)
+        except OSError:
+            return 0
+        return size
+
+
+class BlobWriter(object):
+    """
+    Write a blob to a temporary file in the cache directory, and rename it
+    into place when it is complete
+    """
+
+    def __init__(self, cache, sha, size):
+        self.cache = cache
+        self.sha = sha
+        self.size = size
+        self.written = 0
+        try:
+            fd, self.tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX,
+                                                 dir=cache.path)
+            self.fileobj = os.fdopen(fd, 'wb')
+        except (IOError, OSError) as e:
+            log.warning('blob cache: cannot write %s: %s', sha, e)
+            self.fileobj = None
+
+    def write(self, data):
+        """
+        Arguments:
+            data (bytes): next chunk of the blob
+        """
+        if self.fileobj is None or not data:
+            return
+        try:
+            self.fileobj.write(data)
+            self.written += len(data)
+        except (IOError, OSError) as e:
+            log.warning('blob cache: cannot write %s: %s', self.sha, e)
+            self.abort()
+
+    def abort(self):
+        """
+        Discard the temporary file
+        """
+        fileobj, self.fileobj = self.fileobj, None
+        if fileobj is None:
+            return
+        try:
+            fileobj.close()
+        except (IOError, OSError):
+            pass
+        self.cache._remove(self.tmp_path, 0)
+
+    def close(self):
+        """
+        Add the blob to the cache if all ``size`` bytes were written
+        (otherwise discard it)
+
+        Returns:
+            bool: whether the blob was stored
+        """
+        if self.fileobj is None:
+            return False
+        if self.written != self.size:
+            self.abort()
+            return False
+        fileobj, self.fileobj = self.fileobj, None
+        path = self.cache.blob_path(self.sha)
+        try:
+            fileobj.close()
+            os.chmod(self.tmp_path, 0o644)
+            makedirs(os.path.dirname(path))
+            os.rename(self.tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning('blob cache: cannot store %s: %s', self.sha, e)
+            self.cache._remove(self.tmp_path, 0)
+            return False
+        self.cache._stored(self.size)
+        return True
+
+
+class TeeFile(object):
+    """
+    A binary file-like object which copies what is read from ``fileobj``
+    to a :class:`BlobWriter` (the blob is stored when it has been read
+    completely and closed)
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj, writer):
+        self.fileobj = fileobj
+        self.writer = writer
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.writer.write(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        try:
+            self.fileobj.close()
+        finally:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.cache
+===============
+
+In-memory caches for pgs, a shared byte budget for them, and
+single-flight call coalescing.
+"""
+import collections
+import sys
+import threading
+import time
+
+CACHE_SIZE = 64 * 1024 * 1024
+DECAY_INTERVAL = 10
+
+# an OrderedDict entry (hash table slot and linked list node) and the
+# (value, size) tuple
+ENTRY_OVERHEAD = 160
+
+SKETCH_WIDTH = 16384
+SKETCH_SEEDS = (0x97cb3127, 0x8a3b5c4d, 0xc3a5c85c, 0x2545f491)
+WINDOW_RATIO = 0.01
+
+
+def sizeof(obj):
+    """
+    Estimate the memory used by a value
+
+    Containers (tuples, lists, dicts, sets) are measured with their
+    items; shared and interned objects are counted every time.
+
+    Arguments:
+        obj (object): value
+
+    Returns:
+        int: size in bytes
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key) + sizeof(value)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        for value in obj:
+            size += sizeof(value)
+    return size
+
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache with a byte budget
+
+    Each value is stored with its (caller-reported) size in bytes plus
+    ``overhead`` bytes for the entry itself; least-recently-used values
+    are evicted when the sum of sizes exceeds ``max_bytes``, or when a
+    :class:`CacheBudget` it is registered with needs the memory.
+    """
+
+    def __init__(self, max_bytes=None, overhead=0):
+        """
+        Keyword Arguments:
+            max_bytes (int): byte budget (None: limited only by the
+                :class:`CacheBudget`)
+            overhead (int): bytes to add to the size of each value
+                (e.g. :data:`ENTRY_OVERHEAD`)
+        """
+        self.max_bytes = max_bytes
+        self.overhead = overhead
+        self.budget = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Get a value and mark it as most recently used
+
+        Arguments:
+            key (hashable): cache key
+            default (object): value to return on a miss
+
+        Returns:
+            object: cached value (or ``default``)
+        """
+        with self._lock:
+            try:
+                item = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key, default=None):
+        """
+        Get a value without marking it as used (or counting a hit or miss)
+
+        Arguments:
+            key (hashable): cache key
+            default (object): value to return if ``key`` is not cached
+
+        Returns:
+            object: cached value (or ``default``)
+        """
+        item = self._data.get(key)
+        if item is None:
+            return default
+        return item[0]
+
+    def set(self, key, value, size=None):
+        """
+        Store a value, evicting least-recently-used values as necessary
+
+        Arguments:
+            key (hashable): cache key
+            value (object): value to store
+            size (int): size of ``value`` in bytes
+                (default: :func:`sizeof` of ``key`` and ``value``)
+
+        Returns:
+            bool: False if ``size`` exceeds the whole budget
+        """
+        if size is None:
+            size = sizeof(key) + sizeof(value)
+        size += self.overhead
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        if self.budget is not None and size > self.budget.max_bytes:
+            return False
+        with self._lock:
+            self._store(key, value, size)
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                self._evict()
+        if self.budget is not None:
+            self.budget.rebalance()
+        return True
+
+    def _store(self, key, value, size):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+        self._data[key] = (value, size)
+        self.nbytes += size
+
+    def _evict(self):
+        _, (_, size) = self._data.popitem(last=False)
+        self.nbytes -= size
+        self.evictions += 1
+        return size
+
+    def evict(self):
+        """
+        Remove the least-recently-used value
+
+        Returns:
+            int: bytes freed (0 if the cache is empty)
+        """
+        with self._lock:
+            if not len(self):
+                return 0
+            return self._evict()
+
+    def pop(self, key, default=None):
+        """
+        Remove a value
+
+        Arguments:
+            key (hashable): cache key
+            default (object): value to return if ``key`` is not cached
+
+        Returns:
+            object: the removed value (or ``default``)
+        """
+        with self._lock:
+            item = self._remove(key)
+            if item is None:
+                return default
+            return item[0]
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+        return item
+
+    def _keys(self):
+        return list(self._data)
+
+    def pop_matching(self, predicate):
+        """
+        Remove the values that match a predicate
+
+        Arguments:
+            predicate (callable): ``predicate(key, value)`` is true for
+                values to remove (called with the cache locked)
+
+        Returns:
+            int: number of values removed
+        """
+        with self._lock:
+            keys = [key for key in self._keys()
+                    if predicate(key, self.peek(key))]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        """
+        Remove all values
+        """
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+class FrequencySketch(object):
+    """
+    A count-min sketch of recent access frequencies (TinyLFU)
+
+    Each key increments one 4-bit counter in each of ``depth`` rows; its
+    estimated frequency is the smallest of them. After ``sample_size``
+    increments all counters are halved, so that the sketch forgets old
+    popularity.
+    """
+
+    max_count = 15
+
+    def __init__(self, width=SKETCH_WIDTH, depth=4, sample_size=None):
+        """
+        Keyword Arguments:
+            width (int): counters per row (rounded up to a power of two)
+            depth (int): number of rows (at most ``len(SKETCH_SEEDS)``)
+            sample_size (int): increments between halvings
+                (default: ``10 * width``)
+        """
+        size = 1
+        while size < width:
+            size *= 2
+        self.mask = size - 1
+        self.seeds = SKETCH_SEEDS[:depth]
+        self.rows = [bytearray(size) for _ in self.seeds]
+        self.sample_size = sample_size or 10 * size
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key) & 0xffffffffffffffff
+        for seed in self.seeds:
+            h2 = ((h ^ seed) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+            yield (h2 >> 32) & self.mask
+
+    def increment(self, key):
+        """
+        Record an access
+
+        Arguments:
+            key (hashable): cache key
+        """
+        added = False
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < self.max_count:
+                row[i] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.reset()
+
+    def estimate(self, key):
+        """
+        Arguments:
+            key (hashable): cache key
+
+        Returns:
+            int: estimated number of recent accesses
+        """
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def reset(self):
+        """
+        Halve all counters
+        """
+        self.rows = [bytearray(c >> 1 for c in row) for row in self.rows]
+        self.additions //= 2
+
+
+class TinyLFUCache(LRUCache):
+    """
+    A :class:`LRUCache` with W-TinyLFU admission
+
+    New values enter a small LRU *window* (``window_ratio`` of the cache);
+    when memory is needed, the least-recently-used value of the window
+    (the candidate) only replaces the least-recently-used value of the
+    main LRU (the victim) if a :class:`FrequencySketch` of all gets has
+    seen it more often; otherwise the candidate is dropped. A crawl
+    through many files that are each requested once passes through the
+    window without pushing frequently requested values out of the main
+    cache.
+    """
+
+    def __init__(self, max_bytes=None, overhead=0,
+                 window_ratio=WINDOW_RATIO, sketch=None):
+        """
+        Keyword Arguments:
+            max_bytes (int): byte budget (None: limited only by the
+                :class:`CacheBudget`)
+            overhead (int): bytes to add to the size of each value
+            window_ratio (float): fraction of the cache for new values
+            sketch (FrequencySketch): access frequencies
+                (default: a new :class:`FrequencySketch`)
+        """
+        super(TinyLFUCache, self).__init__(max_bytes, overhead=overhead)
+        self.window_ratio = window_ratio
+        self.sketch = sketch or FrequencySketch()
+        self.rejections = 0
+        self.window_bytes = 0
+        self._window = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._window) + len(self._data)
+
+    def __contains__(self, key):
+        return key in self._window or key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            self.sketch.increment(key)
+            for data in (self._window, self._data):
+                item = data.pop(key, None)
+                if item is not None:
+                    data[key] = item
+                    self.hits += 1
+                    return item[0]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        item = self._window.get(key) or self._data.get(key)
+        if item is None:
+            return default
+        return item[0]
+
+    def _remove(self, key):
+        item = self._window.pop(key, None)
+        if item is not None:
+            self.window_bytes -= item[1]
+        else:
+            item = self._data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+        return item
+
+    def _keys(self):
+        return list(self._window) + list(self._data)
+
+    def _capacity(self):
+        if self.max_bytes is not None:
+            return self.max_bytes
+        if self.budget is not None:
+            return self.budget.max_bytes
+        return self.nbytes
+
+    def _full(self):
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            return True
+        return (self.budget is not None
+                and self.budget.nbytes > self.budget.max_bytes)
+
+    def _store(self, key, value, size):
+        self._remove(key)
+        self._window[key] = (value, size)
+        self.window_bytes += size
+        self.nbytes += size
+        # while there is room, values leaving the window enter the main
+        # cache; otherwise they have to win against a victim (_evict)
+        window_size = self.window_ratio * self._capacity()
+        while (len(self._window) > 1 and self.window_bytes > window_size
+               and not self._full()):
+            key, item = self._window.popitem(last=False)
+            self.window_bytes -= item[1]
+            self._data[key] = item
+
+    def _evict(self):
+        window_size = self.window_ratio * self._capacity()
+        if self._window and (not self._data or
+                             self.window_bytes > window_size):
+            key, item = self._window.popitem(last=False)
+            self.window_bytes -= item[1]
+            if self._data:
+                victim = next(iter(self._data))
+                if (self.sketch.estimate(key)
+                        > self.sketch.estimate(victim)):
+                    # admit the candidate; evict the victim
+                    self._data[key] = item
+                    _, (_, size) = self._data.popitem(last=False)
+                    self.nbytes -= size
+                    self.evictions += 1
+                    return size
+                self.rejections += 1
+            self.nbytes -= item[1]
+            self.evictions += 1
+            return item[1]
+        return super(TinyLFUCache, self)._evict()
+
+    def clear(self):
+        with self._lock:
+            self._window.clear()
+            self._data.clear()
+            self.window_bytes = 0
+            self.nbytes = 0
+
+
+class _Share(object):
+
+    def __init__(self, name, cache, weight, share):
+        self.name = name
+        self.cache = cache
+        self.weight = weight
+        self.share = share
+        self.score = 0.0
+        self.last_hits = cache.hits
+
+    def density(self):
+        """
+        Returns:
+            float: (decayed) hits per byte, weighted by the cost of a miss
+        """
+        hits = self.score + (self.cache.hits - self.last_hits)
+        return self.weight * hits / max(self.cache.nbytes, 1)
+
+
+class CacheBudget(object):
+    """
+    One byte budget shared by several :class:`LRUCache` instances
+
+    Each registered cache may use memory that the others do not; when
+    their total exceeds ``max_bytes``, the cache whose memory is worth
+    least -- recent hits per byte, weighted by what a miss costs -- loses
+    its least-recently-used value, until the total fits again. A cache
+    is never shrunk below its guaranteed ``share`` of the budget.
+    Recent hits are halved every ``decay_interval`` seconds, so that a
+    cache that used to be hot does not keep its memory forever.
+    """
+
+    def __init__(self, max_bytes=CACHE_SIZE, decay_interval=DECAY_INTERVAL):
+        """
+        Keyword Arguments:
+            max_bytes (int): byte budget for all registered caches
+            decay_interval (float): seconds between halvings of recent
+                hit counts
+        """
+        self.max_bytes = max_bytes
+        self.decay_interval = decay_interval
+        self.evictions = 0
+        self.shares = collections.OrderedDict()
+        self._decayed = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a budget from pgs configuration
+        (``pgs.cache_size``, default: 64 MB)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            CacheBudget: cache budget
+        """
+        return cls(conf.get('pgs.cache_size', CACHE_SIZE))
+
+    def register(self, name, cache, weight=1, share=0):
+        """
+        Add a cache to the budget
+
+        Arguments:
+            name (str): cache name (for :meth:`stats`)
+            cache (LRUCache): cache
+
+        Keyword Arguments:
+            weight (float): relative cost of a miss
+            share (float): fraction of ``max_bytes`` the cache keeps
+                under pressure
+
+        Returns:
+            LRUCache: ``cache``
+        """
+        cache.budget = self
+        self.shares[name] = _Share(name, cache, weight, share)
+        return cache
+
+    @property
+    def nbytes(self):
+        return sum(share.cache.nbytes for share in self.shares.values())
+
+    def decay(self, now=None):
+        """
+        Halve the recent hit counts of all caches if ``decay_interval``
+        seconds have passed
+
+        Keyword Arguments:
+            now (float): current time (default: ``time.time()``)
+        """
+        now = time.time() if now is None else now
+        if now - self._decayed < self.decay_interval:
+            return
+        self._decayed = now
+        for share in self.shares.values():
+            hits = share.cache.hits
+            share.score = (share.score + hits - share.last_hits) / 2.0
+            share.last_hits = hits
+
+    def rebalance(self):
+        """
+        Evict values from the caches worth least until all caches fit
+        in ``max_bytes``
+
+        Returns:
+            int: bytes freed
+        """
+        freed = 0
+        with self._lock:
+            self.decay()
+            excess = self.nbytes - self.max_bytes
+            while excess > 0:
+                shares = [
+                    share for share in self.shares.values()
+                    if len(share.cache)
+                    and share.cache.nbytes > share.share * self.max_bytes]
+                if not shares:
+                    break
+                victim = min(shares, key=_Share.density)
+                size = victim.cache.evict()
+                self.evictions += 1
+                freed += size
+                excess -= size
+        return freed
+
+    def stats(self):
+        """
+        Returns:
+            dict: ``{name: {'bytes':, 'entries':, 'hits':, 'misses':,
+            'evictions':}}``
+        """
+        return dict(
+            (name, {'bytes': share.cache.nbytes,
+                    'entries': len(share.cache),
+                    'hits': share.cache.hits,
+                    'misses': share.cache.misses,
+                    'evictions': share.cache.evictions})
+            for (name, share) in self.shares.items())
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key
+
+    The first caller for a key runs the function; callers arriving while
+    it runs wait for it and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)`` unless a call for ``key`` is
+        already in flight, in which case wait for its result
+
+        Arguments:
+            key (hashable): call key
+            func (callable): function to call
+
+        Returns:
+            object: the result of the (shared) call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.gunicorn_conf
+===============
+
+gunicorn server hooks for pgs apps created with
+:func:`pgs.app.create_app`::
+
+    gunicorn -w 4 -c python:pgs.gunicorn_conf \\
+        'pgs.app:create_app({"pgs.git_repo_path": "/srv/repo"})'
+
+(or import ``post_fork`` and ``worker_exit`` from here in your own
+gunicorn configuration file)
+"""
+from .app import on_post_fork as post_fork
+from .app import on_worker_exit as worker_exit
+
+__all__ = ['post_fork', 'worker_exit']
@@ -0,0 +1,720 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.index
+===============
+
+Compact, persistent and shared tree indexes for pgs.
+
+A :class:`CompactIndex` holds the tree index of a commit in memory as a
+trie of interned path segments: the UTF-8 bytes of each segment are
+stored once, length-prefixed, in a ``bytearray``, each node is a parent
+id and a segment id (found by parent and segment through an
+open-addressing hash table), and the mode and type (one byte), object
+id, size and mtime of each node are ``array`` columns, so a path costs
+about 65 bytes (20 of them the object id) instead of a dict entry,
+strings and a tuple.
+
+The tree index (``git ls-tree``) and the modification times (``git log``)
+of a commit are saved to ``<pgs.index_cache_path>/<commit>.idx`` once they
+have been computed, so that a (re)started worker serving an unchanged
+revision maps them from disk instead of running git.
+
+Index files are used in place: a :class:`MappedIndex` is a read-only
+mapping over the memory-mapped file, which finds paths by bisecting the
+sorted records, so no per-process dicts are built and all the worker
+processes on a host share the same pages.
+
+File format (little-endian):
+
+* header: magic ``PGSI``, version (u16), number of records (u32)
+* fixed-width records, sorted by path: path offset and length
+  (u32, u32), mode (u32), type (u8), object id (20 bytes),
+  size (i64; -1 for trees) and mtime (i64; -1 if unknown)
+* the UTF-8 encoded paths
+"""
+import array
+import binascii
+import bisect
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from .blobcache import makedirs
+
+MAGIC = b'PGSI'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxI')
+RECORD = struct.Struct('<IIIB20sqq')
+PATH_REF = struct.Struct('<II')
+MTIME = struct.Struct('<q')
+MTIME_OFFSET = RECORD.size - MTIME.size
+TYPES = ('blob', 'tree', 'commit')
+SHA_SIZE = 20
+U32_NONE = 0xffffffff
+U32_WIDE = 0xfffffffe
+try:
+    array.array('q')
+    INT64 = 'q'
+except ValueError:  # Python 2
+    INT64 = 'l'
+INDEX_CACHE_KEEP = 8
+
+log = logging.getLogger('pgs.index')
+
+
+def _to_bytes(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode('utf-8')
+
+
+def _from_bytes(data):
+    if bytes is str:
+        return data
+    return data.decode('utf-8')
+
+
+def dump_index(fileobj, index, mtimes):
+    """
+    Write a tree index and modification times
+
+    Arguments:
+        fileobj (file): binary file object to write to
+        index (dict): ``{path: (mode, type, hash, size)}``
+            (see :func:`pgs.app.parse_ls_tree`)
+        mtimes (dict): ``{path: committer_date}``
+
+    Raises:
+        ValueError: if an entry cannot be stored (e.g. SHA-256 object ids)
+    """
+    entries = sorted((_to_bytes(path), path, entry)
+                     for (path, entry) in index.items())
+    records, offset = [HEADER.pack(MAGIC, VERSION, len(entries))], 0
+    for bpath, path, (mode, type_, sha, size) in entries:
+        mtime = mtimes.get(path)
+        try:
+            records.append(RECORD.pack(
+                offset, len(bpath), int(mode, 8), TYPES.index(type_),
+                binascii.unhexlify(sha),
+                -1 if size == '-' else int(size),
+                -1 if mtime is None else mtime))
+        except (TypeError, binascii.Error, struct.error) as e:
+            raise ValueError('cannot store %r: %s' % (path, e))
+        offset += len(bpath)
+    fileobj.write(b''.join(records))
+    fileobj.write(b''.join(entry[0] for entry in entries))
+
+
+class _PathTable(object):
+    # the sorted paths of a MappedIndex, as a sequence for bisect
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        return self.index._path(i)
+
+
+class MappedIndex(object):
+    """
+    A read-only ``{path: (mode, type, hash, size)}`` mapping over the
+    contents of an index file (see :func:`dump_index`)
+
+    Entries are decoded when they are looked up; ``mtimes`` is the
+    matching ``{path: committer_date}`` mapping.
+    """
+
+    def __init__(self, buf):
+        """
+        Arguments:
+            buf (buffer): contents of an index file (e.g. an ``mmap``)
+
+        Raises:
+            ValueError: if ``buf`` is not an index file
+        """
+        try:
+            magic, version, count = HEADER.unpack_from(buf, 0)
+        except struct.error as e:
+            raise ValueError('not an index file: %s' % e)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not an index file: %r %r' % (magic, version))
+        self.buf = buf
+        self.count = count
+        self.base = HEADER.size + count * RECORD.size
+        if len(buf) < self.base:
+            raise ValueError('truncated index file')
+        self.paths = _PathTable(self)
+        self.mtimes = IndexMtimes(self)
+
+    def _path(self, i):
+        offset, length = PATH_REF.unpack_from(
+            self.buf, HEADER.size + i * RECORD.size)
+        offset += self.base
+        return self.buf[offset:offset + length]
+
+    def _key(self, i):
+        return _from_bytes(self._path(i))
+
+    def _find(self, path):
+        bpath = _to_bytes(path)
+        i = bisect.bisect_left(self.paths, bpath)
+        if i < self.count and self.paths[i] == bpath:
+            return i
+        return -1
+
+    def _entry(self, i):
+        (_, _, mode, type_, sha, size,
+         _) = RECORD.unpack_from(self.buf, HEADER.size + i * RECORD.size)
+        return ('%06o' % mode, TYPES[type_],
+                _from_bytes(binascii.hexlify(sha)),
+                '-' if size < 0 else str(size))
+
+    def _mtime(self, i):
+        mtime, = MTIME.unpack_from(
+            self.buf, HEADER.size + i * RECORD.size + MTIME_OFFSET)
+        return mtime
+
+    def _set_mtime(self, i, mtime):
+        raise TypeError('a MappedIndex is read-only')
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, path):
+        return self._find(path) >= 0
+
+    def __getitem__(self, path):
+        i = self._find(path)
+        if i < 0:
+            raise KeyError(path)
+        return self._entry(i)
+
+    def get(self, path, default=None):
+        i = self._find(path)
+        if i < 0:
+            return default
+        return self._entry(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._key(i)
+
+    def items(self):
+        for i in range(self.count):
+            yield self._key(i), self._entry(i)
+
+
+class IndexMtimes(object):
+    """
+    The ``{path: committer_date}`` mapping of a :class:`MappedIndex` or
+    :class:`CompactIndex` (stored in its mtime column)
+    """
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __getitem__(self, path):
+        mtime = self.get(path)
+        if mtime is None:
+            raise KeyError(path)
+        return mtime
+
+    def get(self, path, default=None):
+        i = self.index._find(path)
+        if i < 0:
+            return default
+        mtime = self.index._mtime(i)
+        return default if mtime < 0 else mtime
+
+    def __setitem__(self, path, mtime):
+        i = self.index._find(path)
+        if i < 0:
+            raise KeyError(path)
+        self.index._set_mtime(i, mtime)
+
+    def items(self):
+        index = self.index
+        for i in range(index.count):
+            mtime = index._mtime(i)
+            if mtime >= 0:
+                yield index._key(i), mtime
+
+
+class IndexEntry(object):
+    """
+    A ``(mode, type, hash, size)`` tuple view of an entry of a
+    :class:`CompactIndex` (the fields are decoded when they are read)
+    """
+
+    __slots__ = ('index', 'node')
+
+    _fields = ('mode', 'type', 'hash', 'size')
+
+    def __init__(self, index, node):
+        self.index = index
+        self.node = node
+
+    @property
+    def mode(self):
+        return self.index.kind_values[self.index.kinds[self.node]][0]
+
+    @property
+    def type(self):
+        return self.index.kind_values[self.index.kinds[self.node]][1]
+
+    @property
+    def hash(self):
+        index, offset = self.index, self.node * self.index.sha_size
+        sha = index.shas[offset:offset + index.sha_size]
+        return _from_bytes(binascii.hexlify(bytes(sha)))
+
+    @property
+    def size(self):
+        size = self.index._get_u32(self.index.sizes, self.index.wide_sizes,
+                                   self.node)
+        return '-' if size is None else str(size)
+
+    def __len__(self):
+        return 4
+
+    def __iter__(self):
+        return iter((self.mode, self.type, self.hash, self.size))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self)[i]
+        return getattr(self, self._fields[i])
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, IndexEntry)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class CompactIndex(object):
+    """
+    A ``{path: (mode, type, hash, size)}`` mapping stored as a trie of
+    interned path segments with ``array`` columns (see :mod:`pgs.index`)
+
+    Entries are :class:`IndexEntry` views; ``mtimes`` is the matching
+    ``{path: committer_date}`` mapping. The root tree ``''`` is node 0.
+
+    Segments are stored once each, length-prefixed, in ``segments`` (a
+    segment id is its offset). Each node is a parent id, a segment id, a
+    ``(mode, type)`` id (u8), an object id, and a size and mtime (u32;
+    larger values are kept in the ``wide_sizes`` and ``wide_mtimes``
+    dicts).
+    """
+
+    __slots__ = ('segments', 'segment_count', 'segment_table', 'parents',
+                 'name_refs', 'kinds', 'kind_values', 'kind_ids', 'shas',
+                 'sha_size', 'sizes', 'wide_sizes', 'mtime_column',
+                 'wide_mtimes', 'table', 'mtimes')
+
+    def __init__(self, sha_size=SHA_SIZE):
+        """
+        Keyword Arguments:
+            sha_size (int): size of the object ids in bytes
+                (20 for SHA-1, 32 for SHA-256)
+        """
+        self.segments = bytearray()
+        self.segment_count = 0
+        self.segment_table = array.array('i', [-1]) * 16
+        self.parents = array.array('i')
+        self.name_refs = array.array('i')
+        self.kinds = array.array('B')
+        self.kind_values = [('040000', 'tree')]
+        self.kind_ids = {('040000', 'tree'): 0}
+        self.shas = bytearray()
+        self.sha_size = sha_size
+        self.sizes = array.array('I')
+        self.wide_sizes = {}
+        self.mtime_column = array.array('I')
+        self.wide_mtimes = {}
+        self.table = array.array('i', [-1]) * 16
+        self.mtimes = IndexMtimes(self)
+        self._append(-1, self._intern(b''))
+
+    @property
+    def count(self):
+        return len(self.parents)
+
+    def _span(self, name_id):
+        # the start and end offsets of the bytes of an interned segment
+        segments, length, shift = self.segments, 0, 0
+        while True:
+            byte = segments[name_id]
+            name_id += 1
+            length |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return name_id, name_id + length
+            shift += 7
+
+    def _name_id(self, segment):
+        # the id of an interned segment (bytes), or -1
+        table, segments, size = self.segment_table, self.segments, len(segment)
+        mask = len(table) - 1
+        i = hash(segment) & mask
+        while True:
+            name_id = table[i]
+            if name_id < 0:
+                return -1
+            start, end = self._span(name_id)
+            if end - start == size and segments[start:end] == segment:
+                return name_id
+            i = (i + 1) & mask
+
+    def _intern(self, segment):
+        if self.segment_table is None:
+            size = 16
+            while self.segment_count * 3 > size * 2:
+                size *= 2
+            self._resize_segments(size)
+        name_id = self._name_id(segment)
+        if name_id >= 0:
+            return name_id
+        name_id, length = len(self.segments), len(segment)
+        while length >= 0x80:
+            self.segments.append(length & 0x7f | 0x80)
+            length >>= 7
+        self.segments.append(length)
+        self.segments.extend(segment)
+        self.segment_count += 1
+        if self.segment_count * 3 > len(self.segment_table) * 2:
+            self._resize_segments(len(self.segment_table) * 2)
+        else:
+            self._insert_segment(name_id)
+        return name_id
+
+    def _segment(self, name_id):
+        start, end = self._span(name_id)
+        return bytes(self.segments[start:end])
+
+    def _insert_segment(self, name_id):
+        table = self.segment_table
+        mask = len(table) - 1
+        i = hash(self._segment(name_id)) & mask
+        while table[i] >= 0:
+            i = (i + 1) & mask
+        table[i] = name_id
+
+    def _resize_segments(self, size):
+        self.segment_table = array.array('i', [-1]) * size
+        name_id = 0
+        while name_id < len(self.segments):
+            self._insert_segment(name_id)
+            name_id = self._span(name_id)[1]
+
+    def _kind(self, mode, type_):
+        kind = (mode, type_)
+        kind_id = self.kind_ids.get(kind)
+        if kind_id is None:
+            kind_id = len(self.kind_values)
+            if kind_id > 0xff:
+                raise ValueError('too many modes')
+            self.kind_values.append(kind)
+            self.kind_ids[kind] = kind_id
+        return kind_id
+
+    def _get_u32(self, column, wide, node):
+        value = column[node]
+        if value == U32_NONE:
+            return None
+        if value == U32_WIDE:
+            return wide[node]
+        return value
+
+    def _set_u32(self, column, wide, node, value):
+        if column[node] == U32_WIDE:
+            del wide[node]
+        if value is None:
+            column[node] = U32_NONE
+        elif 0 <= value < U32_WIDE:
+            column[node] = value
+        else:
+            column[node] = U32_WIDE
+            wide[node] = value
+
+    def _append(self, parent, name_id):
+        node = len(self.parents)
+        self.parents.append(parent)
+        self.name_refs.append(name_id)
+        self.kinds.append(0)
+        self.shas.extend(b'\0' * self.sha_size)
+        self.sizes.append(U32_NONE)
+        self.mtime_column.append(U32_NONE)
+        if parent >= 0:
+            if node * 3 > len(self.table) * 2:
+                self._resize(len(self.table) * 2)
+            self._insert(node)
+        return node
+
+    def _insert(self, node):
+        table = self.table
+        mask = len(table) - 1
+        i = hash((self.parents[node],
+                  self._segment(self.name_refs[node]))) & mask
+        while table[i] >= 0:
+            i = (i + 1) & mask
+        table[i] = node
+
+    def _resize(self, size):
+        self.table = array.array('i', [-1]) * size
+        for node in range(1, len(self.parents)):
+            self._insert(node)
+
+    def _child(self, parent, segment):
+        table, parents, name_refs = self.table, self.parents, self.name_refs
+        segments, size = self.segments, len(segment)
+        mask = len(table) - 1
+        i = hash((parent, segment)) & mask
+        while True:
+            node = table[i]
+            if node < 0:
+                return -1
+            if parents[node] == parent:
+                start, end = self._span(name_refs[node])
+                if end - start == size and segments[start:end] == segment:
+                    return node
+            i = (i + 1) & mask
+
+    def _find(self, path):
+        if not path:
+            return 0
+        node = 0
+        for segment in _to_bytes(path).split(b'/'):
+            node = self._child(node, segment)
+            if node < 0:
+                return -1
+        return node
+
+    def _key(self, node):
+        segments = []
+        while node > 0:
+            segments.append(self._segment(self.name_refs[node]))
+            node = self.parents[node]
+        return _from_bytes(b'/'.join(reversed(segments)))
+
+    def _entry(self, node):
+        return IndexEntry(self, node)
+
+    def _mtime(self, node):
+        mtime = self._get_u32(self.mtime_column, self.wide_mtimes, node)
+        return -1 if mtime is None else mtime
+
+    def _set_mtime(self, node, mtime):
+        self._set_u32(self.mtime_column, self.wide_mtimes, node,
+                      None if mtime is None or mtime < 0 else mtime)
+
+    def add(self, path, entry):
+        """
+        Add (or replace) the entry of a path (and any missing parent
+        trees)
+
+        Arguments:
+            path (str): path within the repo (``''`` for the root tree)
+            entry (tuple): ``(mode, type, hash, size)``
+
+        Raises:
+            ValueError: if ``entry`` cannot be stored
+        """
+        mode, type_, sha, size = entry
+        try:
+            sha = binascii.unhexlify(sha)
+            mode = '%06o' % int(mode, 8)
+            size = None if size == '-' else int(size)
+        except (TypeError, binascii.Error) as e:
+            raise ValueError('cannot store %r: %s' % (path, e))
+        if type_ not in TYPES:
+            raise ValueError('cannot store %r: bad type' % (path,))
+        if len(sha) != self.sha_size:
+            raise ValueError('cannot store %r: bad object id' % (path,))
+        kind = self._kind(mode, type_)
+        node = 0
+        if path:
+            for segment in _to_bytes(path).split(b'/'):
+                child = self._child(node, segment)
+                node = (child if child >= 0 else
+                        self._append(node, self._intern(segment)))
+        self.kinds[node] = kind
+        self._set_u32(self.sizes, self.wide_sizes, node, size)
+        offset = node * self.sha_size
+        self.shas[offset:offset + self.sha_size] = sha
+
+    def compact(self):
+        """
+        Drop the hash table which interns new segments (lookups do not
+        need it; it is rebuilt if more paths are added)
+        """
+        self.segment_table = None
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __contains__(self, path):
+        return self._find(path) >= 0
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node < 0:
+            raise KeyError(path)
+        return self._entry(node)
+
+    def get(self, path, default=None):
+        node = self._find(path)
+        if node < 0:
+            return default
+        return self._entry(node)
+
+    def __iter__(self):
+        for node in range(len(self.parents)):
+            yield self._key(node)
+
+    def items(self):
+        for node in range(len(self.parents)):
+            yield self._key(node), self._entry(node)
+
+
+class IndexCache(object):
+    """
+    A directory of index files, one per commit
+    """
+
+    def __init__(self, path, keep=INDEX_CACHE_KEEP):
+        """
+        Arguments:
+            path (str): cache directory (created if necessary)
+
+        Keyword Arguments:
+            keep (int): number of index files to keep
+                (the most recently saved)
+        """
+        self.path = os.path.abspath(path)
+        self.keep = keep
+        makedirs(self.path)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create an index cache from pgs configuration
+        (``pgs.index_cache_path``; no cache if unset)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            IndexCache: index cache (or None)
+        """
+        path = conf.get('pgs.index_cache_path')
+        if not path:
+            return None
+        return cls(os.path.expanduser(path))
+
+    def index_path(self, commit):
+        """
+        Arguments:
+            commit (str): commit hash
+
+        Returns:
+            str: path of the index file of ``commit``
+        """
+        return os.path.join(self.path, '%s.idx' % commit)
+
+    def load(self, commit):
+        """
+        Arguments:
+            commit (str): commit hash
+
+        Returns:
+            tuple: ``(index, mtimes)``: a :class:`MappedIndex` and its
+            ``mtimes`` (or None if there is no valid index file for
+            ``commit``)
+        """
+        try:
+            fileobj = open(self.index_path(commit), 'rb')
+        except (IOError, OSError):
+            return None
+        with fileobj:
+            try:
+                buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError) as e:
+                log.warning('cannot map index of %s: %s', commit, e)
+                return None
+        try:
+            index = MappedIndex(buf)
+        except ValueError as e:
+            buf.close()
+            log.warning('cannot load index of %s: %s', commit, e)
+            return None
+        return index, index.mtimes
+
+    def save(self, commit, index, mtimes):
+        """
+        Write the index file of a commit (atomically), and remove the
+        oldest index files beyond ``keep``
+
+        Arguments:
+            commit (str): commit hash
+            index (dict): ``{path: (mode, type, hash, size)}``
+            mtimes (dict): ``{path: committer_date}``
+
+        Returns:
+            bool: whether the index was saved
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+            with os.fdopen(fd, 'wb') as fileobj:
+                dump_index(fileobj, index, mtimes)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.index_path(commit))
+        except (ValueError, EnvironmentError) as e:
+            log.warning('cannot save index of %s: %s', commit, e)
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            return False
+        self.cleanup()
+        return True
+
+    def cleanup(self):
+        """
+        Remove the oldest index files beyond ``keep``
+        """
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.idx'):
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        entries.sort(reverse=True)
+        for _, path in entries[self.keep:]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
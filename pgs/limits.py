@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.limits
+===============
+
+Bounded concurrency for git subprocesses.
+
+Every git subprocess started by a
+:class:`pgs.app.SubprocessGitRepositoryFS` takes a slot from its
+:class:`ProcessLimiter`:
+
+* at most ``pgs.git_max_processes`` (default: 8) run at once
+* a caller waits at most ``pgs.git_queue_timeout`` seconds (default: 5)
+  for a slot before :exc:`QueueTimeout` is raised
+* a command is killed after ``pgs.git_timeout`` seconds (default: 30)
+  and :exc:`ProcessTimeout` is raised
+* blobs are spooled to temporary files (:meth:`ProcessLimiter.spool`),
+  so that slow clients never hold a slot while they download
+
+Requests that cannot be answered from cache are admitted by an
+:class:`AdmissionController` (see :class:`pgs.app.StaticFilesFastPath`):
+
+* at most ``pgs.max_inflight`` (default: 64) are handled at once; others
+  wait in a queue of at most ``pgs.max_queue`` (default: 256) requests
+  for at most ``pgs.admission_max_wait`` seconds (default: 1)
+* as in CoDel, when the queueing delay has stayed above
+  ``pgs.admission_target`` seconds (default: 0.05) for a whole
+  ``pgs.admission_interval`` (default: 0.1), requests are shed at an
+  increasing rate until the delay drops below the target again
+
+Shed requests raise :exc:`Overloaded`.
+
+All of these are :exc:`Unavailable` errors, which pgs answers with
+``503 Service Unavailable`` and ``Retry-After: <pgs.retry_after>``
+(default: 1).
+
+If ``pgs.rate_limit`` is set, each client (``REMOTE_ADDR``, or the address
+appended by the outermost of ``pgs.rate_limit_proxies`` trusted proxies to
+the ``pgs.rate_limit_header`` header) has a :class:`RateLimiter` token
+bucket refilled at ``pgs.rate_limit`` tokens per second, holding at most
+``pgs.rate_limit_burst`` tokens (default: 10 seconds' worth, and at least
+the cost of the most expensive request).
+Requests are charged by cost (``pgs.rate_limit_costs``; see
+:data:`RATE_LIMIT_COSTS`); a client without enough tokens gets
+``429 Too Many Requests`` (:exc:`RateLimited`) with ``Retry-After``.
+"""
+import collections
+import contextlib
+import logging
+import math
+import subprocess
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('pgs.limits')
+
+MAX_PROCESSES = 8
+QUEUE_TIMEOUT = 5
+PROCESS_TIMEOUT = 30
+RETRY_AFTER = 1
+
+MAX_INFLIGHT = 64
+MAX_QUEUE = 256
+ADMISSION_MAX_WAIT = 1
+ADMISSION_TARGET = 0.05
+ADMISSION_INTERVAL = 0.1
+
+RATE_LIMIT_CLIENTS = 10000
+RATE_LIMIT_PROXIES = 1
+RATE_LIMIT_COSTS = {
+    'cached': 1,  # answered from cache (fast path)
+    'uncached': 4,  # resolved or read from the backend
+    'dirlist': 8,  # generating a dirlist (in addition to 'uncached')
+}
+
+
+class Unavailable(Exception):
+    """
+    The backend is saturated; retry after ``retry_after`` seconds
+    """
+
+    status = '503 Service Unavailable'
+
+    def __init__(self, message, retry_after=RETRY_AFTER):
+        super(Unavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Unavailable):
+    """
+    No subprocess slot became free within the queue timeout
+    """
+
+
+class ProcessTimeout(Unavailable):
+    """
+    A subprocess was killed after the per-call timeout
+    """
+
+
+class Overloaded(Unavailable):
+    """
+    A request was shed by the :class:`AdmissionController`
+    """
+
+
+class RateLimited(Unavailable):
+    """
+    A client has used up its :class:`RateLimiter` tokens
+    """
+
+    status = '429 Too Many Requests'
+
+
+class ProcessLimiter(object):
+    """
+    A counting semaphore with a queue timeout for subprocesses
+    """
+
+    def __init__(self,
+                 max_processes=MAX_PROCESSES,
+                 queue_timeout=QUEUE_TIMEOUT,
+                 timeout=PROCESS_TIMEOUT,
+                 retry_after=RETRY_AFTER):
+        """
+        Keyword Arguments:
+            max_processes (int): maximum number of concurrent subprocesses
+            queue_timeout (float): seconds to wait for a slot
+            timeout (float): default seconds before a command is killed
+                (None: no timeout)
+            retry_after (int): ``Retry-After`` seconds for 503 responses
+        """
+        self.max_processes = max_processes
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a limiter from pgs configuration
+        (``pgs.git_max_processes``, ``pgs.git_queue_timeout``,
+        ``pgs.git_timeout``, ``pgs.retry_after``)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            ProcessLimiter: limiter
+        """
+        return cls(
+            max_processes=conf.get('pgs.git_max_processes', MAX_PROCESSES),
+            queue_timeout=conf.get('pgs.git_queue_timeout', QUEUE_TIMEOUT),
+            timeout=conf.get('pgs.git_timeout', PROCESS_TIMEOUT),
+            retry_after=conf.get('pgs.retry_after', RETRY_AFTER))
+
+    def acquire(self):
+        """
+        Take a slot, waiting at most ``queue_timeout`` seconds
+
+        Raises:
+            QueueTimeout: if no slot became free in time
+        """
+        with self._cond:
+            if self.active >= self.max_processes:
+                deadline = time.time() + self.queue_timeout
+                self.waiting += 1
+                try:
+                    while self.active >= self.max_processes:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise QueueTimeout(
+                                'all %d git processes busy'
+                                % self.max_processes, self.retry_after)
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+
+    def release(self):
+        """
+        Give a slot back
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _kill_timer(self, proc, timeout, killed=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not timeout:
+            return None
+        timer = threading.Timer(timeout, _kill, (proc, killed))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def run(self, cmd, stderr=None, timeout=None):
+        """
+        Run a command in a slot
+
+        Arguments:
+            cmd (list): command
+
+        Keyword Arguments:
+            stderr (int): ``subprocess`` stderr
+            timeout (float): seconds before the command is killed
+                (default: ``self.timeout``)
+
+        Returns:
+            tuple: ``(returncode, output)``
+
+        Raises:
+            QueueTimeout: if no slot became free in time
+            ProcessTimeout: if the command was killed
+        """
+        with self.slot():
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+            killed = []
+            timer = self._kill_timer(proc, timeout, killed)
+            try:
+                output, _ = proc.communicate()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        if killed:
+            raise ProcessTimeout('git process timed out: %r' % (cmd,),
+                                 self.retry_after)
+        return proc.returncode, output
+
+    def call(self, cmd, stderr=None, timeout=None):
+        """
+        Like ``subprocess.call`` (see :meth:`run`)
+
+        Returns:
+            int: return code
+        """
+        return self.run(cmd, stderr=stderr, timeout=timeout)[0]
+
+    def check_output(self, cmd, stderr=None, timeout=None):
+        """
+        Like ``subprocess.check_output`` (see :meth:`run`)
+
+        Returns:
+            bytes: standard output
+
+        Raises:
+            subprocess.CalledProcessError: if the command fails
+        """
+        returncode, output = self.run(cmd, stderr=stderr, timeout=timeout)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, output)
+        return output
+
+    def spool(self, cmd, stderr=None, timeout=None):
+        """
+        Run a command in a slot with its standard output written to an
+        anonymous temporary file, so that the slot is given back as soon
+        as the command exits
+
+        Arguments:
+            cmd (list): command
+
+        Keyword Arguments:
+            stderr (int): ``subprocess`` stderr
+            timeout (float): seconds before the command is killed
+                (default: ``self.timeout``)
+
+        Returns:
+            file: its standard output (at offset 0)
+
+        Raises:
+            QueueTimeout: if no slot became free in time
+            ProcessTimeout: if the command was killed
+            IOError: if the command fails
+        """
+        fileobj = tempfile.TemporaryFile(prefix='pgs-spool-')
+        try:
+            with self.slot():
+                proc = subprocess.Popen(cmd, stdout=fileobj, stderr=stderr)
+                killed = []
+                timer = self._kill_timer(proc, timeout, killed)
+                try:
+                    proc.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+            if killed:
+                raise ProcessTimeout('git process timed out: %r' % (cmd,),
+                                     self.retry_after)
+            if proc.returncode:
+                raise IOError('%r exited with %d' % (cmd, proc.returncode))
+            fileobj.seek(0)
+            return fileobj
+        except BaseException:
+            fileobj.close()
+            raise
+
+    def popen(self, cmd, stderr=None, timeout=False):
+        """
+        Start a command in a slot, which is given back when the returned
+        :class:`LimitedProcess` is closed
+
+        Arguments:
+            cmd (list): command
+
+        Keyword Arguments:
+            stderr (int): ``subprocess`` stderr
+            timeout (float): seconds before the command is killed
+                (default: False: no timeout; None: ``self.timeout``)
+
+        Returns:
+            LimitedProcess: the running command
+        """
+        self.acquire()
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        except Exception:
+            self.release()
+            raise
+        timer, killed = None, []
+        if timeout is not False:
+            timer = self._kill_timer(proc, timeout, killed)
+        return LimitedProcess(proc, self, timer, killed)
+
+
+def _kill(proc, killed=None):
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            return
+        if killed is not None:
+            killed.append(proc)
+
+
+class LimitedProcess(object):
+    """
+    A subprocess holding a :class:`ProcessLimiter` slot, usable as a
+    streaming WSGI response body
+
+    Read its standard output with :meth:`read` or iterate over it in
+    chunks of at most ``chunk_size`` bytes.
+    At the end of the output the process is reaped (and a failure
+    logged); :meth:`close` (e.g. the WSGI ``close()`` when a client
+    disconnects) kills it if it is still running.
+    Either way the slot is given back exactly once.
+    ``killed`` is true if the per-call timeout killed it.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, proc, limiter, timer=None, killed=None):
+        self.proc = proc
+        self.stdout = proc.stdout
+        self.limiter = limiter
+        self.timer = timer
+        self.closed = False
+        self._killed = killed if killed is not None else []
+
+    @property
+    def killed(self):
+        return bool(self._killed)
+
+    def read(self, size=-1):
+        if self.closed:
+            return b''
+        data = self.stdout.read(size)
+        if size < 0 or not data:
+            self._finish(eof=True)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self._finish(eof=False)
+
+    def _finish(self, eof):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not eof:
+                _kill(self.proc)
+            self.stdout.close()
+            self.proc.wait()
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.limiter.release()
+        if eof and self.proc.returncode:
+            log.warning('process %d exited with %d'
+                        % (self.proc.pid, self.proc.returncode))
+
+    def __del__(self):
+        # last resort: never leave a zombie or a held slot behind
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AdmissionController(object):
+    """
+    Admission control with CoDel-style load shedding
+
+    :meth:`admit` takes an in-flight slot (waiting in a bounded queue)
+    and :meth:`release` gives it back.
+    The queueing delay (sojourn time) of each admitted request is
+    compared with ``target``: once it has stayed above ``target`` for
+    ``interval`` seconds, the controller starts dropping, shedding one
+    request every ``interval / sqrt(count)`` seconds, and stops as soon as
+    a request is admitted with a delay below ``target``.
+    """
+
+    def __init__(self,
+                 max_inflight=MAX_INFLIGHT,
+                 max_queue=MAX_QUEUE,
+                 max_wait=ADMISSION_MAX_WAIT,
+                 target=ADMISSION_TARGET,
+                 interval=ADMISSION_INTERVAL,
+                 retry_after=RETRY_AFTER):
+        """
+        Keyword Arguments:
+            max_inflight (int): maximum number of requests handled at once
+            max_queue (int): maximum number of waiting requests
+            max_wait (float): seconds a request may wait for a slot
+            target (float): acceptable queueing delay in seconds
+            interval (float): seconds the delay may stay above ``target``
+                before requests are shed
+            retry_after (int): ``Retry-After`` seconds for 503 responses
+        """
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.target = target
+        self.interval = interval
+        self.retry_after = retry_after
+        self.inflight = 0
+        self.waiting = 0
+        self.shed = 0
+        self.dropping = False
+        self._first_above = None
+        self._drop_next = 0
+        self._drop_count = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a controller from pgs configuration
+        (``pgs.max_inflight``, ``pgs.max_queue``,
+        ``pgs.admission_max_wait``, ``pgs.admission_target``,
+        ``pgs.admission_interval``, ``pgs.retry_after``)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            AdmissionController: controller
+        """
+        return cls(
+            max_inflight=conf.get('pgs.max_inflight', MAX_INFLIGHT),
+            max_queue=conf.get('pgs.max_queue', MAX_QUEUE),
+            max_wait=conf.get('pgs.admission_max_wait', ADMISSION_MAX_WAIT),
+            target=conf.get('pgs.admission_target', ADMISSION_TARGET),
+            interval=conf.get('pgs.admission_interval', ADMISSION_INTERVAL),
+            retry_after=conf.get('pgs.retry_after', RETRY_AFTER))
+
+    def _shed(self, reason):
+        self.shed += 1
+        return Overloaded('request shed: %s' % reason, self.retry_after)
+
+    def _should_drop(self, sojourn, now):
+        if sojourn < self.target:
+            self._first_above = None
+            self.dropping = False
+            return False
+        if self._first_above is None:
+            self._first_above = now + self.interval
+            return False
+        if not self.dropping:
+            if now < self._first_above:
+                return False
+            self.dropping = True
+            self._drop_count = 1
+            self._drop_next = now + self.interval
+            return True
+        if now >= self._drop_next:
+            self._drop_count += 1
+            self._drop_next = now + (
+                self.interval / math.sqrt(self._drop_count))
+            return True
+        return False
+
+    def admit(self):
+        """
+        Take an in-flight slot
+
+        Raises:
+            Overloaded: if the request is shed
+        """
+        arrival = time.time()
+        with self._cond:
+            if self.inflight >= self.max_inflight:
+                if self.waiting >= self.max_queue:
+                    raise self._shed('queue full')
+                deadline = arrival + self.max_wait
+                self.waiting += 1
+                try:
+                    while self.inflight >= self.max_inflight:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise self._shed('queue timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            now = time.time()
+            if self._should_drop(now - arrival, now):
+                self._cond.notify()
+                raise self._shed('queueing delay above target')
+            self.inflight += 1
+
+    def release(self):
+        """
+        Give an in-flight slot back
+        """
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+
+
+class RateLimiter(object):
+    """
+    Per-client token buckets in a bounded least-recently-used table
+
+    Clients evicted from the table (the least recently seen of more than
+    ``max_clients``) start again with a full bucket.
+    """
+
+    def __init__(self, rate, burst=None,
+                 max_clients=RATE_LIMIT_CLIENTS,
+                 header=None,
+                 proxies=RATE_LIMIT_PROXIES,
+                 costs=None):
+        """
+        Arguments:
+            rate (float): tokens added to each bucket per second
+
+        Keyword Arguments:
+            burst (float): bucket size (default: ``10 * rate``; at least
+                the cost of a dirlist, so that every request can be served)
+            max_clients (int): maximum number of buckets
+            header (str): request header with the client address
+                (e.g. ``X-Forwarded-For``; default: ``REMOTE_ADDR``)
+            proxies (int): number of trusted proxies which append to
+                ``header`` (the client is the address the outermost one
+                appended; the entries before it are written by the client)
+            costs (dict): tokens per kind of request
+                (default: :data:`RATE_LIMIT_COSTS`)
+        """
+        self.rate = float(rate)
+        self.max_clients = max_clients
+        self.environ_key = None
+        if header:
+            self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self.proxies = max(int(proxies), 1)
+        self.costs = dict(RATE_LIMIT_COSTS)
+        self.costs.update(costs or {})
+        # a dirlist is charged as uncached, then as dirlist
+        self.burst = float(max(burst or 10 * rate,
+                               max(self.costs.values()),
+                               self.costs['uncached'] + self.costs['dirlist']))
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a rate limiter from pgs configuration
+        (``pgs.rate_limit``, ``pgs.rate_limit_burst``,
+        ``pgs.rate_limit_clients``, ``pgs.rate_limit_header``,
+        ``pgs.rate_limit_proxies``, ``pgs.rate_limit_costs``)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            RateLimiter: rate limiter (or None if ``pgs.rate_limit`` is
+            not set)
+        """
+        rate = conf.get('pgs.rate_limit')
+        if not rate:
+            return None
+        return cls(
+            rate,
+            burst=conf.get('pgs.rate_limit_burst'),
+            max_clients=conf.get('pgs.rate_limit_clients',
+                                 RATE_LIMIT_CLIENTS),
+            header=conf.get('pgs.rate_limit_header'),
+            proxies=conf.get('pgs.rate_limit_proxies', RATE_LIMIT_PROXIES),
+            costs=conf.get('pgs.rate_limit_costs'))
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def client(self, environ):
+        """
+        Arguments:
+            environ (dict): WSGI environ
+
+        Returns:
+            str: client key
+        """
+        if self.environ_key is not None:
+            value = environ.get(self.environ_key)
+            if value:
+                addrs = value.split(',')
+                return addrs[max(len(addrs) - self.proxies, 0)].strip()
+        return environ.get('REMOTE_ADDR', '')
+
+    def charge(self, client, kind, paid=None):
+        """
+        Take tokens from a client's bucket
+
+        Arguments:
+            client (str): client key (see :meth:`client`)
+            kind (str): kind of request (a key of ``costs``)
+
+        Keyword Arguments:
+            paid (str): kind the request was already charged as (only the
+                difference is taken)
+
+        Raises:
+            RateLimited: if the bucket does not hold enough tokens
+        """
+        cost = self.costs[kind]
+        if paid is not None:
+            cost -= self.costs[paid]
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst,
+                             bucket[0] + (now - bucket[1]) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        if not allowed:
+            raise RateLimited(
+                'rate limited: %s' % client,
+                int(math.ceil((cost - tokens) / self.rate)))
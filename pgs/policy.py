@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.policy
+===============
+
+``Cache-Control`` policies for pgs.
+
+A policy is a table of rules; the first rule whose pattern matches a
+path (or its MIME type) determines the ``Cache-Control`` header.
+Patterns are:
+
+* ``glob:*.css`` or ``*.css`` -- an :mod:`fnmatch` glob, matched against
+  the path and the basename
+* ``re:^assets/`` -- a regular expression, searched in the path
+* ``mime:image/*`` -- an :mod:`fnmatch` glob, matched against the MIME type
+
+Directives are a ``Cache-Control`` string (``max-age=60, no-cache``) or a
+dict (``{'max-age': 60, 'stale-while-revalidate': 30, 'immutable': True}``).
+
+Fingerprinted (content-hashed) filenames like ``app.3f9a1c7e.js`` or
+``index-BvH3kZ9qLm.js`` are detected and marked immutable before the
+rules are checked (except HTML pages, which keep their URLs).
+"""
+import fnmatch
+import mimetypes
+import posixpath
+import re
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# a name segment followed by the extension(s)
+FINGERPRINT_RE = re.compile(r'(?<=[.-])[0-9A-Za-z_]+(?=(?:\.\w+)+$)')
+HEX_HASH_RE = re.compile(r'^[0-9a-f]{8,}$')
+# a word with a number stuck on (``Version2``, ``facade12``)
+WORD_NUMBER_RE = re.compile(r'^(?:[A-Za-z]+[0-9]+|[0-9]+[A-Za-z]+)$')
+
+
+def is_hash(segment):
+    """
+    Arguments:
+        segment (str): a segment of a filename
+
+    Returns:
+        bool: whether ``segment`` looks like a content hash: at least 8 hex
+        digits, or at least 10 base32/base64url characters, with digits
+        and letters (and not a word with a number stuck on)
+    """
+    if (WORD_NUMBER_RE.match(segment)
+            or not re.search('[0-9]', segment)
+            or not re.search('[A-Za-z]', segment)):
+        return False
+    return HEX_HASH_RE.match(segment) is not None or len(segment) >= 10
+
+
+def is_fingerprinted(path):
+    """
+    Arguments:
+        path (str): path to a file
+
+    Returns:
+        bool: whether the basename contains a content hash
+        (e.g. ``app.3f9a1c7e.js``, ``index-BvH3kZ9qLm.js``)
+    """
+    return any(is_hash(segment) for segment in
+               FINGERPRINT_RE.findall(posixpath.basename(path)))
+
+
+def format_directives(directives):
+    """
+    Arguments:
+        directives (str or dict): ``Cache-Control`` directives
+
+    Returns:
+        str: ``Cache-Control`` header value (or None)
+    """
+    if not directives or not isinstance(directives, dict):
+        return directives or None
+    values = []
+    for name, value in sorted(directives.items()):
+        if value is True:
+            values.append(name)
+        elif value is not None and value is not False:
+            values.append('%s=%s' % (name, value))
+    return ', '.join(values) or None
+
+
+def parse_rule(rule):
+    """
+    Arguments:
+        rule (str or tuple): ``'pattern=directives'``
+            or ``(pattern, directives)``
+
+    Returns:
+        tuple: ``(kind, pattern, directives)`` where ``kind`` is one of
+        ``glob``, ``re``, ``mime``; ``pattern`` is compiled for ``re``
+    """
+    if isinstance(rule, tuple):
+        pattern, directives = rule
+    else:
+        pattern, directives = rule.split('=', 1)
+    pattern = pattern.strip()
+    kind = 'glob'
+    for _kind in ('glob', 're', 'mime'):
+        if pattern.startswith(_kind + ':'):
+            kind, pattern = _kind, pattern[len(_kind) + 1:]
+            break
+    if kind == 're':
+        pattern = re.compile(pattern)
+    return kind, pattern, format_directives(directives)
+
+
+class CacheControlPolicy(object):
+    """
+    A ``Cache-Control`` policy table
+
+    Call a policy with a path and MIME type to get its ``Cache-Control``
+    header value (or None).
+    """
+
+    def __init__(self, rules=None, default=None, fingerprinted=IMMUTABLE):
+        """
+        Keyword Arguments:
+            rules (list): rules (see :func:`parse_rule`)
+            default (str or dict): directives for paths matching no rule
+            fingerprinted (str or dict): directives for fingerprinted paths
+                (None to disable detection)
+        """
+        self.rules = [parse_rule(rule) for rule in (rules or [])]
+        self.default = format_directives(default)
+        self.fingerprinted = format_directives(fingerprinted)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Create a policy from pgs configuration:
+
+        * ``pgs.cache_control_rules`` -- list of rules
+        * ``pgs.cache_control`` -- default directives
+        * ``pgs.cache_control_fingerprinted`` -- directives for fingerprinted
+          paths (default: :data:`IMMUTABLE`; None to disable)
+
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            CacheControlPolicy: policy
+        """
+        return cls(
+            rules=conf.get('pgs.cache_control_rules'),
+            default=conf.get('pgs.cache_control'),
+            fingerprinted=conf.get('pgs.cache_control_fingerprinted',
+                                   IMMUTABLE))
+
+    def __call__(self, path, mimetype=None):
+        """
+        Arguments:
+            path (str): path to a file
+            mimetype (str): MIME type of the file (or None)
+
+        Returns:
+            str: ``Cache-Control`` header value (or None)
+        """
+        if self.fingerprinted and is_fingerprinted(path):
+            html = (mimetype or mimetypes.guess_type(path)[0] or '')
+            if html.split(';')[0].strip() != 'text/html':
+                return self.fingerprinted
+        path = path.lstrip('/')
+        basename = posixpath.basename(path)
+        for kind, pattern, directives in self.rules:
+            if kind == 'glob':
+                matched = (fnmatch.fnmatch(path, pattern)
+                           or fnmatch.fnmatch(basename, pattern))
+            elif kind == 're':
+                matched = pattern.search(path) is not None
+            else:
+                matched = bool(mimetype) and fnmatch.fnmatch(mimetype, pattern)
+            if matched:
+                return directives
+        return self.default
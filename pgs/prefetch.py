@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.prefetch
+===============
+
+Predictive prefetch and preload of the assets of served HTML pages.
+
+When an HTML page is served, its same-origin stylesheets, scripts and
+images will be requested a few milliseconds later: the page is parsed
+(once per path and ETag; the result is cached) for ``href`` and ``src``
+references, and the assets that are not resolved yet are warmed (see
+:func:`pgs.warmup.warm_path`) in a background thread, so that the
+follow-up requests are answered from memory.
+
+The critical assets of a page (stylesheets, scripts and preloaded fonts)
+are also announced to the browser in a ``Link: rel=preload`` header (see
+:func:`preload_headers`), which can be sent ahead of the response in a
+``103 Early Hints`` response. Pages too large for the response cache are
+scanned once per ETag from the first ``PRELOAD_SCAN_SIZE`` bytes of their
+file (see :func:`scan_html`).
+"""
+import collections
+import logging
+import threading
+import time
+
+try:
+    from html.parser import HTMLParser
+    from urllib.parse import urljoin, urlsplit
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+    from urlparse import urljoin, urlsplit
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import bottle
+
+from .cache import LRUCache
+from .warmup import unquote_path, warm_path
+
+PREFETCH_QUEUE_SIZE = 256
+MAX_ASSETS = 64
+MISSING_SIZE = 1024
+MISSING_TTL = 60
+PRELOAD_DESTINATIONS = ('style', 'script', 'font')
+MAX_PRELOADS = 16
+PRELOAD_SCAN_SIZE = 32 * 1024
+
+# (tag, attribute): request destination (cf. ``Link: rel=preload; as=``)
+ASSET_ATTRS = {
+    ('script', 'src'): 'script',
+    ('img', 'src'): 'image',
+    ('input', 'src'): 'image',
+    ('source', 'src'): 'image',
+    ('video', 'poster'): 'image',
+}
+LINK_RELS = {
+    'stylesheet': 'style',
+    'icon': 'image',
+    'apple-touch-icon': 'image',
+    'modulepreload': 'script',
+    'preload': None,  # from the ``as`` attribute
+}
+
+log = logging.getLogger('pgs.prefetch')
+
+
+class AssetParser(HTMLParser):
+    """
+    Collect the ``(reference, destination)`` of the subresources of an
+    HTML document (scripts, stylesheets, images, icons and preloads)
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.assets = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'link':
+            rels = (attrs.get('rel') or '').lower().split()
+            for rel in rels:
+                if rel in LINK_RELS:
+                    destination = LINK_RELS[rel] or attrs.get('as')
+                    if destination and attrs.get('href'):
+                        self.assets.append((attrs['href'], destination))
+                    break
+            return
+        for (name, value) in attrs.items():
+            destination = ASSET_ATTRS.get((tag, name))
+            if destination and value:
+                self.assets.append((value, destination))
+
+    handle_startendtag = handle_starttag
+
+
+def parse_assets(html, path, max_assets=MAX_ASSETS):
+    """
+    Find the same-origin assets referenced by an HTML document
+
+    Arguments:
+        html (bytes): HTML document (UTF-8)
+        path (str): path of the document (relative references are
+            resolved against ``/<path>``)
+
+    Keyword Arguments:
+        max_assets (int): maximum number of assets
+
+    Returns:
+        tuple: ``(url_path, destination)`` pairs in document order, where
+        ``url_path`` is a request path (``PATH_INFO``) and
+        ``destination`` is ``script``, ``style``, ``image``, ...
+    """
+    if bytes is not str:
+        html = html.decode('utf-8', 'replace')
+    parser = AssetParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:  # HTMLParseError (Python 2)
+        log.debug('cannot parse %r: %s', path, e)
+    base = '/' + path.lstrip('/')
+    assets = collections.OrderedDict()
+    for (ref, destination) in parser.assets:
+        ref = ref.strip()
+        if ref.startswith('//') or ref.startswith('#'):
+            continue
+        url = urlsplit(urljoin(base, ref))
+        if url.scheme or url.netloc:
+            continue
+        url_path = unquote_path(url.path)
+        if url_path and url_path != base and url_path not in assets:
+            assets[url_path] = destination
+            if len(assets) >= max_assets:
+                break
+    return tuple(assets.items())
+
+
+def is_html(resource):
+    """
+    Arguments:
+        resource (pgs.app.Resource): header record
+
+    Returns:
+        bool: whether its ``Content-Type`` is ``text/html``
+    """
+    for (name, value) in resource.headers:
+        if name == 'Content-Type':
+            return value.startswith('text/html')
+    return False
+
+
+def html_assets(FS, resource, body):
+    """
+    Get the assets of an HTML resource (cached in ``FS.html_assets`` by
+    path and ETag)
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (pgs.app.Resource): header record of an HTML file
+        body (bytes): its contents
+
+    Returns:
+        tuple: ``(url_path, destination)`` pairs (see :func:`parse_assets`)
+    """
+    key = (resource.path, resource.etag)
+    assets = FS.html_assets.get(key)
+    if assets is None:
+        assets = parse_assets(body, resource.path)
+        FS.html_assets.set(key, assets)
+    return assets
+
+
+class Prefetcher(object):
+    """
+    Warm request paths in one background thread, at most
+    ``max_pending`` at a time (paths that are already resolved or
+    pending, or that were not found in the last ``MISSING_TTL`` seconds,
+    are skipped; paths are dropped when the queue is full)
+    """
+
+    def __init__(self, FS, max_pending=PREFETCH_QUEUE_SIZE):
+        """
+        Arguments:
+            FS (RepositoryFS): filesystem
+
+        Keyword Arguments:
+            max_pending (int): queue size
+        """
+        self.FS = FS
+        self.queue = queue.Queue(max_pending)
+        self.pending = set()
+        self.missing = LRUCache(MISSING_SIZE)
+        self.prefetched = 0
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf, FS):
+        """
+        Arguments:
+            conf (dict): configuration
+            FS (RepositoryFS): filesystem
+
+        Returns:
+            Prefetcher: prefetcher (or None unless ``pgs.prefetch``)
+        """
+        if not conf.get('pgs.prefetch'):
+            return None
+        return cls(FS)
+
+    def submit(self, url_paths):
+        """
+        Arguments:
+            url_paths (iterable): request paths to warm
+        """
+        resolutions, now = self.FS.resolutions, time.time()
+        with self._lock:
+            for url_path in url_paths:
+                if (url_path in self.pending
+                        or resolutions.peek(url_path) is not None
+                        or now - self.missing.peek(url_path, 0)
+                        < MISSING_TTL):
+                    continue
+                try:
+                    self.queue.put_nowait(url_path)
+                except queue.Full:
+                    self.dropped += 1
+                    break
+                self.pending.add(url_path)
+            if self._thread is None and self.pending:
+                self._thread = threading.Thread(target=self._run,
+                                                name='pgs-prefetch')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            url_path = self.queue.get()
+            try:
+                if warm_path(self.FS, url_path):
+                    self.prefetched += 1
+                else:
+                    self.missing.set(url_path, time.time(), 1)
+            except Exception as e:
+                log.debug('prefetch: %r: %s', url_path, e)
+            finally:
+                with self._lock:
+                    self.pending.discard(url_path)
+                self.queue.task_done()
+
+
+def prefetch(FS, resource, body):
+    """
+    Prefetch the assets of a served HTML resource (if ``pgs.prefetch``)
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (pgs.app.Resource): header record
+        body (bytes): contents
+    """
+    if FS.prefetcher is None or not is_html(resource):
+        return
+    FS.prefetcher.submit(
+        url_path for (url_path, _) in html_assets(FS, resource, body))
+
+
+def link_header(assets, max_preloads=MAX_PRELOADS):
+    """
+    Arguments:
+        assets (tuple): ``(url_path, destination)`` pairs (see
+            :func:`parse_assets`)
+
+    Keyword Arguments:
+        max_preloads (int): maximum number of preloads
+
+    Returns:
+        str: ``Link`` header value preloading the critical assets
+        (stylesheets, scripts and fonts; None if there are none)
+    """
+    links = []
+    for (url_path, destination) in assets:
+        if destination not in PRELOAD_DESTINATIONS:
+            continue
+        link = '<%s>; rel=preload; as=%s' % (
+            bottle.urlquote(url_path), destination)
+        if destination == 'font':
+            link += '; crossorigin'
+        links.append(link)
+        if len(links) >= max_preloads:
+            break
+    return ', '.join(links) or None
+
+
+def preload_enabled(FS):
+    """
+    Returns:
+        bool: whether ``pgs.preload`` or ``pgs.early_hints`` is set
+    """
+    return bool(FS.conf.get('pgs.preload') or FS.conf.get('pgs.early_hints'))
+
+
+def scan_html(FS, resource, fileobj):
+    """
+    Find the assets of an HTML resource (that was not parsed yet) in the
+    head of its file, and rewind it
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (pgs.app.Resource): header record
+        fileobj (file-like): binary file object (streams which cannot
+            ``seek`` are not scanned)
+    """
+    if not preload_enabled(FS) or not is_html(resource):
+        return
+    if (not hasattr(fileobj, 'seek') or FS.html_assets.peek(
+            (resource.path, resource.etag)) is not None):
+        return
+    position = fileobj.tell()
+    head = fileobj.read(PRELOAD_SCAN_SIZE)
+    fileobj.seek(position)
+    html_assets(FS, resource, head)
+
+
+def preload_headers(FS, resource, body=None):
+    """
+    Get the ``Link: rel=preload`` header of an HTML resource (with
+    ``pgs.preload`` or ``pgs.early_hints``)
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        resource (pgs.app.Resource): header record
+
+    Keyword Arguments:
+        body (bytes): contents (to parse them if they were not parsed
+            yet)
+
+    Returns:
+        tuple: ``(('Link', value),)`` (or ``()`` if there are no critical
+        assets, or the page was not parsed yet and ``body`` is None)
+    """
+    if not preload_enabled(FS) or not is_html(resource):
+        return ()
+    if body is None:
+        assets = FS.html_assets.peek((resource.path, resource.etag))
+        if assets is None:
+            return ()
+    else:
+        assets = html_assets(FS, resource, body)
+    link = link_header(assets)
+    if link is None:
+        return ()
+    return (('Link', link),)
@@ -0,0 +1,879 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.servers
+===============
+
+bottle server adapters for pgs.
+
+* :class:`PreforkServer` -- N pre-forked worker processes which share
+  one port (with ``SO_REUSEPORT`` where available)
+* :class:`ThreadPoolServer` -- a fixed-size thread pool with HTTP/1.1
+  persistent connections (keep-alive and pipelining), a bounded accept
+  queue and timeouts (stdlib only); idle connections wait in a selector
+  instead of a thread (Python 3)
+"""
+import collections
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+try:
+    import selectors
+except ImportError:  # Python 2: idle connections keep their thread
+    selectors = None
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Queue, Full
+    from urllib import unquote
+
+    def unquote_path(path):
+        return unquote(path)
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue, Full
+    from urllib.parse import unquote
+
+    def unquote_path(path):
+        return unquote(path, 'iso-8859-1')
+
+import bottle
+
+log = logging.getLogger('pgs.servers')
+
+
+def make_listen_socket(host, port, reuse_port=False, listen=True,
+                       backlog=128):
+    """
+    Create a TCP server socket
+
+    Arguments:
+        host (str): address to bind to
+        port (int): port to bind to (0 for a random port)
+
+    Keyword Arguments:
+        reuse_port (bool): set ``SO_REUSEPORT``
+            (so that other processes can bind the same port)
+        listen (bool): whether to ``listen()`` (a bound socket which is not
+            listening reserves the port but does not accept connections)
+        backlog (int): ``listen()`` backlog
+
+    Returns:
+        socket.socket: bound socket
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    if listen:
+        sock.listen(backlog)
+    return sock
+
+
+def make_wsgiref_server(sock, app, quiet=False):
+    """
+    Create a ``wsgiref`` server which accepts connections from an
+    already bound, listening socket
+
+    Arguments:
+        sock (socket.socket): listening socket
+        app (callable): WSGI application
+
+    Keyword Arguments:
+        quiet (bool): don't log requests to stderr
+
+    Returns:
+        wsgiref.simple_server.WSGIServer: server
+    """
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+    class Handler(WSGIRequestHandler):
+        def address_string(self):  # Prevent reverse DNS lookups please.
+            return self.client_address[0]
+
+        def log_request(*args, **kw):
+            if not quiet:
+                return WSGIRequestHandler.log_request(*args, **kw)
+
+    class Server(WSGIServer):
+        address_family = sock.family
+
+    srv = Server(sock.getsockname()[:2], Handler, bind_and_activate=False)
+    srv.socket.close()
+    srv.socket = sock
+    srv.server_address = sock.getsockname()
+    srv.server_name, srv.server_port = srv.server_address[:2]
+    srv.setup_environ()
+    srv.set_app(app)
+    return srv
+
+
+class PreforkServer(bottle.ServerAdapter):
+    """
+    Pre-fork ``workers`` processes which each serve the app on the same port
+
+    With ``SO_REUSEPORT`` (Linux >= 3.9, BSD) every worker listens on its
+    own socket and the kernel balances connections between them;
+    otherwise the workers share one inherited listening socket.
+
+    The master process supervises the workers: a worker which exits is
+    restarted (at most once per second per worker), and ``SIGINT`` or
+    ``SIGTERM`` stop all workers.
+
+    Options:
+        workers (int): number of worker processes (default: 2)
+        post_fork (callable): ``post_fork(worker_id)`` is called in each
+            worker after fork, to reinitialise per-process state
+            (e.g. :func:`pgs.app.post_fork`)
+        worker_exit (callable): ``worker_exit(worker_id)`` is called in
+            each worker before it exits, to release per-process resources
+            (e.g. :func:`pgs.app.worker_exit`)
+        reuse_port (bool): use ``SO_REUSEPORT`` if available
+            (default: True)
+        make_server (callable): ``make_server(sock, app, quiet)`` returns
+            a server with a ``serve_forever`` method
+            (default: :func:`make_wsgiref_server`)
+    """
+
+    restart_interval = 1
+
+    def run(self, handler):  # pragma: no cover
+        self.workers = int(self.options.get('workers', 2))
+        self.post_fork = self.options.get('post_fork')
+        self.worker_exit = self.options.get('worker_exit')
+        self.make_server = self.options.get('make_server',
+                                            make_wsgiref_server)
+        self.reuse_port = (self.options.get('reuse_port', True)
+                           and hasattr(socket, 'SO_REUSEPORT'))
+        # with SO_REUSEPORT, the master only reserves the port
+        self.socket = make_listen_socket(self.host, self.port,
+                                         reuse_port=self.reuse_port,
+                                         listen=not self.reuse_port)
+        self.port = self.socket.getsockname()[1]
+        self.children = {}
+        self.started = {}
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for worker_id in range(self.workers):
+                self.spawn(worker_id, handler)
+            self.supervise(handler)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_workers()
+            self.socket.close()
+
+    def spawn(self, worker_id, handler):
+        """
+        Fork a worker process
+
+        Arguments:
+            worker_id (int): worker number
+            handler (callable): WSGI application
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = worker_id
+            self.started[worker_id] = time.time()
+            return pid
+        exitcode = 1
+
+        def stop(signum, frame):
+            self.exit_worker(worker_id, 0)
+
+        try:
+            signal.signal(signal.SIGTERM, stop)
+            if self.post_fork is not None:
+                self.post_fork(worker_id)
+            if self.reuse_port:
+                self.socket.close()
+                sock = make_listen_socket(self.host, self.port,
+                                          reuse_port=True)
+            else:
+                sock = self.socket
+            srv = self.make_server(sock, handler, quiet=self.quiet)
+            srv.serve_forever()
+            exitcode = 0
+        except KeyboardInterrupt:
+            exitcode = 0
+        except Exception:
+            log.exception('worker %d (pid %d) failed', worker_id, os.getpid())
+        finally:
+            self.exit_worker(worker_id, exitcode)
+
+    def exit_worker(self, worker_id, exitcode):
+        """
+        Call ``worker_exit`` and exit a worker process
+
+        Arguments:
+            worker_id (int): worker number
+            exitcode (int): exit status
+        """
+        try:
+            if self.worker_exit is not None:
+                self.worker_exit(worker_id)
+        except Exception:
+            log.exception('worker %d (pid %d): worker_exit failed',
+                          worker_id, os.getpid())
+        os._exit(exitcode)
+
+    def supervise(self, handler):
+        """
+        Wait for workers to exit and restart them
+        """
+        while True:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+            log.warning('worker %d (pid %d) exited with status %d',
+                        worker_id, pid, status)
+            uptime = time.time() - self.started.get(worker_id, 0)
+            if uptime < self.restart_interval:
+                time.sleep(self.restart_interval - uptime)
+            self.spawn(worker_id, handler)
+
+    def stop_workers(self):
+        """
+        Terminate all workers and wait for them to exit
+        """
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self.children.pop(pid, None)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('latin-1')
+
+
+class _InputReader(object):
+    """
+    A ``wsgi.input`` which reads at most ``Content-Length`` bytes
+    (so that the next request on a persistent connection stays intact)
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class FileWrapper(object):
+    """
+    A ``wsgi.file_wrapper``: a file response body, which
+    :class:`WSGIRequestHandler` sends with ``socket.sendfile``
+    (Python >= 3.5) if it is a file on disk
+    """
+
+    def __init__(self, filelike, blksize=64 * 1024):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def fileno(self):
+        """
+        Returns:
+            int: file descriptor (or None if ``filelike`` is not a file)
+        """
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    """
+    An HTTP/1.1 WSGI request handler with persistent connections
+
+    Requests on a connection are handled in order (pipelined requests
+    are read from the buffered socket file); responses without a
+    ``Content-Length`` use chunked transfer encoding. A connection is
+    closed after ``server.keepalive_timeout`` idle seconds, after
+    ``server.max_requests`` requests, or when the client asks.
+
+    With a ``server.selector``, a connection with no request data
+    buffered or readable is parked (:attr:`parked`) instead of waiting in
+    its thread; the server resumes it (:meth:`resume`) once it is
+    readable.
+
+    Apps can send a ``103 Early Hints`` response before they call
+    ``start_response`` with ``environ['wsgi.early_hints'](headers)``
+    (HTTP/1.1 requests only; it returns whether the hints were sent).
+    """
+
+    protocol_version = 'HTTP/1.1'
+    max_drain = 64 * 1024
+    bodyless_statuses = ('204', '304')
+    parked = False
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        self.requests_handled = 0
+        BaseHTTPRequestHandler.setup(self)
+
+    def address_string(self):  # Prevent reverse DNS lookups please.
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        if not self.server.quiet:
+            return BaseHTTPRequestHandler.log_request(self, *args, **kwargs)
+
+    def handle(self):
+        self.parked = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.idle():
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def finish(self):
+        if not self.parked:
+            BaseHTTPRequestHandler.finish(self)
+
+    def resume(self):
+        """
+        Handle the next requests of a parked connection
+        """
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def idle(self):
+        """
+        Returns:
+            bool: True if the connection can be parked (no request data is
+            buffered or readable yet)
+        """
+        peek = getattr(self.rfile, 'peek', None)
+        if self.server.selector is None or peek is None:
+            return False
+        self.connection.settimeout(0)
+        try:
+            return not peek(1)
+        except socket.error:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                self.close_connection = True
+                return
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+            if not self.parse_request():
+                self.close_connection = True
+                return
+            self.requests_handled += 1
+            if self.requests_handled >= self.server.max_requests:
+                self.close_connection = True
+            self.run_wsgi()
+            self.wfile.flush()
+        except socket.timeout:
+            self.close_connection = True
+        except socket.error:
+            self.close_connection = True
+
+    def get_environ(self):
+        """
+        Returns:
+            dict: WSGI environ for the current request
+        """
+        env = self.server.base_environ.copy()
+        env['SERVER_PROTOCOL'] = self.request_version
+        env['REQUEST_METHOD'] = self.command
+        if '?' in self.path:
+            path, query = self.path.split('?', 1)
+        else:
+            path, query = self.path, ''
+        env['PATH_INFO'] = unquote_path(path)
+        env['QUERY_STRING'] = query
+        env['REMOTE_ADDR'] = self.client_address[0]
+        env['REMOTE_PORT'] = str(self.client_address[1])
+        for name, value in self.headers.items():
+            name = name.replace('-', '_').upper()
+            value = value.strip()
+            if name == 'CONTENT_TYPE':
+                env['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                env['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name
+                if key in env:
+                    value = env[key] + ',' + value
+                env[key] = value
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if 'HTTP_TRANSFER_ENCODING' in env:
+            self.close_connection = True
+        env['wsgi.input'] = self.input = _InputReader(self.rfile, length)
+        env['wsgi.errors'] = sys.stderr
+        env['wsgi.file_wrapper'] = FileWrapper
+        env['wsgi.version'] = (1, 0)
+        env['wsgi.url_scheme'] = 'http'
+        env['wsgi.multithread'] = True
+        env['wsgi.multiprocess'] = False
+        env['wsgi.run_once'] = False
+        return env
+
+    def run_wsgi(self):
+        """
+        Call the WSGI app for the current request and write its response
+        """
+        environ = self.get_environ()
+        state = {'status': None, 'headers': None, 'sent': False,
+                 'chunked': False}
+
+        def send_headers():
+            status, headers = state['status'], state['headers']
+            names = set(name.lower() for (name, _) in headers)
+            has_body = (self.command != 'HEAD'
+                        and status[:3] not in self.bodyless_statuses
+                        and status[:1] != '1')
+            if 'content-length' not in names and has_body:
+                if self.request_version == 'HTTP/1.1':
+                    state['chunked'] = True
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                else:
+                    self.close_connection = True
+            if self.close_connection:
+                headers.append(('Connection', 'close'))
+            elif self.request_version != 'HTTP/1.1':
+                headers.append(('Connection', 'keep-alive'))
+            if 'date' not in names:
+                headers.append(('Date', self.date_time_string()))
+            if 'server' not in names:
+                headers.append(('Server', self.version_string()))
+            out = ['%s %s\r\n' % (self.protocol_version, status)]
+            out.extend('%s: %s\r\n' % header for header in headers)
+            out.append('\r\n')
+            self.wfile.write(_to_bytes(''.join(out)))
+            state['sent'] = True
+            self.log_request(status[:3])
+
+        def early_hints(headers):
+            if state['sent'] or self.request_version != 'HTTP/1.1':
+                return False
+            out = ['%s 103 Early Hints\r\n' % self.protocol_version]
+            out.extend('%s: %s\r\n' % header for header in headers)
+            out.append('\r\n')
+            self.wfile.write(_to_bytes(''.join(out)))
+            self.wfile.flush()
+            return True
+
+        def write(data):
+            if not state['sent']:
+                send_headers()
+            if not data or self.command == 'HEAD':
+                return
+            if state['chunked']:
+                self.wfile.write(_to_bytes('%x\r\n' % len(data)))
+                self.wfile.write(data)
+                self.wfile.write(b'\r\n')
+            else:
+                self.wfile.write(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[1]
+                finally:
+                    exc_info = None
+            state['status'], state['headers'] = status, list(headers)
+            return write
+
+        environ['wsgi.early_hints'] = early_hints
+        result = None
+        try:
+            result = self.server.app(environ, start_response)
+            if not self.sendfile(result, write, state):
+                for data in result:
+                    write(data)
+            if not state['sent']:
+                send_headers()
+            if state['chunked']:
+                self.wfile.write(b'0\r\n\r\n')
+        except socket.error:
+            self.close_connection = True
+        except Exception:
+            log.exception('error handling %r', self.requestline)
+            self.close_connection = True
+            if not state['sent']:
+                body = b'Internal Server Error'
+                state['status'] = '500 Internal Server Error'
+                state['headers'] = [('Content-Type', 'text/plain'),
+                                    ('Content-Length', str(len(body)))]
+                write(body)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if self.input.remaining > self.max_drain:
+            self.close_connection = True
+        elif self.input.remaining:
+            self.input.read()
+
+    def sendfile(self, result, write, state):
+        """
+        Send a :class:`FileWrapper` response body of a file on disk with
+        ``socket.sendfile`` (after the headers)
+
+        Returns:
+            bool: False if ``result`` must be iterated instead
+        """
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if (sendfile is None or not isinstance(result, FileWrapper)
+                or result.fileno() is None):
+            return False
+        write(b'')
+        if state['chunked'] or self.command == 'HEAD':
+            return False
+        self.wfile.flush()
+        fileobj = result.filelike
+        sendfile(fileobj, fileobj.tell())
+        return True
+
+
+class ThreadPoolWSGIServer(HTTPServer):
+    """
+    An HTTP server which hands accepted connections to a fixed-size pool
+    of worker threads through a bounded queue
+
+    Where the ``selectors`` module is available (Python 3), connections
+    wait in a selector until they are readable, both when they are
+    accepted and between keep-alive requests (see
+    :meth:`WSGIRequestHandler.idle`), so that idle clients do not hold
+    worker threads. When the queue is full, readable connections are
+    answered with ``503 Service Unavailable`` and closed.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, app,
+                 threads=10,
+                 queue_size=64,
+                 backlog=128,
+                 keepalive_timeout=5,
+                 max_requests=1000,
+                 quiet=False,
+                 bind_and_activate=True):
+        """
+        Arguments:
+            server_address (tuple): ``(host, port)``
+            app (callable): WSGI application
+
+        Keyword Arguments:
+            threads (int): number of worker threads
+            queue_size (int): accepted connections waiting for a thread
+            backlog (int): ``listen()`` backlog
+            keepalive_timeout (float): seconds to wait for the next request
+                on a connection (and socket timeout)
+            max_requests (int): requests per connection
+            quiet (bool): don't log requests to stderr
+            bind_and_activate (bool): bind and listen
+                (see :func:`make_threadpool_server`)
+        """
+        self.request_queue_size = backlog
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
+        HTTPServer.__init__(self, server_address, WSGIRequestHandler,
+                            bind_and_activate=bind_and_activate)
+        self.app = app
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.quiet = quiet
+        self.requests = Queue(maxsize=queue_size)
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.process_requests,
+                                      name='pgs-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.selector = None
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+            self._parked = collections.deque()
+            self._closing = False
+            self._wakeup = socket.socketpair()
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            self.selector.register(self._wakeup[0], selectors.EVENT_READ)
+            self._poller = threading.Thread(target=self.poll_connections,
+                                            name='pgs-poller')
+            self._poller.daemon = True
+            self._poller.start()
+        if bind_and_activate:
+            self.setup_environ()
+
+    def setup_environ(self):
+        host, port = self.socket.getsockname()[:2]
+        self.server_name, self.server_port = host, port
+        self.base_environ = {
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'SCRIPT_NAME': '',
+        }
+
+    def process_request(self, request, client_address):
+        if self.selector is not None:
+            self.park(request, client_address)
+        else:
+            self.dispatch(request, client_address)
+
+    def dispatch(self, request, client_address, handler=None):
+        """
+        Queue a readable connection for a worker thread (or answer
+        ``503`` if the queue is full)
+
+        Arguments:
+            request (socket.socket): connection
+            client_address (tuple): client address
+
+        Keyword Arguments:
+            handler (WSGIRequestHandler): parked handler of a persistent
+                connection (None for a new connection)
+        """
+        try:
+            self.requests.put_nowait((request, client_address, handler))
+        except Full:
+            log.warning('request queue full: rejecting %r', client_address)
+            try:
+                request.sendall(
+                    b'HTTP/1.1 503 Service Unavailable\r\n'
+                    b'Content-Length: 0\r\n'
+                    b'Retry-After: 1\r\n'
+                    b'Connection: close\r\n\r\n')
+            except socket.error:
+                pass
+            self.shutdown_connection(request, handler)
+
+    def park(self, request, client_address, handler=None):
+        """
+        Wait for a connection to be readable in the selector (for at most
+        ``keepalive_timeout`` seconds), then :meth:`dispatch` it
+
+        Arguments:
+            request (socket.socket): connection
+            client_address (tuple): client address
+
+        Keyword Arguments:
+            handler (WSGIRequestHandler): parked handler of a persistent
+                connection (None for a new connection)
+        """
+        self._parked.append((request, client_address, handler))
+        self.wake()
+
+    def wake(self):
+        try:
+            self._wakeup[1].send(b'\0')
+        except socket.error:
+            pass
+
+    def poll_connections(self):
+        """
+        Dispatch parked connections once they are readable, and close the
+        ones which stay idle for ``keepalive_timeout`` seconds
+        """
+        selector = self.selector
+        # deadlines are in parking order: the timeout is the same for all
+        deadlines = collections.OrderedDict()
+        while not self._closing:
+            while self._parked:
+                item = self._parked.popleft()
+                selector.register(item[0], selectors.EVENT_READ, item)
+                deadlines[item[0]] = (time.time() + self.keepalive_timeout,
+                                      item)
+            timeout = None
+            if deadlines:
+                deadline, _ = next(iter(deadlines.values()))
+                timeout = max(deadline - time.time(), 0)
+            for key, _ in selector.select(timeout):
+                if key.data is None:
+                    try:
+                        self._wakeup[0].recv(4096)
+                    except socket.error:
+                        pass
+                    continue
+                selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self.dispatch(*key.data)
+            now = time.time()
+            while deadlines:
+                deadline, item = next(iter(deadlines.values()))
+                if deadline > now:
+                    break
+                del deadlines[item[0]]
+                selector.unregister(item[0])
+                self.shutdown_connection(item[0], item[2])
+        for deadline, item in deadlines.values():
+            self.shutdown_connection(item[0], item[2])
+        for item in self._parked:
+            self.shutdown_connection(item[0], item[2])
+        selector.close()
+        for sock in self._wakeup:
+            sock.close()
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address, handler = item
+            parked = False
+            try:
+                if handler is None:
+                    handler = self.RequestHandlerClass(request,
+                                                       client_address, self)
+                else:
+                    handler.resume()
+                parked = handler.parked
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if parked:
+                    self.park(request, client_address, handler)
+                else:
+                    self.shutdown_request(request)
+
+    def shutdown_connection(self, request, handler=None):
+        """
+        Close a connection (and the socket files of its handler)
+        """
+        if handler is not None:
+            handler.parked = False
+            try:
+                handler.finish()
+            except socket.error:
+                pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for thread in self.threads:
+            self.requests.put(None)
+        if self.selector is not None:
+            self._closing = True
+            self.wake()
+
+
+def make_threadpool_server(sock, app, quiet=False, **options):
+    """
+    Create a :class:`ThreadPoolWSGIServer` which accepts connections from
+    an already bound, listening socket
+
+    (e.g. ``make_server=functools.partial(make_threadpool_server,
+    threads=20)`` for :class:`PreforkServer`)
+
+    Arguments:
+        sock (socket.socket): listening socket
+        app (callable): WSGI application
+
+    Keyword Arguments:
+        quiet (bool): don't log requests to stderr
+        options (dict): :class:`ThreadPoolWSGIServer` options
+
+    Returns:
+        ThreadPoolWSGIServer: server
+    """
+    srv = ThreadPoolWSGIServer(sock.getsockname()[:2], app, quiet=quiet,
+                               bind_and_activate=False, **options)
+    srv.socket.close()
+    srv.socket = sock
+    srv.server_address = sock.getsockname()
+    srv.setup_environ()
+    return srv
+
+
+class ThreadPoolServer(bottle.ServerAdapter):
+    """
+    Serve with a :class:`ThreadPoolWSGIServer`
+
+    Options:
+        threads (int): number of worker threads (default: 10)
+        queue_size (int): accepted connections waiting for a thread
+            (default: 64)
+        backlog (int): ``listen()`` backlog (default: 128)
+        keepalive_timeout (float): idle seconds before a persistent
+            connection is closed (default: 5)
+        max_requests (int): requests per connection (default: 1000)
+    """
+
+    def run(self, handler):  # pragma: no cover
+        self.srv = ThreadPoolWSGIServer((self.host, self.port), handler,
+                                        quiet=self.quiet, **self.options)
+        self.port = self.srv.server_port
+        try:
+            self.srv.serve_forever()
+        finally:
+            self.srv.server_close()
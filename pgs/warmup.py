@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+pgs.warmup
+===============
+
+Cache warm-up for pgs.
+
+After a restart or a deploy, the most requested paths are requested once
+in a background thread, so that their resolutions, :class:`Resource`
+records (and the tree index and modification times they need), small
+responses and git blobs (in the disk blob cache) are cached before the
+first wave of users asks for them.
+
+The paths come from:
+
+* an access log in Common or Combined Log Format (``pgs.warm_from``,
+  ``--warm-from``), when a process starts
+* a sample of recent requests (``pgs.warm_auto``, ``--warm-auto``),
+  when the served git revision moves
+"""
+import collections
+import logging
+import re
+import threading
+
+import bottle
+
+from .limits import Unavailable
+
+WARM_TOP = 1000
+WARM_LOG_BYTES = 16 * 1024 * 1024
+SAMPLE_EVERY = 4
+SAMPLE_SIZE = 4096
+CHUNK_SIZE = 64 * 1024
+
+LOG_REQUEST = re.compile(
+    r'"(?:GET|HEAD) ([^ "]+) HTTP/[0-9.]+" (?:200|304) ')
+
+log = logging.getLogger('pgs.warmup')
+
+
+def unquote_path(path):
+    """
+    Arguments:
+        path (str): request target (e.g. ``/a%20b?x=1``)
+
+    Returns:
+        str: request path as in ``PATH_INFO`` (e.g. ``/a b``; None if
+        it is not UTF-8)
+    """
+    path = bottle.urlunquote(path.split('#', 1)[0].split('?', 1)[0])
+    if bottle.py3k:
+        try:
+            path = path.encode('latin1').decode('utf8')
+        except UnicodeError:
+            return None
+    return path
+
+
+def parse_access_log(lines):
+    """
+    Parse the request paths of successful ``GET`` and ``HEAD`` requests
+    from access log lines (Common or Combined Log Format)
+
+    Arguments:
+        lines (iterable): log lines
+
+    Yields:
+        str: request path (without the query string, unquoted)
+    """
+    for line in lines:
+        match = LOG_REQUEST.search(line)
+        if match is not None:
+            path = unquote_path(match.group(1))
+            if path is not None and path.startswith('/'):
+                yield path
+
+
+def read_access_log(path, top=WARM_TOP, max_bytes=WARM_LOG_BYTES):
+    """
+    Get the most requested paths of (the end of) an access log
+
+    Arguments:
+        path (str): access log path
+
+    Keyword Arguments:
+        top (int): number of paths
+        max_bytes (int): number of bytes to read from the end of the log
+
+    Returns:
+        list: request paths, most requested first (empty if the log
+        cannot be read)
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            fileobj.seek(0, 2)
+            size = fileobj.tell()
+            fileobj.seek(max(0, size - max_bytes))
+            data = fileobj.read()
+    except (IOError, OSError) as e:
+        log.warning('cannot read access log %r: %s', path, e)
+        return []
+    if bytes is not str:
+        data = data.decode('latin1')
+    lines = data.splitlines()
+    if size > max_bytes:
+        lines = lines[1:]  # partial line
+    counts = collections.Counter(parse_access_log(lines))
+    return [url_path for (url_path, _) in counts.most_common(top)]
+
+
+class PathSampler(object):
+    """
+    Count every ``every``-th request path (at most ``size`` paths; the
+    counts are halved when it is full, so that recent requests count
+    more)
+    """
+
+    def __init__(self, every=SAMPLE_EVERY, size=SAMPLE_SIZE):
+        """
+        Keyword Arguments:
+            every (int): sample one request in ``every``
+            size (int): maximum number of paths
+        """
+        self.every = every
+        self.size = size
+        self.counts = {}
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """
+        Arguments:
+            conf (dict): configuration
+
+        Returns:
+            PathSampler: sampler (or None unless ``pgs.warm_auto``)
+        """
+        if not conf.get('pgs.warm_auto'):
+            return None
+        return cls()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def record(self, url_path):
+        """
+        Arguments:
+            url_path (str): request path
+        """
+        self.seen += 1
+        if self.seen % self.every:
+            return
+        with self._lock:
+            self.counts[url_path] = self.counts.get(url_path, 0) + 1
+            if len(self.counts) > self.size:
+                self.counts = dict(
+                    (key, count // 2)
+                    for (key, count) in self.counts.items() if count > 1)
+
+    def top(self, n=WARM_TOP):
+        """
+        Arguments:
+            n (int): number of paths
+
+        Returns:
+            list: sampled request paths, most requested first
+        """
+        with self._lock:
+            counts = collections.Counter(self.counts)
+        return [url_path for (url_path, _) in counts.most_common(n)]
+
+
+def warm_path(FS, url_path):
+    """
+    Request a path once, without a client
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        url_path (str): request path
+
+    Returns:
+        bool: whether ``url_path`` resolved to a file
+    """
+    from .app import cached_response, resolve_path
+    _, resource = resolve_path(FS, url_path)
+    if resource is None:
+        return False
+    if cached_response(FS, resource) is not None:
+        return True
+    # too large for the response cache: add it to the disk blob cache
+    fileobj = FS.open_cached(resource)
+    if fileobj is None and getattr(FS, 'blob_cache', None) is not None:
+        fileobj = FS.open_resource(resource)
+        while fileobj.read(CHUNK_SIZE):
+            pass
+    if fileobj is not None:
+        fileobj.close()
+    return True
+
+
+def warm(FS, url_paths):
+    """
+    Warm the caches of a filesystem, one path at a time (stopping if
+    requests are being shed)
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        url_paths (list): request paths, most important first
+
+    Returns:
+        int: number of paths that resolved to files
+    """
+    warmed = 0
+    for url_path in url_paths:
+        try:
+            warmed += warm_path(FS, url_path)
+        except Unavailable as e:
+            log.info('warm-up stopped after %d paths: %s', warmed, e)
+            break
+        except Exception as e:
+            log.debug('warm-up: %r: %s', url_path, e)
+    log.info('warm-up: %d of %d paths', warmed, len(url_paths))
+    return warmed
+
+
+def start_warmup(FS, url_paths):
+    """
+    :func:`warm` in a background thread
+
+    Arguments:
+        FS (RepositoryFS): filesystem
+        url_paths (list): request paths
+
+    Returns:
+        threading.Thread: the (daemon) thread (or None if there is
+        nothing to warm)
+    """
+    if not url_paths:
+        return None
+    thread = threading.Thread(target=warm, args=(FS, list(url_paths)),
+                              name='pgs-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -11,10 +11,37 @@ Tests for `pgs` module.
 import unittest
 
 import collections
+import functools
+import io
 import os.path
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
 
 import pgs.app
 from pgs.app import pathjoin
+from pgs.blobcache import DiskBlobCache
+from pgs.cache import (CacheBudget, FrequencySketch, LRUCache, SingleFlight,
+                       TinyLFUCache, sizeof)
+from pgs.index import (CompactIndex, IndexCache, IndexEntry, MappedIndex,
+                       dump_index)
+from pgs.limits import (AdmissionController, Overloaded, ProcessLimiter,
+                        ProcessTimeout, QueueTimeout, RateLimited,
+                        RateLimiter)
+from pgs.policy import CacheControlPolicy, IMMUTABLE, is_fingerprinted
+from pgs.prefetch import parse_assets
+from pgs.servers import FileWrapper, PreforkServer, ThreadPoolWSGIServer
+from pgs.warmup import PathSampler, parse_access_log, read_access_log, warm
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -189,12 +216,961 @@ class TestDirectoryRepositoryFS(unittest.TestCase, FSTestUtils):
         for _path in self.files:
             return self._test_fs_file(self, self.FS, _path, self.conf)
 
+    def test_070_get_resource(self):
+        resource = self.FS.get_resource('index.html')
+        self.assertTrue(resource)
+        headers = dict(resource.headers)
+        self.assertEqual(headers['Content-Length'], str(resource.size))
+        self.assertEqual(headers['ETag'], resource.etag)
+        self.assertTrue(headers['Content-Type'].startswith('text/html'))
+        self.assertIn('Last-Modified', headers)
+        self.assertIs(self.FS.get_resource('index.html'), resource)
+
+    def test_080_get_resource_missing(self):
+        self.assertIsNone(self.FS.get_resource('a'))
+        self.assertIsNone(self.FS.get_resource('does-not-exist'))
+
+    def test_090_get_resource_sibling(self):
+        path = tempfile.mkdtemp(prefix='pgs-test-')
+        try:
+            for name in ('www', 'www2'):
+                os.mkdir(os.path.join(path, name))
+                with open(os.path.join(path, name, 'f'), 'wb') as fileobj:
+                    fileobj.write(b'f')
+            root_path = os.path.join(path, 'www')
+            FS = pgs.app.DirectoryRepositoryFS({'pgs.root_path': root_path})
+            # without sanitize_path, the root check is the last defense
+            FS.getsyspath = lambda p: os.path.join(root_path, p)
+            self.assertIsNotNone(FS.get_resource('f'))
+            self.assertIsNone(FS.get_resource('../www2/f'))
+        finally:
+            shutil.rmtree(path)
+
+    def test_095_resolution_added(self):
+        path = tempfile.mkdtemp(prefix='pgs-test-')
+        try:
+            with open(os.path.join(path, 'a.html'), 'wb') as fileobj:
+                fileobj.write(b'a')
+            FS = pgs.app.DirectoryRepositoryFS({'pgs.root_path': path})
+            self.assertEqual(pgs.app.resolve_path(FS, '/a')[1].path, 'a.html')
+            self.assertEqual(FS.lookup('/a').path, 'a.html')
+            os.mkdir(os.path.join(path, 'a'))
+            self.assertIsNone(FS.lookup('/a'))
+            self.assertIsNone(pgs.app.resolve_path(FS, '/a')[1])
+            with open(os.path.join(path, 'a', 'index.html'), 'wb') as f:
+                f.write(b'index')
+            path_, resource = pgs.app.resolve_path(FS, '/a')
+            self.assertEqual(resource.path, 'a/index.html')
+        finally:
+            shutil.rmtree(path)
+
 
 class TestSubprocessGitRepositoryFS(TestDirectoryRepositoryFS):
     Class = pgs.app.SubprocessGitRepositoryFS
     conf = {'pgs.git_repo_path': GIT_REPO_PATH,
             'pgs.git_repo_rev': 'pgs-test'}
 
+    def test_100_get_tree_entry_quoted(self):
+        path = tempfile.mkdtemp(prefix='pgs-test-')
+        name = u'caf\xe9 "x".txt'
+        try:
+            git = ['git', '-C', path, '-c', 'user.name=t',
+                   '-c', 'user.email=t@t']
+            subprocess.check_call(git + ['init', '-q'])
+            with open(os.path.join(path, name).encode('utf-8'),
+                      'wb') as fileobj:
+                fileobj.write(b'x')
+            subprocess.check_call(git + ['add', '.'])
+            subprocess.check_call(git + ['commit', '-q', '-m', 'x'])
+            FS = self.Class({'pgs.git_repo_path': path,
+                             'pgs.git_repo_rev': 'HEAD',
+                             'pgs.git_index': False})
+            if bytes is str:
+                name = name.encode('utf-8')
+            entry = FS.get_tree_entry(name)
+            self.assertEqual((entry[1], entry[3]), ('blob', '1'))
+        finally:
+            shutil.rmtree(path)
+
+    def test_110_lookup_cached(self):
+        self.assertIsNone(self.FS.lookup_cached('/a/b'))
+        pgs.app.resolve_path(self.FS, '/a/b')
+        resource = self.FS.lookup_cached('/a/b')
+        self.assertEqual(resource.path, 'a/b/index.html')
+        self.FS._snapshot_checked = 0
+        self.assertIsNone(self.FS.lookup_cached('/a/b'))
+        self.assertEqual(self.FS._snapshot_checked, 0)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'pgs.aio requires Python >= 3.7')
+class TestAsyncGitRepositoryFS(unittest.TestCase):
+
+    conf = TestSubprocessGitRepositoryFS.conf
+
+    def setUp(self):
+        import asyncio
+        import pgs.aio
+        self.FS = pgs.aio.AsyncGitRepositoryFS(dict(self.conf))
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.FS.aclose())
+        self.loop.close()
+
+    def read(self, path):
+        resource = self.loop.run_until_complete(self.FS.stat(path))
+        blob = self.loop.run_until_complete(self.FS.open(resource))
+        chunks = []
+        while True:
+            chunk = self.loop.run_until_complete(blob.read(4))
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.loop.run_until_complete(blob.close())
+        return resource, b''.join(chunks)
+
+    def test_stat_open(self):
+        resource, body = self.read('index.html')
+        self.assertEqual(body, b'awesome\n')
+        self.assertEqual(resource.size, len(body))
+        self.assertTrue(self.FS.metadata_ready())
+        batch = self.FS._batch
+        self.assertTrue(batch)
+        resource, body = self.read('a/b/c')
+        self.assertIs(self.FS._batch, batch)
+        self.assertIsNone(
+            self.loop.run_until_complete(self.FS.stat('does-not-exist')))
+
+    def test_open_streamed(self):
+        self.FS.conf['pgs.git_batch_max_size'] = 0
+        self.FS.limiter = ProcessLimiter(max_processes=1)
+        resource = self.loop.run_until_complete(self.FS.stat('index.html'))
+        blob = self.loop.run_until_complete(self.FS.open(resource))
+        self.assertFalse(self.FS._slots.locked())  # spooled
+        self.loop.run_until_complete(blob.close())
+        resource, body = self.read('index.html')
+        self.assertEqual(body, b'awesome\n')
+        self.assertIsNone(self.FS._batch)
+
+    def test_put_blob_failure(self):
+        import asyncio
+
+        class BrokenBlobCache(object):
+            def put(self, sha, data):
+                raise IOError('disk full')
+
+        self.FS.blob_cache = BrokenBlobCache()
+        with self.assertLogs('pgs.aio', 'WARNING') as logs:
+            resource, body = self.read('index.html')
+            while self.FS._puts:
+                self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(body, b'awesome\n')
+        self.assertIn('disk full', logs.output[0])
+
+    def test_resolve(self):
+        path, resource = self.loop.run_until_complete(self.FS.resolve('/a/b'))
+        self.assertEqual(resource.path, 'a/b/index.html')
+
+    def test_read_blob_coalesced(self):
+        import asyncio
+        resource = self.loop.run_until_complete(self.FS.stat('index.html'))
+        sha = resource.etag.strip('"')
+        reads = [self.loop.create_task(self.FS.read_blob(sha))
+                 for i in range(3)]
+        results = self.loop.run_until_complete(asyncio.gather(*reads))
+        self.assertEqual(results, [b'awesome\n'] * 3)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(self.FS._reads, {})
+
+
+class TestProcessLimiter(unittest.TestCase):
+
+    def test_queue_timeout(self):
+        limiter = ProcessLimiter(max_processes=1, queue_timeout=0.01)
+        proc = limiter.popen(['sleep', '10'])
+        self.assertEqual(limiter.active, 1)
+        self.assertRaises(QueueTimeout, limiter.check_output, ['true'])
+        proc.close()
+        self.assertEqual(limiter.active, 0)
+        self.assertEqual(proc.proc.returncode, -signal.SIGKILL)
+        self.assertEqual(limiter.check_output(['echo', 'ok']), b'ok\n')
+        self.assertEqual(limiter.call(['false']), 1)
+        self.assertEqual(limiter.active, 0)
+
+    def test_streaming(self):
+        limiter = ProcessLimiter()
+        proc = limiter.popen(['yes'])
+        chunks = []
+        for chunk in proc:
+            chunks.append(chunk)
+            if len(chunks) == 3:
+                break
+        self.assertTrue(all(len(c) <= proc.chunk_size for c in chunks))
+        proc.close()
+        self.assertEqual(proc.proc.returncode, -signal.SIGKILL)
+        self.assertEqual(limiter.active, 0)
+
+        FS = pgs.app.SubprocessGitRepositoryFS(
+            TestSubprocessGitRepositoryFS.conf)
+        fileobj = FS.get_fileobj('index.html')
+        self.assertEqual(FS.limiter.active, 0)  # spooled
+        self.assertEqual(fileobj.read(), b'awesome\n')
+        fileobj.close()
+        self.assertEqual(FS.get_contents('a/b/c'),
+                         FS.get_fileobj('a/b/c').read())
+        self.assertRaises(subprocess.CalledProcessError,
+                          FS.get_contents, 'does-not-exist')
+        self.assertRaises(IOError, FS.get_fileobj, 'does-not-exist')
+        self.assertEqual(FS.limiter.active, 0)
+
+    def test_spool(self):
+        limiter = ProcessLimiter(max_processes=1, timeout=0.05,
+                                 retry_after=3)
+        fileobj = limiter.spool(['echo', 'ok'])
+        self.assertEqual(limiter.active, 0)
+        self.assertEqual(fileobj.read(), b'ok\n')
+        fileobj.close()
+        self.assertRaises(IOError, limiter.spool, ['false'])
+        self.assertRaises(ProcessTimeout, limiter.spool, ['sleep', '10'])
+        self.assertEqual(limiter.active, 0)
+
+    def test_process_timeout(self):
+        limiter = ProcessLimiter(timeout=0.05, retry_after=3)
+        try:
+            limiter.check_output(['sleep', '10'])
+        except ProcessTimeout as e:
+            self.assertEqual(e.retry_after, 3)
+        else:
+            self.fail('ProcessTimeout not raised')
+        self.assertEqual(limiter.active, 0)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(10)
+        self.assertTrue(cache.set('a', 'aaaa', 4))
+        self.assertTrue(cache.set('b', 'bbbb', 4))
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertTrue(cache.set('c', 'cccc', 4))
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.nbytes, 8)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertFalse(cache.set('d', 'd' * 11, 11))
+        self.assertEqual(cache.pop('a'), 'aaaa')
+        self.assertEqual(cache.nbytes, 4)
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_sizeof(self):
+        self.assertGreater(sizeof(('a', [b'x' * 100])), 100)
+        cache = LRUCache(overhead=10)
+        cache.set('a', b'x' * 100)
+        self.assertEqual(cache.nbytes, sizeof('a') + sizeof(b'x' * 100) + 10)
+
+
+class TestTinyLFUCache(unittest.TestCase):
+
+    def test_frequency_sketch(self):
+        sketch = FrequencySketch(width=64, sample_size=100)
+        for _ in range(3):
+            sketch.increment('a')
+        self.assertEqual(sketch.estimate('a'), 3)
+        for _ in range(20):
+            sketch.increment('b')
+        self.assertEqual(sketch.estimate('b'), FrequencySketch.max_count)
+        sketch.reset()
+        self.assertEqual(sketch.estimate('a'), 1)
+
+    def test_scan_resistance(self):
+        cache = TinyLFUCache(100)
+        hot = ['h%d' % i for i in range(4)]
+        for key in hot:
+            self.assertIsNone(cache.get(key))
+            cache.set(key, key, 20)
+        for _ in range(3):
+            for key in hot:
+                self.assertEqual(cache.get(key), key)
+        for i in range(50):
+            key = 'crawl%d' % i
+            self.assertIsNone(cache.get(key))
+            cache.set(key, key, 20)
+            self.assertLessEqual(cache.nbytes, 100)
+        for key in hot:
+            self.assertIn(key, cache)
+        self.assertGreaterEqual(cache.rejections, 49)
+
+        for _ in range(6):
+            cache.get('new')
+        cache.set('new', 'new', 20)
+        cache.set('crawl', 'crawl', 20)
+        self.assertIn('new', cache)
+        self.assertEqual(sum(key in cache for key in hot), 3)
+        self.assertEqual(cache.pop('new'), 'new')
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+
+class TestDiskBlobCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='pgs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_open(self):
+        cache = DiskBlobCache(self.path)
+        sha = 'ab' * 20
+        self.assertIsNone(cache.open(sha))
+        self.assertTrue(cache.put(sha, b'blob'))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.path, 'ab', 'ab' * 19)))
+        with cache.open(sha) as fileobj:
+            self.assertEqual(fileobj.read(), b'blob')
+        self.assertEqual((cache.hits, cache.misses, cache.stored), (1, 1, 1))
+
+    def test_tee(self):
+        cache = DiskBlobCache(self.path)
+        tee = cache.tee('cd' * 20, 8, io.BytesIO(b'12345678'))
+        self.assertEqual(tee.read(4), b'1234')
+        tee.close()
+        self.assertIsNone(cache.open('cd' * 20))
+        self.assertEqual(os.listdir(self.path), [])
+        with cache.tee('cd' * 20, 8, io.BytesIO(b'12345678')) as tee:
+            self.assertEqual(b''.join(tee), b'12345678')
+        with cache.open('cd' * 20) as fileobj:
+            self.assertEqual(fileobj.read(), b'12345678')
+
+    def test_cleanup(self):
+        cache = DiskBlobCache(self.path, max_bytes=10000, low_water=0.7)
+        now = time.time()
+        for i, sha in enumerate(['01' * 20, '02' * 20, '03' * 20]):
+            cache.put(sha, b'x' * 100)
+            os.utime(cache.blob_path(sha), (now - 100 + i, now - 100 + i))
+        cache.open('01' * 20).close()
+        cache.put('04' * 20, b'x' * 100)
+        tmp = os.path.join(self.path, '.tmp-abandoned')
+        open(tmp, 'w').close()
+        os.utime(tmp, (now - 7200, now - 7200))
+        self.assertEqual(cache.cleanup(), 0)
+        self.assertFalse(os.path.exists(tmp))
+        cache.max_bytes = 300
+        self.assertEqual(cache.cleanup(), 200)
+        self.assertIsNone(cache.open('02' * 20))
+        self.assertIsNone(cache.open('03' * 20))
+        self.assertEqual(cache.cleanup(), 0)
+
+    def test_git_repository_fs(self):
+        FS = pgs.app.SubprocessGitRepositoryFS(dict(
+            confs['git0'], **{'pgs.blob_cache_path': self.path}))
+        resource = FS.get_resource('a/b/index.html')
+        self.assertIsNone(FS.open_cached(resource))
+        fileobj = FS.open_resource(resource)
+        self.assertEqual(fileobj.read(), b'here\n')
+        fileobj.close()
+        fileobj = FS.open_cached(resource)
+        self.assertEqual(fileobj.read(), b'here\n')
+        fileobj.close()
+
+
+class TestIndexCache(unittest.TestCase):
+
+    conf = confs['git0']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='pgs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_dump_load(self):
+        name = u'\xe9.html'
+        if bytes is str:
+            name = name.encode('utf-8')
+        index = {'': ('040000', 'tree', 'ab' * 20, '-'),
+                 'a': ('040000', 'tree', 'cd' * 20, '-'),
+                 'a/b.txt': ('100644', 'blob', 'ef' * 20, '12'),
+                 name: ('100644', 'blob', '01' * 20, '0')}
+        mtimes = {'a/b.txt': 1500000000}
+        fileobj = io.BytesIO()
+        dump_index(fileobj, index, mtimes)
+        mapped = MappedIndex(fileobj.getvalue())
+        self.assertEqual(len(mapped), 4)
+        self.assertEqual(dict(mapped.items()), index)
+        self.assertEqual(dict(mapped.mtimes.items()), mtimes)
+        self.assertEqual(mapped['a/b.txt'], index['a/b.txt'])
+        self.assertEqual(mapped.get(name), index[name])
+        self.assertIsNone(mapped.get('a/b'))
+        self.assertNotIn('b.txt', mapped)
+        self.assertEqual(mapped.mtimes.get('a/b.txt'), 1500000000)
+        self.assertIsNone(mapped.mtimes.get('a'))
+        self.assertRaises(KeyError, lambda: mapped.mtimes[name])
+        self.assertRaises(ValueError, MappedIndex, b'PGSX')
+        self.assertRaises(ValueError, dump_index, io.BytesIO(),
+                          {'': ('040000', 'tree', 'xyz', '-')}, {})
+
+    def test_git_repository_fs(self):
+        conf = dict(self.conf, **{'pgs.index_cache_path': self.path})
+        FS = pgs.app.SubprocessGitRepositoryFS(conf)
+        mtimes = dict(FS.get_mtimes().items())
+        commit = FS.snapshot()
+        self.assertTrue(os.path.exists(FS.index_cache.index_path(commit)))
+        self.assertIsInstance(FS.get_index(), MappedIndex)
+
+        FS = pgs.app.SubprocessGitRepositoryFS(conf)
+        cmds = []
+        check_output = FS.limiter.check_output
+        FS.limiter.check_output = lambda cmd, **kw: (
+            cmds.append(cmd[3]) or check_output(cmd, **kw))
+        self.assertEqual(dict(FS.get_mtimes().items()), mtimes)
+        self.assertEqual(FS.get_resource('a/b/index.html').size, 5)
+        self.assertEqual(cmds, ['rev-parse'])
+
+        cache = IndexCache(self.path, keep=1)
+        cache.save('0' * 40, FS.get_index(), mtimes)
+        self.assertEqual(os.listdir(self.path), ['0' * 40 + '.idx'])
+        self.assertIsNone(cache.load(commit))
+        self.assertEqual(FS.get_index()[''][2], commit)
+
+
+class TestCompactIndex(unittest.TestCase):
+
+    def test_compact_index(self):
+        commit = 'ab' * 20
+        output = ('040000 tree %s       -\ta\0'
+                  '100644 blob %s      12\ta/b.txt\0'
+                  '100644 blob %s       0\ta/a\0'
+                  '160000 commit %s     -\tc\0') % (
+                      'cd' * 20, 'ef' * 20, '01' * 20, '23' * 20)
+        index = pgs.app.parse_ls_tree(output, commit)
+        self.assertIsInstance(index, CompactIndex)
+        self.assertEqual(dict(index.items()), {
+            '': ('040000', 'tree', commit, '-'),
+            'a': ('040000', 'tree', 'cd' * 20, '-'),
+            'a/b.txt': ('100644', 'blob', 'ef' * 20, '12'),
+            'a/a': ('100644', 'blob', '01' * 20, '0'),
+            'c': ('160000', 'commit', '23' * 20, '-')})
+        self.assertEqual(index.segment_count, 4)
+        self.assertEqual(len(index.kind_values), 3)
+        entry = index['a/b.txt']
+        self.assertIsInstance(entry, IndexEntry)
+        self.assertEqual((entry.mode, entry.type, entry.size),
+                         ('100644', 'blob', '12'))
+        mode, type_, sha, size = entry
+        self.assertEqual(sha, 'ef' * 20)
+        self.assertEqual(entry[-3:], ('blob', 'ef' * 20, '12'))
+        self.assertEqual(hash(entry), hash(tuple(entry)))
+        self.assertNotEqual(entry, index['a/a'])
+        self.assertIsNone(index.get('a/c'))
+        self.assertIsNone(index.get('a/b.txt/x'))
+        self.assertNotIn('b.txt', index)
+        self.assertRaises(KeyError, lambda: index['x'])
+        self.assertRaises(ValueError, index.add, 'x',
+                          ('100644', 'blob', 'ab' * 32, '1'))
+
+        index.add('d/e/f', ('100644', 'blob', '45' * 20, '3'))
+        self.assertEqual(index['d/e'][1], 'tree')
+        for i in range(100):
+            index.add('d/%d' % i, ('100644', 'blob', '67' * 20, str(i)))
+        self.assertEqual(len(index), 108)
+        self.assertEqual(index['d/42'][3], '42')
+        self.assertEqual(index['d/e/f'][2], '45' * 20)
+
+        parser = pgs.app.MtimesParser(index)
+        parser.feed(b'\x011500000000\0\na/b.txt\0d/e/f\0')
+        self.assertIs(parser.mtimes, index.mtimes)
+        self.assertEqual(dict(index.mtimes.items()),
+                         {'a/b.txt': 1500000000, 'd/e/f': 1500000000})
+        self.assertIsNone(index.mtimes.get('a/a'))
+
+        # sizes and mtimes which do not fit in 32 bits
+        index.add('big', ('100644', 'blob', '89' * 20, str(2 ** 33)))
+        index.mtimes['big'] = 2 ** 32 + 5
+        self.assertEqual(index['big'][3], str(2 ** 33))
+        self.assertEqual(index.mtimes['big'], 2 ** 32 + 5)
+        index.add('big', ('100755', 'blob', '89' * 20, '5'))
+        index.mtimes['big'] = 1500000000
+        self.assertEqual(index['big'], ('100755', 'blob', '89' * 20, '5'))
+        self.assertEqual((index.wide_sizes, index.wide_mtimes), ({}, {}))
+
+        fileobj = io.BytesIO()
+        dump_index(fileobj, index, index.mtimes)
+        mapped = MappedIndex(fileobj.getvalue())
+        self.assertEqual(dict(mapped.items()), dict(index.items()))
+
+    def test_bytes_per_path(self):
+        paths = ['dir%d/sub%d/file-%d.html' % (i // 1000, i // 100, i)
+                 for i in range(20000)]
+        try:
+            import tracemalloc
+        except ImportError:  # Python 2: the storage is in the columns
+            tracemalloc = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+        index = CompactIndex()
+        for path in paths:
+            index.add(path, ('100644', 'blob', 'ab' * 20, '10'))
+        index.compact()
+        if tracemalloc is not None:
+            nbytes = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+        else:
+            nbytes = sum(sys.getsizeof(getattr(index, name))
+                         for name in CompactIndex.__slots__)
+        self.assertLess(nbytes / len(paths), 72)  # 20 are the object id
+        self.assertEqual(index['dir3/sub35/file-3512.html'][3], '10')
+        self.assertIn('dir3/sub35/file-3512.html', list(index))
+
+
+class TestCacheBudget(unittest.TestCase):
+
+    def test_budget(self):
+        budget = CacheBudget(100, decay_interval=60)
+        hot = budget.register('hot', LRUCache(), weight=1)
+        cold = budget.register('cold', LRUCache(), weight=1)
+        for key in 'abc':
+            hot.set(key, key, 20)
+        hot.get('a')
+        cold.set('x', 'x', 20)
+        cold.set('y', 'y', 20)
+        self.assertEqual(budget.nbytes, 100)
+        cold.set('z', 'z', 20)
+        self.assertEqual(budget.nbytes, 100)
+        self.assertEqual(len(hot), 3)
+        self.assertNotIn('x', cold)
+        self.assertEqual(budget.evictions, 1)
+        self.assertFalse(cold.set('big', 'big', 101))
+
+        budget.shares['cold'].share = 0.6
+        hot.set('d', 'd', 20)
+        self.assertNotIn('b', hot)
+        self.assertEqual(len(cold), 2)
+        stats = budget.stats()
+        self.assertEqual(stats['hot']['hits'], 1)
+        self.assertEqual(stats['hot']['evictions'], 1)
+
+    def test_decay(self):
+        budget = CacheBudget(100, decay_interval=10)
+        cache = budget.register('cache', LRUCache())
+        cache.set('a', 'a', 10)
+        for _ in range(4):
+            cache.get('a')
+        budget.decay(now=budget._decayed + 10)
+        self.assertEqual(budget.shares['cache'].score, 2)
+        self.assertEqual(budget.shares['cache'].density(), 0.2)
+
+    def test_repository_fs(self):
+        FS = pgs.app.DirectoryRepositoryFS(
+            dict(confs['fs0'], **{'pgs.cache_size': 4096}))
+        self.assertIs(FS.responses.budget, FS.caches)
+        resource = FS.get_resource('index.html')
+        self.assertIsNotNone(pgs.app.cached_response(FS, resource))
+        self.assertEqual(set(FS.caches.stats()),
+                         set(['resources', 'resolutions', 'responses',
+                              'dirlists', 'html_assets']))
+        self.assertLessEqual(FS.caches.nbytes, 4096)
+        self.assertGreater(FS.caches.nbytes, 0)
+
+
+class TestInvalidation(unittest.TestCase):
+
+    conf = confs['git0']
+
+    def test_parse_diff_tree(self):
+        output = 'M\0a\0A\0a/b.html\0D\0c\0'
+        self.assertEqual(pgs.app.parse_diff_tree(output),
+                         {'a': 'M', 'a/b.html': 'A', 'c': 'D'})
+        self.assertEqual(pgs.app.parse_diff_tree(''), {})
+
+    def test_git_repository_fs(self):
+        FS = pgs.app.SubprocessGitRepositoryFS(dict(self.conf))
+        commit = FS.snapshot()
+        self.assertEqual(FS.diff_snapshot(commit, commit), {})
+        self.assertIsNone(FS.diff_snapshot(commit, '0' * 40))
+        for url_path in ('/', 'a/b'):
+            _, resource = pgs.app.resolve_path(FS, url_path)
+            pgs.app.cached_response(FS, resource)
+        FS.get_resource('a/b/c')
+        for path in ('/', 'a/', 'a/b/'):
+            FS.dirlists.set(path, ['<table class="dirlist">'])
+
+        changes = {'a': 'M', 'a/b': 'M', 'a/b/index.html': 'M',
+                   'a/b.html': 'A'}
+        FS.set_snapshot('0' * 40, time.time(), changes)
+        self.assertIn('index.html', FS._resources)
+        self.assertIn('a/b/c', FS._resources)
+        self.assertNotIn('a/b/index.html', FS._resources)
+        self.assertEqual([key[0] for key in FS.responses._keys()],
+                         ['index.html'])
+        self.assertEqual(FS.resolutions.get('/'), 'index.html')
+        self.assertNotIn('a/b', FS.resolutions)
+        self.assertEqual(sorted(FS.dirlists._keys()), ['/', 'a/b/'])
+        self.assertIsNone(FS._index)
+
+        FS.set_snapshot(commit, time.time())
+        self.assertEqual(len(FS._resources), 0)
+        self.assertEqual(len(FS.dirlists), 0)
+
+
+class TestWarmup(unittest.TestCase):
+
+    conf = confs['git0']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='pgs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_parse_access_log(self):
+        lines = [
+            '1.2.3.4 - - [10/Oct/2026:13:55:36 +0000] '
+            '"GET /a/b?x=1 HTTP/1.1" 200 5 "-" "curl"',
+            '1.2.3.4 - - [10/Oct/2026:13:55:37 +0000] '
+            '"HEAD /%C3%A9.html HTTP/1.0" 304 -',
+            '1.2.3.4 - - [10/Oct/2026:13:55:38 +0000] '
+            '"GET /missing HTTP/1.1" 404 9',
+            '1.2.3.4 - - [10/Oct/2026:13:55:39 +0000] '
+            '"POST /a/b HTTP/1.1" 200 5',
+            'garbage']
+        name = u'/\xe9.html'
+        if bytes is str:
+            name = name.encode('utf-8')
+        self.assertEqual(list(parse_access_log(lines)), ['/a/b', name])
+
+        log_path = os.path.join(self.path, 'access.log')
+        with open(log_path, 'w') as fileobj:
+            for url_path in ['/', '/a/b', '/', '/index.html', '/a/b', '/a/b']:
+                fileobj.write('- - - [-] "GET %s HTTP/1.1" 200 1\n'
+                              % url_path)
+        self.assertEqual(read_access_log(log_path, top=2),
+                         ['/a/b', '/'])
+        self.assertEqual(read_access_log(log_path, max_bytes=40), ['/a/b'])
+        self.assertEqual(read_access_log(log_path + '.x'), [])
+
+    def test_path_sampler(self):
+        sampler = PathSampler(every=2, size=3)
+        for url_path in ['/a', '/a', '/b', '/b', '/b', '/b']:
+            sampler.record(url_path)
+        self.assertEqual(sampler.top(), ['/b', '/a'])
+        sampler.every = 1
+        for url_path in ['/c', '/d']:
+            sampler.record(url_path)
+        self.assertEqual(sampler.top(), ['/b'])
+        self.assertIsNone(PathSampler.from_conf({}))
+
+    def test_warm(self):
+        conf = dict(self.conf, **{'pgs.blob_cache_path': self.path})
+        FS = pgs.app.SubprocessGitRepositoryFS(conf)
+        self.assertEqual(warm(FS, ['/', '/a/b', '/a/b/c', '/missing']), 3)
+        self.assertEqual(FS.resolutions.get('/a/b'), 'a/b/index.html')
+        self.assertEqual(len(FS.responses), 3)
+        resource = FS.lookup('/a/b/c')
+        self.assertIsNotNone(FS.open_cached(resource))
+
+    def test_warm_auto(self):
+        FS = pgs.app.SubprocessGitRepositoryFS(
+            dict(self.conf, **{'pgs.warm_auto': True}))
+        FS.sampler.every = 1
+        commit = FS.snapshot()
+        for url_path in ['/a/b', '/a/b', '/']:
+            FS.lookup(url_path)
+        self.assertEqual(len(FS.resolutions), 0)
+        FS.set_snapshot('0' * 40, time.time(), {})
+        FS.set_snapshot(commit, time.time(), {'a/b/index.html': 'M'})
+        for _ in range(100):
+            if len(FS.resolutions) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(FS.resolutions.get('/a/b'), 'a/b/index.html')
+        self.assertEqual(FS.resolutions.get('/'), 'index.html')
+
+
+class TestPrefetch(unittest.TestCase):
+
+    html = b"""<!DOCTYPE html>
+<html><head>
+<link rel="stylesheet" href="style.css?v=2">
+<link rel="preload" href="/fonts/a.woff2" as="font" crossorigin>
+<link rel="alternate" href="/feed.xml">
+<link rel="icon" href="https://example.org/favicon.ico">
+<script src="../js/app.js"></script>
+<script>var x = "<img src=no.png>";</script>
+</head><body>
+<a href="/other.html">other</a>
+<img src="img/a%20b.png"/><img src="//cdn.example.org/x.png">
+<img src="data:image/png;base64,AAAA"><img src="style.css">
+</body></html>"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='pgs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_parse_assets(self):
+        self.assertEqual(parse_assets(self.html, 'a/index.html'), (
+            ('/a/style.css', 'style'),
+            ('/fonts/a.woff2', 'font'),
+            ('/js/app.js', 'script'),
+            ('/a/img/a b.png', 'image')))
+        self.assertEqual(parse_assets(b'<img src=', 'index.html'), ())
+
+    def test_prefetch(self):
+        os.makedirs(os.path.join(self.path, 'a', 'img'))
+        for name, data in [('a/index.html', self.html),
+                           ('a/style.css', b'body {}'),
+                           ('a/img/a b.png', b'png')]:
+            with open(os.path.join(self.path, name), 'wb') as fileobj:
+                fileobj.write(data)
+        FS = pgs.app.DirectoryRepositoryFS(
+            {'pgs.root_path': self.path, 'pgs.prefetch': True})
+        resource = FS.get_resource('a/index.html')
+        for _ in range(2):
+            pgs.app.cached_response(FS, resource)
+            FS.prefetcher.queue.join()
+        self.assertEqual(len(FS.html_assets), 1)
+        self.assertEqual(FS.prefetcher.prefetched, 2)
+        self.assertEqual(len(FS.prefetcher.missing), 2)
+        self.assertEqual(FS.resolutions.get('/a/style.css'), 'a/style.css')
+        self.assertIsNotNone(FS.lookup('/a/img/a b.png'))
+        self.assertEqual(len(FS.responses), 3)
+
+    def test_preload(self):
+        os.makedirs(os.path.join(self.path, 'a'))
+        with open(os.path.join(self.path, 'a', 'index.html'), 'wb') as f:
+            f.write(self.html)
+        FS = pgs.app.DirectoryRepositoryFS(
+            {'pgs.root_path': self.path, 'pgs.early_hints': True})
+        resource = FS.get_resource('a/index.html')
+        self.assertEqual(pgs.app.response_headers(FS, resource),
+                         list(resource.headers))
+        self.assertEqual(pgs.app.early_hints(FS, resource), ())
+        link = ('</a/style.css>; rel=preload; as=style, '
+                '</fonts/a.woff2>; rel=preload; as=font; crossorigin, '
+                '</js/app.js>; rel=preload; as=script')
+        _, headers, _ = pgs.app.cached_response(FS, resource)
+        self.assertEqual(dict(headers)['Link'], link)
+        self.assertEqual(
+            dict(pgs.app.response_headers(FS, resource))['Link'], link)
+        self.assertEqual(pgs.app.early_hints(FS, resource), ())
+        FS.responses.clear()
+        self.assertEqual(pgs.app.early_hints(FS, resource), (('Link', link),))
+
+    def test_early_hints(self):
+        def app(environ, start_response):
+            sent = environ['wsgi.early_hints']([('Link', '</a.css>')])
+            start_response('200 OK', [('Content-Length', '1')])
+            return [b'1' if sent else b'0']
+
+        srv = ThreadPoolWSGIServer(('127.0.0.1', 0), app, threads=1,
+                                   quiet=True)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.daemon = True
+        thread.start()
+        sock = socket.create_connection(('127.0.0.1', srv.server_port))
+        try:
+            sock.settimeout(10)
+            sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                         b'GET / HTTP/1.0\r\n\r\n')
+            output = b''
+            while True:  # the HTTP/1.0 request closes the connection
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                output += chunk
+        finally:
+            sock.close()
+            srv.shutdown()
+            srv.server_close()
+        self.assertTrue(output.startswith(
+            b'HTTP/1.1 103 Early Hints\r\nLink: </a.css>\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(output.count(b'103 Early Hints'), 1)
+        self.assertTrue(output.endswith(b'\r\n\r\n0'))
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_admit(self):
+        admission = AdmissionController(max_inflight=1, max_wait=0.01)
+        admission.admit()
+        self.assertRaises(Overloaded, admission.admit)
+        admission.release()
+        admission.admit()
+        admission.release()
+        self.assertEqual(admission.inflight, 0)
+        self.assertEqual(admission.shed, 1)
+
+    def test_codel(self):
+        admission = AdmissionController(target=0.05, interval=0.1)
+        self.assertFalse(admission._should_drop(0.06, 0.0))
+        self.assertFalse(admission._should_drop(0.06, 0.05))
+        self.assertTrue(admission._should_drop(0.06, 0.11))
+        self.assertTrue(admission.dropping)
+        self.assertFalse(admission._should_drop(0.06, 0.12))
+        self.assertTrue(admission._should_drop(0.06, 0.22))
+        self.assertFalse(admission._should_drop(0.06, 0.23))
+        # drops get more frequent: interval / sqrt(count)
+        self.assertTrue(admission._should_drop(0.06, 0.22 + 0.1 / 2 ** 0.5))
+        self.assertFalse(admission._should_drop(0.01, 0.4))
+        self.assertFalse(admission.dropping)
+
+    def test_admitted_file(self):
+        released = []
+        result = FileWrapper(io.BytesIO(b'data'))
+        response = pgs.app.AdmittedResponse.wrap(
+            result, lambda: released.append(1), FileWrapper)
+        self.assertIs(response, result)  # still sent with sendfile
+        response.close()
+        response.close()
+        self.assertTrue(result.filelike.closed)
+        self.assertEqual(released, [1])
+        response = pgs.app.AdmittedResponse.wrap(
+            [b'data'], lambda: released.append(2), FileWrapper)
+        self.assertIsInstance(response, pgs.app.AdmittedResponse)
+        response.close()
+        self.assertEqual(released, [1, 2])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(1, burst=12, max_clients=2,
+                              header='X-Forwarded-For')
+        client = limiter.client({'REMOTE_ADDR': '10.0.0.1',
+                                 'HTTP_X_FORWARDED_FOR': '192.0.2.1'})
+        self.assertEqual(client, '192.0.2.1')
+        self.assertEqual(limiter.client({'REMOTE_ADDR': '10.0.0.1'}),
+                         '10.0.0.1')
+        for i in range(12):
+            limiter.charge(client, 'cached')
+        try:
+            limiter.charge(client, 'cached')
+        except RateLimited as e:
+            self.assertEqual(e.status[:3], '429')
+            self.assertEqual(e.retry_after, 1)
+        else:
+            self.fail('RateLimited not raised')
+        limiter.charge('192.0.2.2', 'uncached')
+        limiter.charge('192.0.2.2', 'dirlist')
+        self.assertRaises(RateLimited, limiter.charge, '192.0.2.2', 'dirlist')
+        limiter.charge('192.0.2.3', 'cached')
+        limiter.charge('192.0.2.3', 'uncached', paid='cached')
+        limiter.charge('192.0.2.3', 'dirlist')
+        self.assertRaises(RateLimited, limiter.charge, '192.0.2.3', 'cached')
+        self.assertEqual(len(limiter), 2)
+        self.assertIsNone(RateLimiter.from_conf({}))
+
+    def test_burst(self):
+        self.assertEqual(RateLimiter(2).burst, 20)
+        self.assertEqual(RateLimiter(0.5).burst, 12)
+        self.assertEqual(RateLimiter(0.5, burst=2).burst, 12)
+        self.assertEqual(RateLimiter(0.5, costs={'dirlist': 20}).burst, 24)
+        limiter = RateLimiter(0.1)
+        limiter.charge('192.0.2.1', 'cached')
+        limiter.charge('192.0.2.1', 'uncached', paid='cached')
+        limiter.charge('192.0.2.1', 'dirlist')
+
+    def test_spoofed_forwarded_for(self):
+        limiter = RateLimiter(1, burst=12, header='X-Forwarded-For')
+        for i in range(12):
+            environ = {'HTTP_X_FORWARDED_FOR': '198.51.100.%d, 192.0.2.1' % i}
+            self.assertEqual(limiter.client(environ), '192.0.2.1')
+            limiter.charge(limiter.client(environ), 'cached')
+        environ['HTTP_X_FORWARDED_FOR'] = '198.51.100.99, 192.0.2.1'
+        self.assertRaises(RateLimited, limiter.charge,
+                          limiter.client(environ), 'cached')
+        limiter = RateLimiter(1, header='X-Forwarded-For', proxies=2)
+        self.assertEqual(limiter.client({
+            'HTTP_X_FORWARDED_FOR': '198.51.100.1, 192.0.2.1, 10.0.0.2'}),
+            '192.0.2.1')
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started, proceed = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def fetch(value):
+            calls.append(value)
+            started.set()
+            proceed.wait(10)
+            if value is None:
+                raise KeyError(value)
+            return [value]
+
+        def request(value):
+            try:
+                results.append(flights.do(('key', value), fetch, value))
+            except KeyError as e:
+                results.append(e)
+
+        for value in ('a', None):
+            del calls[:], results[:]
+            started.clear()
+            proceed.clear()
+            threads = [threading.Thread(target=request, args=(value,))
+                       for i in range(4)]
+            threads[0].start()
+            started.wait(10)
+            for thread in threads[1:]:
+                thread.start()
+            while flights.coalesced < 3:
+                time.sleep(0.01)
+            proceed.set()
+            for thread in threads:
+                thread.join(10)
+            self.assertEqual(calls, [value])
+            self.assertEqual(len(results), 4)
+            self.assertTrue(all(r is results[0] for r in results))
+            self.assertEqual(len(flights), 0)
+            flights.coalesced = 0
+
+
+class TestCacheControlPolicy(unittest.TestCase):
+
+    def test_is_fingerprinted(self):
+        for path in ['app.3f9a1c7e.js', '/static/css/main.8c8b27cf.css',
+                     'index-BvH3kZ9qLm.js', 'a/b/vendor-0d3f5e6b7a.min.js',
+                     'chunk-vendors.k3x9p2m4q7.js']:
+            self.assertTrue(is_fingerprinted(path), path)
+        for path in ['index.html', 'app.js', 'jquery-3.3.1.min.js',
+                     'app.decade.js', 'select2-bootstrap4.css',
+                     'app.3f9a1c7e', 'a.3f9a1c7e/index.html',
+                     'Report-Version2.html', 'about-Company1.html',
+                     'photo-facade12.jpg', 'logo-Summer24.png',
+                     'backup-20240101.tar.gz', 'a-deadbeefcafe.js']:
+            self.assertFalse(is_fingerprinted(path), path)
+
+    def test_policy(self):
+        policy = CacheControlPolicy(
+            rules=['*.html=no-cache',
+                   ('re:^docs/', {'max-age': 60,
+                                  'stale-while-revalidate': 30}),
+                   'mime:image/*=public, max-age=86400'],
+            default='max-age=300')
+        self.assertEqual(policy('/index.html', 'text/html'), 'no-cache')
+        self.assertEqual(policy('/a/b/index.html', 'text/html'), 'no-cache')
+        self.assertEqual(policy('docs/a.txt', 'text/plain'),
+                         'max-age=60, stale-while-revalidate=30')
+        self.assertEqual(policy('a/logo.png', 'image/png'),
+                         'public, max-age=86400')
+        self.assertEqual(policy('a/b/c', None), 'max-age=300')
+        self.assertEqual(policy('app.3f9a1c7e.js', 'application/javascript'),
+                         IMMUTABLE)
+        self.assertEqual(policy('index.3f9a1c7e.html', 'text/html'),
+                         'no-cache')
+        self.assertEqual(policy('index.3f9a1c7e.html'), 'no-cache')
+        self.assertEqual(CacheControlPolicy()('index.3f9a1c7e.htm'), None)
+        policy = CacheControlPolicy(fingerprinted=None)
+        self.assertIsNone(policy('app.3f9a1c7e.js', 'application/javascript'))
+
 
 class TestPgsApp(unittest.TestCase):
 
@@ -225,12 +1201,39 @@ class TestPgsApp(unittest.TestCase):
         fs = app.config.get('pgs.FS')
         self.assertTrue(fs)
 
+    def test_conf_from_environ(self):
+        conf = pgs.app.conf_from_environ({
+            'PGS_GIT_REPO_PATH': GIT_REPO_PATH, 'PGS_ROOT_PATH': ''})
+        self.assertEqual(conf, {
+            'pgs.git_repo_path': GIT_REPO_PATH,
+            'pgs.git_repo_rev': pgs.app.GIT_REPO_REV_DEFAULT})
+
 
 # WebTest WSGI tests
 
 import webtest
 
 
+class TestCreateApp(unittest.TestCase):
+
+    conf = confs['git0']
+
+    def test_create_app(self):
+        wsgi_app = pgs.app.create_app(dict(self.conf))
+        app = wsgi_app.app
+        self.assertIsNot(app, pgs.app.app)
+        self.assertIsNone(app.config['pgs.FS'])
+        rsp = webtest.TestApp(wsgi_app).get('/a/b/')
+        self.assertEqual(rsp.text, u'here\n')
+        FS = app.config['pgs.FS']
+        self.assertTrue(FS)
+
+        pgs.app.on_post_fork()
+        self.assertIs(app.config['pgs.FS'], FS)
+        self.assertEqual(len(FS.resolutions), 0)
+        pgs.app.on_worker_exit()
+
+
 class TestWebPgs_SubprocessGitRepositoryFS(unittest.TestCase):
 
     conf = confs['git0']
@@ -255,11 +1258,511 @@ class TestWebPgs_SubprocessGitRepositoryFS(unittest.TestCase):
             rsp = self.app.get(url)
             rsp.mustcontain(u'class="dirlist"')
 
+    def test_conditional(self):
+        rsp = self.app.get('/index.html')
+        etag = rsp.headers['ETag']
+        last_modified = rsp.headers['Last-Modified']
+        self.app.get('/index.html',
+                     headers={'If-None-Match': etag}, status=304)
+        self.app.get('/index.html',
+                     headers={'If-None-Match': 'W/' + etag}, status=304)
+        self.app.get('/index.html',
+                     headers={'If-None-Match': 'WW/' + etag}, status=200)
+        self.app.get('/index.html',
+                     headers={'If-Modified-Since': last_modified},
+                     status=304)
+        rsp = self.app.get('/index.html',
+                           headers={'If-None-Match': '"other"'})
+        self.assertEqual(rsp.text, u'awesome\n')
+
+    def test_cache_control(self):
+        rsp = self.app.get('/index.html')
+        self.assertNotIn('Cache-Control', rsp.headers)
+        FS = self.app.app.config['pgs.FS']
+        FS.reset()
+        FS.cache_policy = CacheControlPolicy(
+            rules=['*.html=no-cache'], default='max-age=60')
+        app = webtest.TestApp(pgs.app.make_wsgi_app(self.app.app))
+        for _ in range(2):
+            rsp = app.get('/index.html')
+            self.assertEqual(rsp.headers['Cache-Control'], 'no-cache')
+            rsp = app.get('/a/b/c')
+            self.assertEqual(rsp.headers['Cache-Control'], 'max-age=60')
+
+    def test_conditional_metadata_only(self):
+        rsp = self.app.get('/index.html')
+        etag = rsp.headers['ETag']
+        self.app.get('/a/b/c', headers={'If-None-Match': '"x"'})
+
+        def no_subprocess(*args, **kwargs):
+            raise AssertionError('subprocess: %r' % (args,))
+
+        subprocess = pgs.app.subprocess
+        _subprocess = dict(vars(subprocess))
+        FS = self.app.app.config['pgs.FS']
+        FS.conf['pgs.git_rev_ttl'] = 3600
+        try:
+            for name in ('call', 'check_output', 'Popen'):
+                setattr(subprocess, name, no_subprocess)
+            self.app.get('/', headers={'If-None-Match': etag}, status=304)
+            self.app.head('/a/b/index', status=200)
+            self.app.get('/a/b/index.html',
+                         headers={'If-Modified-Since':
+                                  'Fri, 01 Jan 2100 00:00:00 GMT'},
+                         status=304)
+        finally:
+            for name in ('call', 'check_output', 'Popen'):
+                setattr(subprocess, name, _subprocess[name])
+            del FS.conf['pgs.git_rev_ttl']
+
+    def test_fast_path(self):
+        bottle_app = self.app.app
+        fast_path = pgs.app.make_wsgi_app(bottle_app)
+        app = webtest.TestApp(fast_path)
+        responses = []
+
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+
+        environ = {'REQUEST_METHOD': 'HEAD', 'PATH_INFO': '/a/b'}
+        self.assertIsNone(fast_path.serve(environ, start_response))
+        rsp = app.get('/a/b')
+        self.assertEqual(rsp.text, u'here\n')
+        self.assertEqual(
+            bottle_app.config['pgs.FS'].resolutions.get('/a/b'),
+            'a/b/index.html')
+
+        self.assertEqual(fast_path.serve(environ, start_response), [])
+        status, headers = responses[-1]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], rsp.headers['ETag'])
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/a/b',
+                   'HTTP_IF_NONE_MATCH': rsp.headers['ETag']}
+        self.assertEqual(fast_path.serve(environ, start_response), [])
+        status, headers = responses[-1]
+        self.assertEqual(status, '304 Not Modified')
+        self.assertNotIn('Content-Length', headers)
+
+        rsp = app.get('/a/b')
+        self.assertEqual(rsp.text, u'here\n')
+        responses = bottle_app.config['pgs.FS'].responses
+        self.assertTrue(responses.hits)
+        rsp = app.get('/a/b/@@')
+        rsp.mustcontain(u'class="dirlist"')
+
+    def test_admission(self):
+        fast_path = pgs.app.make_wsgi_app(self.app.app)
+        app = webtest.TestApp(fast_path)
+        rsp = app.get('/index.html')
+        fast_path.admission = AdmissionController(max_inflight=0,
+                                                  max_wait=0, retry_after=2)
+        self.assertEqual(app.get('/index.html').text, u'awesome\n')
+        app.get('/index.html', headers={'If-None-Match': rsp.headers['ETag']},
+                status=304)
+        rsp = app.get('/a/b/@@', status=503)
+        self.assertEqual(rsp.headers['Retry-After'], '2')
+        FS = self.app.app.config['pgs.FS']
+        if isinstance(FS, pgs.app.SubprocessGitRepositoryFS):
+            FS._snapshot_checked = 0
+            app.get('/index.html', status=503)
+            self.assertEqual(FS._snapshot_checked, 0)
+        fast_path.admission = AdmissionController(max_inflight=1)
+        app.get('/a/b/@@')
+        self.assertEqual(fast_path.admission.inflight, 0)
+
+    def test_rate_limit(self):
+        fast_path = pgs.app.make_wsgi_app(self.app.app)
+        app = webtest.TestApp(fast_path)
+        fast_path.rate_limiter = RateLimiter(0.01)
+        app.get('/a/b/@@')
+        rsp = app.get('/index.html', status=429)
+        self.assertEqual(rsp.headers['Retry-After'], '100')
+        app.get('/index.html', extra_environ={'REMOTE_ADDR': '192.0.2.1'})
+
+    def test_unavailable(self):
+        FS = self.app.app.config['pgs.FS']
+        if not isinstance(FS, pgs.app.SubprocessGitRepositoryFS):
+            return
+        FS.reset()
+        FS.limiter = ProcessLimiter(max_processes=1, queue_timeout=0.01,
+                                    retry_after=7)
+        FS.limiter.acquire()
+        try:
+            rsp = self.app.get('/index.html', status=503)
+            self.assertEqual(rsp.headers['Retry-After'], '7')
+            rsp = webtest.TestApp(pgs.app.make_wsgi_app(self.app.app)).get(
+                '/index.html', status=503)
+        finally:
+            FS.limiter.release()
+        rsp = self.app.get('/index.html')
+        self.assertEqual(rsp.text, u'awesome\n')
+        self.assertEqual(FS.limiter.active, 0)
+
 
 class TestWebPgs_DirectoryRepositoryFS(TestWebPgs_SubprocessGitRepositoryFS):
 
     conf = confs['fs0']
 
 
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+class TestPreforkServer(unittest.TestCase):
+
+    conf = confs['fs0']
+
+    def test_prefork_server(self):
+        app = pgs.app.configure_app(pgs.app.app, self.conf)
+        port = get_free_port()
+        pid = os.fork()
+        if not pid:
+            try:
+                server = PreforkServer(
+                    host='127.0.0.1', port=port, workers=2,
+                    post_fork=functools.partial(
+                        pgs.app.post_fork, app))
+                server.quiet = True
+                server.run(pgs.app.make_wsgi_app(app))
+            finally:
+                os._exit(0)
+        try:
+            self.assertTrue(wait_for_port(port))
+            for url in ['/', '/a/b', '/a/b']:
+                rsp = urlopen('http://127.0.0.1:%d%s' % (port, url))
+                self.assertEqual(rsp.getcode(), 200)
+                self.assertTrue(rsp.read())
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_post_fork(self):
+        app = pgs.app.configure_app(pgs.app.app, self.conf)
+        FS = app.config['pgs.FS']
+        FS.resolutions.set('/x', 'x')
+        pgs.app.post_fork(app, 0)
+        self.assertEqual(len(FS.resolutions), 0)
+
+
+class TestThreadPoolWSGIServer(unittest.TestCase):
+
+    conf = confs['fs0']
+
+    def setUp(self):
+        app = pgs.app.configure_app(pgs.app.app, self.conf)
+        self.srv = ThreadPoolWSGIServer(('127.0.0.1', 0),
+                                        pgs.app.make_wsgi_app(app),
+                                        threads=2, quiet=True)
+        self.thread = threading.Thread(target=self.srv.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.srv.server_port
+
+    def tearDown(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+    def request(self, data):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(10)
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+        return b''.join(chunks)
+
+    def test_pipelining(self):
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            b'HEAD /a/b/c HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            b'GET /a/b/ HTTP/1.1\r\nHost: localhost\r\n'
+            b'Connection: close\r\n\r\n')
+        self.assertEqual(output.count(b'HTTP/1.1 200 OK\r\n'), 3)
+        self.assertEqual(output.count(b'Connection: close\r\n'), 1)
+        self.assertTrue(output.endswith(b'\r\n\r\nhere\n'))
+        self.assertIn(b'\r\n\r\nawesome\n', output)
+
+    def test_http10(self):
+        output = self.request(b'GET / HTTP/1.0\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Connection: close\r\n', output)
+        self.assertTrue(output.endswith(b'awesome\n'))
+
+    def test_file_response(self):
+        config = pgs.app.app.config
+        config['pgs.response_cache_max_size'] = 0
+        try:
+            output = self.request(
+                b'GET /a/b/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        finally:
+            del config['pgs.response_cache_max_size']
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(output.endswith(b'\r\n\r\nhere\n'))
+
+    @unittest.skipIf(sys.version_info < (3,),
+                     'idle connections hold threads on Python 2')
+    def test_idle_connections(self):
+        connections = []
+        try:
+            for i in range(4):  # more than the worker threads
+                sock = socket.create_connection(('127.0.0.1', self.port))
+                sock.settimeout(10)
+                connections.append(sock)
+            for sock in connections[:2]:  # idle keep-alive connections
+                sock.sendall(b'GET /index.html HTTP/1.1\r\n\r\n')
+                output = b''
+                while not output.endswith(b'awesome\n'):
+                    output += sock.recv(4096)
+            start = time.time()
+            output = self.request(
+                b'GET /a/b/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+            self.assertLess(time.time() - start, 2)
+        finally:
+            for sock in connections:
+                sock.close()
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(output.endswith(b'\r\n\r\nhere\n'))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'pgs.aio requires Python >= 3.7')
+class TestAsyncPgsServer(TestThreadPoolWSGIServer):
+
+    def setUp(self):
+        import asyncio
+        import pgs.aio
+        app = pgs.app.configure_app(pgs.app.app, self.conf)
+        self.loop = asyncio.new_event_loop()
+        self.srv = pgs.aio.AsyncPgsServer(app, keepalive_timeout=5)
+        server = self.loop.run_until_complete(self.srv.start('127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        import asyncio
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.srv.close())
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:  # connections the test left open
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.close()
+
+    def request(self, data):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(10)
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+        return b''.join(chunks)
+
+    def test_not_modified(self):
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        etag = [line.split(b': ', 1)[1] for line in output.split(b'\r\n')
+                if line.startswith(b'ETag: ')][0]
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nIf-None-Match: ' + etag +
+            b'\r\n\r\n'
+            b'GET /a/b/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 304 Not Modified\r\n'))
+        self.assertEqual(output.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertTrue(output.endswith(b'\r\n\r\nhere\n'))
+
+    def test_streamed_fallback(self):
+        import bottle
+        app = bottle.Bottle()
+        app.config['pgs.FS'] = self.srv.FS
+        app.route('/stream', callback=lambda: iter([b'a' * 70000, b'b']))
+        self.srv.app = app
+        output = self.request(
+            b'GET /stream HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertIn(b'Transfer-Encoding: chunked\r\n', output)
+        self.assertTrue(output.endswith(
+            b'\r\n\r\n11170\r\n' + b'a' * 70000 +
+            b'\r\n1\r\nb\r\n0\r\n\r\n'))
+        output = self.request(b'GET /stream HTTP/1.0\r\n\r\n')
+        self.assertIn(b'Connection: close\r\n', output)
+        self.assertTrue(output.endswith(b'\r\n\r\n' + b'a' * 70000 + b'b'))
+
+    def test_admission(self):
+        self.request(
+            b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.srv.fast_path.admission = AdmissionController(
+            max_inflight=0, max_wait=0, retry_after=2)
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\n\r\n'
+            b'GET /a/b/@@ HTTP/1.1\r\n\r\n'
+            b'GET /a/b/c HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'\r\n\r\nawesome\n'
+                      b'HTTP/1.1 503 Service Unavailable\r\n'
+                      b'Content-Length: 0\r\nRetry-After: 2\r\n', output)
+        self.assertEqual(output.count(b'503 Service Unavailable'), 2)
+        self.assertEqual(self.srv.fast_path.admission.inflight, 0)
+
+    def test_admission_queue(self):
+        admission = self.srv.fast_path.admission = AdmissionController(
+            max_inflight=1, max_queue=1, max_wait=10)
+        admission.inflight = 1
+        outputs = []
+        thread = threading.Thread(target=lambda: outputs.append(self.request(
+            b'GET /a/b/@@ HTTP/1.1\r\nConnection: close\r\n\r\n')))
+        thread.start()
+        deadline = time.time() + 5
+        while admission.waiting < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        output = self.request(
+            b'GET /a/b/@@ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.loop.call_soon_threadsafe(self.srv.admission.release)
+        thread.join()
+        self.assertTrue(outputs[0].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual((admission.inflight, admission.waiting), (0, 0))
+
+    def test_rate_limit(self):
+        self.srv.fast_path.rate_limiter = RateLimiter(0.01)
+        output = self.request(
+            b'GET /a/b/@@ HTTP/1.1\r\n\r\n'
+            b'GET /a/b/@@ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'HTTP/1.1 429 Too Many Requests\r\n'
+                      b'Content-Length: 0\r\nRetry-After: 100\r\n', output)
+
+    def test_open_error(self):
+        import asyncio
+        self.request(b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        FS = self.srv.FS
+        FS.responses.clear()
+
+        def fail(resource):
+            raise IOError('permission denied')
+
+        def fail_async(resource):
+            future = asyncio.get_event_loop().create_future()
+            future.set_exception(IOError('permission denied'))
+            return future
+
+        FS.open_cached = FS.open_resource = fail
+        FS.open = fail_async
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 403 Forbidden\r\n'))
+
+    def test_held_flight(self):
+        self.request(b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        FS = self.srv.FS
+        FS.responses.clear()
+        resource = FS.lookup('/index.html')
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            held.set()
+            done.wait(10)
+
+        thread = threading.Thread(target=FS.flights.do, args=(
+            ('response', resource.path, resource.etag, 'identity'), hold))
+        thread.start()
+        held.wait(5)
+        start = time.time()
+        try:
+            output = self.request(
+                b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        finally:
+            done.set()
+            thread.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(output.endswith(b'\r\n\r\nawesome\n'))
+
+
+class TestAsyncPgsServer_Git(TestAsyncPgsServer):
+
+    conf = confs['git0']
+
+    def test_async_git(self):
+        import pgs.aio
+        self.assertIsInstance(self.srv.FS, pgs.aio.AsyncGitRepositoryFS)
+
+    def test_admission_refresh(self):
+        self.request(b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        FS = self.srv.FS
+        FS._snapshot_checked = 0
+        self.srv.fast_path.admission = AdmissionController(
+            max_inflight=0, max_wait=0)
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertEqual(FS._snapshot_checked, 0)
+
+    def test_spooled_blob(self):
+        config = pgs.app.app.config
+        config['pgs.git_batch_max_size'] = 0
+        config['pgs.response_cache_max_size'] = 0
+        try:
+            output = self.request(
+                b'GET /a/b/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        finally:
+            del config['pgs.git_batch_max_size']
+            del config['pgs.response_cache_max_size']
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(output.endswith(b'\r\n\r\nhere\n'))
+
+    def test_git_limiter(self):
+        conf = dict(self.srv.FS.conf, **{'pgs.git_rev_ttl': 60,
+                                         'pgs.response_cache_max_size': 0})
+        FS = self.srv.app.config['pgs.FS'] = (
+            pgs.app.SubprocessGitRepositoryFS(conf))
+        output = self.request(
+            b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(output.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(output.endswith(b'\r\n\r\nawesome\n'))
+        self.assertEqual(FS.limiter.active, 0)
+        FS.limiter = ProcessLimiter(max_processes=1, queue_timeout=0.01,
+                                    retry_after=7)
+        FS.limiter.acquire()
+        try:
+            output = self.request(
+                b'GET /index.html HTTP/1.1\r\nConnection: close\r\n\r\n')
+        finally:
+            FS.limiter.release()
+        self.assertTrue(output.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn(b'Retry-After: 7\r\n', output)
+
+
 if __name__ == '__main__':
     unittest.main()